@@ -1,3 +1,4 @@
+import copy
 from configparser import NoOptionError
 
 import numpy as np
@@ -11,6 +12,8 @@ from helpers.analyzer import Analyzer
 SUPPORTED_METRICS = ["length", "numerical_value", "entropy", "base64_encoded_length", "hex_encoded_length",
                      "url_length", "relative_english_entropy"]
 SUPPORTED_TRIGGERS = ["high", "low"]
+# metrics that can be computed by Elasticsearch when pushing the aggregations down
+PUSHDOWN_METRICS = ["length", "numerical_value"]
 
 
 class MetricsAnalyzer(Analyzer):
@@ -21,17 +24,26 @@ class MetricsAnalyzer(Analyzer):
     # even the ones for which the number of documents is less than MIN_EVALUATE_BATCH.
     MIN_EVALUATE_BATCH = 100
 
+    # maximum number of aggregator values of which the outlier documents are fetched with a single query
+    PUSHDOWN_FETCH_BATCH_SIZE = 500
+
     def __init__(self, model_name, config_section):
         super(MetricsAnalyzer, self).__init__("metrics", model_name, config_section)
 
     def evaluate_model(self):
+        if self.model_settings["aggregation_pushdown"]:
+            if self._can_push_down_aggregations():
+                self._evaluate_model_with_aggregations()
+                return
+            logging.logger.warning("aggregation pushdown is not possible for use case %s, as it uses derived fields "
+                                   "or the %s metric - scanning all events instead", self.model_name,
+                                   self.model_settings["metric"])
+
         batch = defaultdict()  # Contain the current batch information
         remaining_metrics = defaultdict()
         total_metrics_in_batch = 0
 
-        self.total_events, documents = es.count_and_scan_documents(index=self.model_settings["es_index"],
-                                                                   search_query=self.search_query,
-                                                                   model_settings=self.model_settings)
+        self.total_events, documents = self.count_and_scan_documents()
 
         self.print_analysis_intro(event_type="evaluating " + self.model_name, total_events=self.total_events)
 
@@ -88,6 +100,174 @@ class MetricsAnalyzer(Analyzer):
 
         self.print_analysis_summary()
 
+    def _can_push_down_aggregations(self):
+        """
+        Check if the metrics of the use case can be computed by Elasticsearch: derived fields only exist in
+        ee-outliers, and only the numerical value and the length metrics can be computed in Elasticsearch
+
+        :return: True if the metrics can be computed with aggregations
+        """
+        return not self.model_settings["use_derived_fields"] and self.model_settings["metric"] in PUSHDOWN_METRICS
+
+    def _evaluate_model_with_aggregations(self):
+        """
+        Compute the decision frontier of each aggregator value from the statistics of the metric computed by
+        Elasticsearch, and only fetch the documents beyond the decision frontier of their aggregator value.
+        Contrary to the evaluation in batches, all events of the history window are evaluated at once, and
+        whitelisted outliers are skipped without computing the decision frontier again.
+        """
+        self.total_events = es.count_documents(index=self.model_settings["es_index"],
+                                               search_query=self.get_search_query(),
+                                               model_settings=self.model_settings)
+        self.print_analysis_intro(event_type="evaluating " + self.model_name, total_events=self.total_events)
+
+        if self.total_events > 0:
+            decision_frontiers, aggregator_field_values = self._get_decision_frontiers_from_aggregations()
+            logging.logger.info("computed decision frontiers of %s aggregators with Elasticsearch",
+                                "{:,}".format(len(decision_frontiers)))
+
+            if decision_frontiers:
+                self._process_outliers_beyond_decision_frontiers(decision_frontiers, aggregator_field_values)
+            else:
+                logging.logger.info("no outliers processed")
+
+        self.print_analysis_summary()
+
+    def _get_decision_frontiers_from_aggregations(self):
+        """
+        Compute the decision frontier of each aggregator value, from the statistics of the metric computed by
+        Elasticsearch for each aggregator value
+
+        :return: dictionary with the decision frontier of each aggregator value, and dictionary with the raw field
+        values of each aggregator value
+        """
+        percents = [50]
+        if self.model_settings["trigger_method"] == "percentile":
+            percents.append(self.model_settings["trigger_sensitivity"])
+
+        decision_frontiers = dict()
+        aggregator_field_values = dict()
+        for values, stats in es.scan_metric_aggregation(index=self.model_settings["es_index"],
+                                                        aggregator_fields=self.model_settings["aggregator"],
+                                                        target_field=self.model_settings["target"],
+                                                        metric=self.model_settings["metric"],
+                                                        search_query=self.get_search_query(),
+                                                        model_settings=self.model_settings, percents=percents):
+            if not stats["count"]:
+                continue
+
+            aggregator_value = helpers.utils.flatten_sentence(
+                [helpers.utils.flatten_sentence(value) for value in values])
+            decision_frontier = helpers.utils.get_decision_frontier_from_stats(
+                self.model_settings["trigger_method"], stats, self.model_settings["trigger_sensitivity"],
+                self.model_settings["trigger_on"])
+            logging.logger.debug("using decision frontier %s for aggregator %s - %s", decision_frontier,
+                                 aggregator_value, self.model_settings["metric"])
+
+            # no value is beyond an undefined decision frontier (coefficient of variation of values averaging 0)
+            if np.isnan(decision_frontier):
+                continue
+
+            decision_frontiers[aggregator_value] = decision_frontier
+            aggregator_field_values[aggregator_value] = values
+
+        return decision_frontiers, aggregator_field_values
+
+    def _process_outliers_beyond_decision_frontiers(self, decision_frontiers, aggregator_field_values):
+        """
+        Fetch the documents of which the metric is beyond the decision frontier of their aggregator value and
+        process their outliers
+
+        :param decision_frontiers: dictionary with the decision frontier of each aggregator value
+        :param aggregator_field_values: dictionary with the raw field values of each aggregator value
+        """
+        aggregatable_fields = es.get_aggregatable_fields(self.model_settings["es_index"],
+                                                         self.model_settings["aggregator"])
+        metric_source = es.get_metric_source(self.model_settings["es_index"], self.model_settings["target"],
+                                             self.model_settings["metric"])
+        aggregator_values = list(decision_frontiers.keys())
+
+        for i in range(0, len(aggregator_values), self.PUSHDOWN_FETCH_BATCH_SIZE):
+            batch_aggregator_values = aggregator_values[i:i + self.PUSHDOWN_FETCH_BATCH_SIZE]
+            frontier_filters = list()
+            for aggregator_value in batch_aggregator_values:
+                filters = [{"term": {aggregatable_fields[field]: value}} for field, value in
+                           zip(self.model_settings["aggregator"], aggregator_field_values[aggregator_value])]
+                filters.append(self._build_decision_frontier_filter(decision_frontiers[aggregator_value],
+                                                                    metric_source))
+                frontier_filters.append({"bool": {"filter": filters}})
+
+            # each batch extends the query of the use case with its own filter
+            search_query = copy.deepcopy(self.get_search_query())
+            search_query["filter"] = search_query.get("filter", list()) + \
+                [{"bool": {"should": frontier_filters, "minimum_should_match": 1}}]
+
+            # all fetched documents are outliers, so their complete source is fetched right away
+            total_documents, documents = es.count_and_scan_documents(index=self.model_settings["es_index"],
+                                                                     search_query=search_query,
+                                                                     model_settings=self.model_settings)
+            logging.init_ticker(total_steps=total_documents,
+                                desc=self.model_name + " - processing outliers of metrics model")
+
+            for doc in documents:
+                logging.tick()
+                doc["_source_complete"] = True
+                self._process_document_beyond_decision_frontiers(doc, decision_frontiers)
+
+    def _build_decision_frontier_filter(self, decision_frontier, metric_source):
+        """
+        Build the filter matching the documents of which the metric is beyond the decision frontier
+
+        :param decision_frontier: the decision frontier
+        :param metric_source: dictionary with the field or the script of the metric
+        :return: the filter
+        """
+        operator = "gt" if self.model_settings["trigger_on"] == "high" else "lt"
+        # infinite values can't be sent in a query, while all finite values compare the same way with the largest float
+        max_float = np.finfo(np.float64).max
+        decision_frontier = np.clip(decision_frontier, -max_float, max_float)
+
+        if "field" in metric_source:
+            return {"range": {metric_source["field"]: {operator: float(decision_frontier)}}}
+
+        script_source = "def value = " + metric_source["script"]["source"] + "; return value != null && value " + \
+                        (">" if operator == "gt" else "<") + " params.decision_frontier;"
+        script_params = dict(metric_source["script"]["params"], decision_frontier=float(decision_frontier))
+        return {"script": {"script": {"source": script_source, "lang": metric_source["script"]["lang"],
+                                      "params": script_params}}}
+
+    def _process_document_beyond_decision_frontiers(self, doc, decision_frontiers):
+        """
+        Process an outlier for each aggregator value of a document of which the metric is beyond the decision frontier
+
+        :param doc: the document
+        :param decision_frontiers: dictionary with the decision frontier of each aggregator value
+        """
+        target_value, aggregator_sentences = self._compute_aggregator_and_target_value(doc)
+        if target_value is None or aggregator_sentences is None:
+            return
+
+        metric, metric_observations = self.calculate_metric(self.model_settings["metric"], target_value)
+        if metric is None:
+            return
+
+        for aggregator_sentence in aggregator_sentences:
+            aggregator_value = helpers.utils.flatten_sentence(aggregator_sentence)
+            if aggregator_value not in decision_frontiers or not helpers.utils.is_outlier(
+                    metric, decision_frontiers[aggregator_value], self.model_settings["trigger_on"]):
+                continue
+
+            observations = dict(metric_observations, target=target_value, aggregator=aggregator_value)
+            self._add_outlier_observations(observations, set(), decision_frontiers[aggregator_value], metric)
+
+            fields = es.extract_fields_from_document(
+                doc, extract_derived_fields=self.model_settings["use_derived_fields"])
+            outlier = self.create_outlier(fields, doc, extra_outlier_information=observations)
+            if outlier.is_whitelisted(self.model_whitelist_literals, self.model_whitelist_regexps):
+                self.nr_whitelisted_elements += 1
+            else:
+                self.process_outlier(outlier)
+
     def _add_document_to_batch(self, doc, batch, target_value, aggregator_sentences):
         """
         Compute different metrics and observation to add them to the batch
@@ -240,6 +420,11 @@ class MetricsAnalyzer(Analyzer):
         list_documents_need_to_be_removed = []
         non_outlier_values = set()
 
+        self.complete_documents([raw_doc for raw_doc, metric_value in zip(metrics_aggregator_value["raw_docs"],
+                                                                          metrics_aggregator_value["metrics"])
+                                 if helpers.utils.is_outlier(metric_value, decision_frontier,
+                                                             self.model_settings["trigger_on"])])
+
         # Calculate all outliers in array
         for ii, metric_value in enumerate(metrics_aggregator_value["metrics"]):
             is_outlier = helpers.utils.is_outlier(metric_value, decision_frontier,
@@ -272,7 +457,27 @@ class MetricsAnalyzer(Analyzer):
         """
 
         observations = metrics_aggregator_value["observations"][ii]
+        self._add_outlier_observations(observations, non_outlier_values, decision_frontier, metric_value)
+
+        # Extract fields from raw document
+        fields = es.extract_fields_from_document(
+            metrics_aggregator_value["raw_docs"][ii],
+            extract_derived_fields=self.model_settings["use_derived_fields"])
+
+        outlier = self.create_outlier(fields, metrics_aggregator_value["raw_docs"][ii],
+                                      extra_outlier_information=observations)
+        return outlier
 
+    @staticmethod
+    def _add_outlier_observations(observations, non_outlier_values, decision_frontier, metric_value):
+        """
+        Add the observations linked to the detection of an outlier
+
+        :param observations: the observations of the document, updated in place
+        :param non_outlier_values: set of metric values that aren't outliers
+        :param decision_frontier: the value of the decision frontier
+        :param metric_value: the metric value
+        """
         if non_outlier_values:
             non_outlier_values_sample = ",".join(random.sample(
                 non_outlier_values, 3 if len(non_outlier_values) > 3 else len(non_outlier_values)))
@@ -286,15 +491,6 @@ class MetricsAnalyzer(Analyzer):
         confidence = np.abs(decision_frontier - metric_value)
         observations["confidence"] = confidence
 
-        # Extract fields from raw document
-        fields = es.extract_fields_from_document(
-            metrics_aggregator_value["raw_docs"][ii],
-            extract_derived_fields=self.model_settings["use_derived_fields"])
-
-        outlier = self.create_outlier(fields, metrics_aggregator_value["raw_docs"][ii],
-                                      extra_outlier_information=observations)
-        return outlier
-
     def _extract_additional_model_settings(self):
         """
         Override method from Analyzer
@@ -320,6 +516,9 @@ class MetricsAnalyzer(Analyzer):
 
         self.metrics_batch_eval_size = settings.config.getint("metrics", "metrics_batch_eval_size")
 
+        self.model_settings["aggregation_pushdown"] = self.extract_parameter("aggregation_pushdown", "boolean",
+                                                                             default=False)
+
     @staticmethod
     def add_metric_to_batch(eval_metrics_array, aggregator_value, target_value, metrics_value, observations, doc):
         """
@@ -1,7 +1,15 @@
 from helpers.singletons import settings, es, logging
 from helpers.analyzer import Analyzer
+import helpers.utils
 import re
+import copy
 from configparser import NoSectionError, NoOptionError
+from elasticsearch.exceptions import RequestError
+
+# placeholders of the outlier summary, type and reason, replaced by the values of each event
+PLACEHOLDER_REGEX = re.compile(r'\{([^\}]*)\}')
+# maximum number of events already flagged by a use case that are excluded by id from its query, in append write mode
+MAX_EXCLUDED_OUTLIER_IDS = 10000
 
 
 class SimplequeryAnalyzer(Analyzer):
@@ -21,8 +29,24 @@ class SimplequeryAnalyzer(Analyzer):
             except (NoSectionError, NoOptionError):
                 self.model_settings["highlight_match"] = False
 
-    def evaluate_model(self):
+        # simplequery use cases can share their scans without enabling shared scans for all use cases
+        self.model_settings["es_shared_scan"] = self.extract_parameter("es_shared_scan", "boolean",
+                                                                       default=self.model_settings["es_shared_scan"])
 
+        self.model_settings["server_side_tagging"] = self.extract_parameter("server_side_tagging", "boolean",
+                                                                            default=False)
+
+    def get_source_includes(self):
+        """
+        Override method from Analyzer: a simple query hit can match on any field, so complete documents are always
+        scanned
+        """
+        return None
+
+    def get_search_query(self):
+        """
+        Override method from Analyzer: exclude the documents already flagged as outlier by this use case
+        """
         model_filter = {
             "bool": {
                 "filter": [{
@@ -42,22 +66,47 @@ class SimplequeryAnalyzer(Analyzer):
             }
         }
 
+        query = copy.deepcopy(self.search_query)
+
+        # in append write mode, the outliers are not part of the documents but stored in a dedicated index
+        if es.get_outliers_write_mode() == "append":
+            outlier_document_ids = es.get_outlier_document_ids(self.model_type, self.model_name, self.model_settings,
+                                                               max_ids=MAX_EXCLUDED_OUTLIER_IDS)
+            if outlier_document_ids is None:
+                # too many events to exclude, they are scanned again but the records of their outliers already exist
+                # and are not indexed twice
+                logging.logger.debug("more than %d events already flagged by use case %s, not excluding them from "
+                                     "the search query", MAX_EXCLUDED_OUTLIER_IDS, self.config_section_name)
+                return query
+            model_filter = {"ids": {"values": outlier_document_ids}}
+
         exclude_hits_filter = {
             "bool": {
                 "must_not": model_filter
             }
         }
 
-        query = self.search_query
-
         if "filter" in query:
             query["filter"].append(exclude_hits_filter)
         else:
             query["filter"] = [exclude_hits_filter]
 
-        self.total_events, documents = es.count_and_scan_documents(index=self.model_settings["es_index"],
-                                                                   search_query=query,
-                                                                   model_settings=self.model_settings)
+        return query
+
+    def evaluate_model(self):
+        if self.model_settings["server_side_tagging"] and self.shared_scan_feed is None and \
+                self._can_tag_server_side():
+            outlier = self._create_outlier({"_source": dict()})
+            whitelist_filter = self._build_whitelist_filter(outlier)
+            if whitelist_filter is not None:
+                try:
+                    self.evaluate_model_server_side(outlier, whitelist_filter)
+                    return
+                except RequestError:
+                    logging.logger.warning("unable to add the outliers of use case %s in Elasticsearch, scanning the "
+                                           "events instead", self.config_section_name, exc_info=True)
+
+        self.total_events, documents = self.count_and_scan_documents()
 
         self.print_analysis_intro(event_type="evaluating " + self.model_type + "_" + self.model_name,
                                   total_events=self.total_events)
@@ -94,3 +143,139 @@ class SimplequeryAnalyzer(Analyzer):
         fields = es.extract_fields_from_document(raw_doc,
                                                  extract_derived_fields=self.model_settings["use_derived_fields"])
         return self.create_outlier(fields, raw_doc, extra_outlier_information=extra_outlier_information)
+
+    def _can_tag_server_side(self):
+        """
+        Check if the outliers of the use case are the same for all events, apart from their assets, and don't need
+        any client-side processing, so that they can be added by Elasticsearch with an update by query
+
+        :return: True if the outliers can be added by Elasticsearch
+        """
+        if self.model_settings["use_derived_fields"] or self.model_settings["should_notify"] or \
+                self.model_settings["highlight_match"]:
+            return False
+
+        if not settings.es_save_results or settings.print_outliers_to_console:
+            return False
+
+        # append mode indexes a record per outlier, and coalesced outlier updates sending complete events would
+        # overwrite the outliers added by Elasticsearch
+        write_mode = es.get_outliers_write_mode()
+        if write_mode == "append" or (write_mode == "full" and settings.config.getboolean(
+                "general", "es_coalesce_outlier_updates", fallback=False)):
+            return False
+
+        return not any(PLACEHOLDER_REGEX.search(self.model_settings[setting_name] or "")
+                       for setting_name in ("outlier_summary", "outlier_type", "outlier_reason"))
+
+    def _build_whitelist_filter(self, outlier):
+        """
+        Translate the whitelists into a list of queries that match at least all events of which the outlier could be
+        whitelisted. A literal whitelist entry matches the events containing all its values that are not already part
+        of the outlier, with term queries on the fields of the index. Regular expression whitelist entries, entries
+        on assets, and indices with fields on which term queries don't match the values exactly can't be translated
+        into queries.
+
+        :param outlier: the outlier of the use case, without event
+        :return: list of queries, or None if the whitelists can't be translated into queries
+        """
+        if settings.whitelist_regexps_config or self.model_whitelist_regexps:
+            return None
+
+        outlier_values = set()
+        for value in helpers.utils.nested_dict_values(outlier.outlier_dict):
+            values = value if isinstance(value, list) else [value]
+            outlier_values.update(str(item).strip() for item in values)
+
+        event_whitelists = list()
+        for whitelist_values in settings.whitelist_literals_config + self.model_whitelist_literals:
+            event_whitelist_values = [value for value in whitelist_values if value not in outlier_values]
+            # all outliers of the use case are whitelisted
+            if not event_whitelist_values:
+                return None
+            event_whitelists.append(sorted(event_whitelist_values))
+
+        if not event_whitelists:
+            return list()
+
+        # the assets of each event are added to its outlier
+        asset_prefixes = tuple(asset_field_type + ": " for _, asset_field_type in settings.list_assets)
+        if asset_prefixes and any(value.startswith(asset_prefixes) for event_whitelist_values in event_whitelists
+                                  for value in event_whitelist_values):
+            return None
+
+        exact_match_fields = es.get_exact_match_fields(self.model_settings["es_index"])
+        if exact_match_fields is None:
+            logging.logger.debug("some fields of index %s can't be matched exactly, scanning the events of use case "
+                                 "%s", self.model_settings["es_index"], self.config_section_name)
+            return None
+
+        return [{"bool": {"filter": [self._build_whitelist_value_query(value, exact_match_fields)
+                                     for value in event_whitelist_values]}}
+                for event_whitelist_values in event_whitelists]
+
+    @staticmethod
+    def _build_whitelist_value_query(value, exact_match_fields):
+        """
+        Build a query matching all events containing a whitelisted value, as value of one of their fields, as id or as
+        index
+
+        :param value: the whitelisted value
+        :param exact_match_fields: the fields on which term queries match the values exactly
+        :return: the query
+        """
+        value_queries = [{"ids": {"values": [value]}},
+                         {"term": {"_index": value}}]
+        value_queries.extend({"term": {field: value}} for field in exact_match_fields)
+
+        return {"bool": {"should": value_queries, "minimum_should_match": 1}}
+
+    def evaluate_model_server_side(self, outlier, whitelist_filter):
+        """
+        Add the outlier of the use case to its events with an update by query running in Elasticsearch, instead of
+        scanning all events. The events that could be whitelisted are excluded from the update by query, and
+        evaluated by scanning them.
+
+        :param outlier: the outlier of the use case, without event
+        :param whitelist_filter: list of queries matching at least all events that could be whitelisted
+        """
+        search_query = self.get_search_query()
+        self.total_events = es.count_documents(index=self.model_settings["es_index"], search_query=search_query,
+                                               model_settings=self.model_settings)
+
+        self.print_analysis_intro(event_type="evaluating " + self.model_type + "_" + self.model_name,
+                                  total_events=self.total_events)
+
+        if self.total_events > 0:
+            update_search_query = copy.deepcopy(search_query)
+            if whitelist_filter:
+                update_search_query["filter"].append({"bool": {"must_not": whitelist_filter}})
+
+            logging.logger.info("adding outliers in Elasticsearch for use case %s", self.config_section_name)
+            result = es.add_outlier_by_query(index=self.model_settings["es_index"], search_query=update_search_query,
+                                             model_settings=self.model_settings,
+                                             outlier_dict_of_arrays=outlier.get_outlier_dict_of_arrays())
+
+            nr_outliers = result.get("updated", 0) + result.get("noops", 0)
+            self.total_outliers += nr_outliers
+            self.nr_unchanged_outliers += result.get("noops", 0)
+            if nr_outliers > 0:
+                self.outlier_summaries.add(outlier.outlier_dict["summary"])
+
+        if self.total_events > 0 and whitelist_filter:
+            # evaluate the events that could be whitelisted like any other use case
+            whitelist_search_query = copy.deepcopy(search_query)
+            whitelist_search_query["filter"].append({"bool": {"should": whitelist_filter,
+                                                              "minimum_should_match": 1}})
+            total_whitelist_events, documents = es.count_and_scan_documents(
+                index=self.model_settings["es_index"], search_query=whitelist_search_query,
+                query_fields=self.get_source_includes(), model_settings=self.model_settings)
+
+            logging.init_ticker(total_steps=total_whitelist_events,
+                                desc=self.model_name + " - evaluating " + self.model_type + " model")
+            if total_whitelist_events > 0:
+                for doc in documents:
+                    logging.tick()
+                    self.process_outlier(self._create_outlier(doc))
+
+        self.print_analysis_summary()
@@ -1,15 +1,18 @@
 from helpers.singletons import settings, es, logging
 from helpers.analyzer import Analyzer
+from helpers.firstseenstore import FirstSeenStore
 import datetime as dt
 import dateutil.parser
 import math
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 
 
 class SuddenAppearanceAnalyzer(Analyzer):
 
     def __init__(self, model_name, config_section):
         super(SuddenAppearanceAnalyzer, self).__init__("sudden_appearance", model_name, config_section)
-        self.end_time = dt.datetime.now()
+        self.end_time = es.get_run_end_time()
         self.num_event_proc = 0  # Current number of events processed
 
     def _extract_additional_model_settings(self):
@@ -20,13 +23,6 @@ class SuddenAppearanceAnalyzer(Analyzer):
                                                                      "timestamp_field",
                                                                      fallback="@timestamp")
 
-        self.model_settings["max_num_aggs"] = settings.config.getint("sudden_appearance",
-                                                                     "max_num_aggregators",
-                                                                     fallback=100000)
-        self.model_settings["max_num_targets"] = settings.config.getint("sudden_appearance",
-                                                                        "max_num_targets",
-                                                                        fallback=100000)
-
         self.model_settings["target"] = self.config_section["target"].replace(' ', '').split(",")
         self.model_settings["aggregator"] = self.config_section["aggregator"].replace(' ', '').split(",")
 
@@ -57,6 +53,26 @@ class SuddenAppearanceAnalyzer(Analyzer):
             raise ValueError("sliding_window_step_size of %s should not be bigger than sliding_window_size of %s"
                              % (str(self.jump_win), str(self.delta_slide_win)))
 
+        self.model_settings["single_pass_evaluation"] = self.extract_parameter("single_pass_evaluation", "boolean",
+                                                                               default=False)
+        self.model_settings["max_parallel_windows"] = self.extract_parameter("max_parallel_windows", "int", default=1)
+        if self.model_settings["max_parallel_windows"] < 1:
+            raise ValueError("max_parallel_windows should be bigger than 0")
+
+        self.model_settings["first_seen_store"] = self.extract_parameter("first_seen_store", "boolean", default=False)
+        self.model_settings["first_seen_store_directory"] = self.extract_parameter("first_seen_store_directory",
+                                                                                   default="/mappedvolumes/data/state/")
+        self.model_settings["first_seen_store_overlap_minutes"] = self.extract_parameter(
+            "first_seen_store_overlap_minutes", "int", default=10)
+        if self.model_settings["first_seen_store_overlap_minutes"] < 0:
+            raise ValueError("first_seen_store_overlap_minutes should not be negative")
+
+    def get_source_includes(self):
+        """
+        Override method from Analyzer: documents are fetched through aggregations and not scanned
+        """
+        return None
+
     def evaluate_model(self):
         self.total_events = es.count_documents(index=self.model_settings["es_index"],
                                                search_query=self.search_query,
@@ -65,29 +81,70 @@ class SuddenAppearanceAnalyzer(Analyzer):
         self.print_analysis_intro(event_type="evaluating " + self.model_type + "_" + self.model_name,
                                   total_events=self.total_events)
 
-        # Compute the number of times we will scan the slide window
-        num_jump = math.ceil((self.delta_history_win - self.delta_slide_win) / self.jump_win)
-        num_scan = num_jump + 1
+        first_seen_store = None
+        last_processed_time = None
+        if self.model_settings["first_seen_store"]:
+            first_seen_store = FirstSeenStore(self.model_settings["first_seen_store_directory"])
+            last_processed_time = first_seen_store.get_last_processed_time(self.config_section_name)
 
-        logging.init_ticker(total_steps=num_scan,
-                            desc=self.model_name + " - evaluating " + self.model_type + " model")
+        try:
+            if last_processed_time is not None:
+                logging.init_ticker(total_steps=1,
+                                    desc=self.model_name + " - evaluating " + self.model_type + " model")
+                self.find_sudden_appearance_since_last_run(first_seen_store, last_processed_time)
+            else:
+                sliding_windows = self._get_sliding_windows()
+
+                logging.init_ticker(total_steps=len(sliding_windows),
+                                    desc=self.model_name + " - evaluating " + self.model_type + " model")
+
+                if self.model_settings["single_pass_evaluation"]:
+                    self.find_sudden_appearance_in_single_pass(sliding_windows)
+                elif self.model_settings["max_parallel_windows"] > 1:
+                    self.find_sudden_appearance_in_parallel(sliding_windows)
+                else:
+                    for start_slide_win, end_slide_win in sliding_windows:
+                        self.find_sudden_appearance(start_slide_win, end_slide_win)
+
+                if first_seen_store is not None:
+                    # first run of the use case: remember all combinations of the history window
+                    self._save_first_seen_combinations(first_seen_store, self.end_time - self.delta_history_win,
+                                                       self.end_time)
+
+            if first_seen_store is not None:
+                first_seen_store.set_last_processed_time(self.config_section_name, self.end_time)
+        finally:
+            if first_seen_store is not None:
+                first_seen_store.close()
+
+        self.print_analysis_summary()
+
+    def _get_sliding_windows(self):
+        """
+        Compute the time windows evaluated by the model: windows of size self.delta_slide_win moving by steps of
+        self.jump_win through the history window, followed by a last window of size self.jump_win ending at
+        self.end_time
+
+        :return: list of tuples with the start and the end time of each time window
+        """
+        sliding_windows = list()
 
         start_slide_win = self.end_time - self.delta_history_win
         end_slide_win = start_slide_win + self.delta_slide_win
 
         if end_slide_win == self.end_time:
-            self.find_sudden_appearance(start_slide_win, end_slide_win)
+            sliding_windows.append((start_slide_win, end_slide_win))
 
         while end_slide_win < self.end_time:
-            self.find_sudden_appearance(start_slide_win, end_slide_win)
+            sliding_windows.append((start_slide_win, end_slide_win))
             start_slide_win += self.jump_win
             end_slide_win += self.jump_win
             if end_slide_win >= self.end_time:
                 end_slide_win = self.end_time
                 start_slide_win = self.end_time - self.jump_win
-                self.find_sudden_appearance(start_slide_win, end_slide_win)
+                sliding_windows.append((start_slide_win, end_slide_win))
 
-        self.print_analysis_summary()
+        return sliding_windows
 
     def find_sudden_appearance(self, start_slide_win, end_slide_win):
         """
@@ -99,49 +156,302 @@ class SuddenAppearanceAnalyzer(Analyzer):
         :param start_slide_win: start time of the time window
         :param end_slide_win: end time of the time window
         """
-        aggregator_buckets = es.scan_first_occur_documents(search_query=self.search_query,
-                                                           start_time=start_slide_win,
-                                                           end_time=end_slide_win,
-                                                           model_settings=self.model_settings)
-        # Loop over the aggregations
-        for aggregator_bucket in aggregator_buckets:
-            target_buckets = aggregator_bucket["target"]["buckets"]
-            # Loop over the documents in aggregation
-            for doc in target_buckets:
-                self.num_event_proc += doc["doc_count"]
-                raw_doc = doc["top_doc"]["hits"]["hits"][0]
+        self._process_sudden_appearance(self._scan_first_occur_documents(start_slide_win, end_slide_win),
+                                        start_slide_win, end_slide_win)
+
+    def find_sudden_appearance_in_parallel(self, sliding_windows):
+        """
+        Find sudden apparitions in all time windows, with the aggregations of up to
+        self.model_settings["max_parallel_windows"] time windows running concurrently. The outliers are still
+        processed by the current thread, one time window after the other, in the order of the time windows.
+
+        :param sliding_windows: list of tuples with the start and the end time of each time window
+        """
+        max_parallel_windows = self.model_settings["max_parallel_windows"]
+        with ThreadPoolExecutor(max_workers=max_parallel_windows) as executor:
+            pending_windows = deque()
+            for start_slide_win, end_slide_win in sliding_windows:
+                # the generator only queries Elasticsearch once it is consumed, by a thread of the pool
+                future = executor.submit(list, self._scan_first_occur_documents(start_slide_win, end_slide_win))
+                pending_windows.append((future, start_slide_win, end_slide_win))
+
+                # wait for the oldest time window before submitting more, so that at most max_parallel_windows time
+                # windows are kept in memory
+                if len(pending_windows) >= max_parallel_windows:
+                    future, start, end = pending_windows.popleft()
+                    self._process_sudden_appearance(future.result(), start, end)
+
+            while pending_windows:
+                future, start, end = pending_windows.popleft()
+                self._process_sudden_appearance(future.result(), start, end)
+
+    def _scan_first_occur_documents(self, start_slide_win, end_slide_win):
+        """
+        Page through the combinations of aggregator and target values of a time window, fetching the first document
+        of the combinations that may appear for the first time in the last step of the time window
+
+        :param start_slide_win: start time of the time window
+        :param end_slide_win: end time of the time window
+        :return: generator of combinations
+        """
+        return es.scan_first_occur_documents(search_query=self.search_query,
+                                             start_time=start_slide_win,
+                                             end_time=end_slide_win,
+                                             model_settings=self.model_settings,
+                                             first_occur_start_time=end_slide_win - self.jump_win)
+
+    def _process_sudden_appearance(self, first_occur_buckets, start_slide_win, end_slide_win):
+        """
+        Create outliers for the combinations of aggregator and target values of a time window that appear for the
+        first time in the last step of the time window
+
+        :param first_occur_buckets: iterable of combinations of the time window
+        :param start_slide_win: start time of the time window
+        :param end_slide_win: end time of the time window
+        """
+        first_occur_start_time = end_slide_win - self.jump_win
+        # Loop over the combinations of aggregator and target values, page by page
+        for first_occur_bucket in first_occur_buckets:
+            self.num_event_proc += first_occur_bucket["doc_count"]
+            raw_doc = first_occur_bucket["top_doc"]
+            # the first document is only fetched if the combination may appear for the first time after
+            # first_occur_start_time
+            if raw_doc is None:
+                continue
+
+            fields = es.extract_fields_from_document(raw_doc,
+                                                     extract_derived_fields=self.model_settings["use_derived_fields"])
+            # convert the event timestamp in the right format
+            event_timestamp = dateutil.parser.parse(fields[self.model_settings["timestamp_field"]],
+                                                    ignoretz=True)
+
+            if event_timestamp > first_occur_start_time:
+                self._process_first_occurrence(first_occur_bucket, fields, event_timestamp, start_slide_win,
+                                               end_slide_win)
+
+        logging.tick(self.num_event_proc)
+
+    def find_sudden_appearance_since_last_run(self, first_seen_store, last_processed_time):
+        """
+        Find the combinations of aggregator and target values that appear for the first time since the previous run
+        of the use case: the combinations of the events between last_processed_time and self.end_time that are not
+        in the first-seen store. Only the first document of these combinations is fetched, and all combinations of
+        the events are saved in the store.
+        The events of the last first_seen_store_overlap_minutes before last_processed_time are processed again, so
+        that events ingested late are still evaluated. Their combinations that were already processed are in the store.
+
+        :param first_seen_store: the store of the combinations seen during previous runs
+        :param last_processed_time: time up to which the events were processed during the previous run
+        """
+        start_time = last_processed_time - dt.timedelta(minutes=self.model_settings["first_seen_store_overlap_minutes"])
+        first_occur_buckets = es.scan_first_occur_documents(search_query=self.search_query,
+                                                            start_time=start_time,
+                                                            end_time=self.end_time,
+                                                            model_settings=self.model_settings,
+                                                            fetch_documents=False)
+
+        for first_occur_batch in self._get_first_occur_batches(first_occur_buckets):
+            seen_combinations = first_seen_store.get_seen_combinations(
+                self.config_section_name,
+                [(first_occur_bucket["aggregator"], first_occur_bucket["target"])
+                 for first_occur_bucket in first_occur_batch])
+            new_first_occur_buckets = [first_occur_bucket for first_occur_bucket in first_occur_batch
+                                       if (first_occur_bucket["aggregator"], first_occur_bucket["target"])
+                                       not in seen_combinations]
+            if new_first_occur_buckets:
+                es.fetch_first_occur_documents(new_first_occur_buckets, search_query=self.search_query,
+                                               start_time=start_time, end_time=self.end_time,
+                                               model_settings=self.model_settings)
+
+            for first_occur_bucket in new_first_occur_buckets:
+                raw_doc = first_occur_bucket["top_doc"]
+                if raw_doc is None:
+                    continue
+
                 fields = es.extract_fields_from_document(raw_doc,
                                                          extract_derived_fields=self.model_settings[
                                                              "use_derived_fields"])
-                # convert the event timestamp in the right format
                 event_timestamp = dateutil.parser.parse(fields[self.model_settings["timestamp_field"]],
                                                         ignoretz=True)
+                self._process_first_occurrence(first_occur_bucket, fields, event_timestamp, start_time, self.end_time)
 
-                if event_timestamp > (end_slide_win - self.jump_win):
-                    # retrieve extra information
-                    extra_outlier_information = dict()
-                    extra_outlier_information["size_time_window"] = str(self.delta_slide_win)
-                    extra_outlier_information["start_time_window"] = str(start_slide_win)
-                    extra_outlier_information["end_time_window"] = str(end_slide_win)
-                    extra_outlier_information["aggregator"] = self.model_settings["aggregator"]
-                    extra_outlier_information["aggregator_value"] = aggregator_bucket["key"]
-                    extra_outlier_information["target"] = self.model_settings["target"]
-                    extra_outlier_information["target_value"] = doc["key"]
-                    extra_outlier_information["num_target_value_in_window"] = doc["doc_count"]
-
-                    outlier = self.create_outlier(fields,
-                                                  raw_doc,
-                                                  extra_outlier_information=extra_outlier_information)
-                    self.process_outlier(outlier)
-
-                    summary = "In aggregator '%s: %s', the field(s) '%s: %s' appear(s) " \
-                              "suddenly at %s of the time window of size %s." % \
-                              (", ".join(self.model_settings["aggregator"]),
-                               aggregator_bucket["key"],
-                               " ,".join(self.model_settings["target"]),
-                               doc["key"],
-                               str(event_timestamp),
-                               self.delta_slide_win)
-                    logging.logger.debug(summary)
+            self.num_event_proc += sum(first_occur_bucket["doc_count"] for first_occur_bucket in first_occur_batch)
+            self._add_first_seen_occurrences(first_seen_store, first_occur_batch)
 
         logging.tick(self.num_event_proc)
+
+    def _save_first_seen_combinations(self, first_seen_store, start_time, end_time):
+        """
+        Save all combinations of aggregator and target values of the events between start_time and end_time in the
+        first-seen store
+
+        :param first_seen_store: the store of the combinations seen during previous runs
+        :param start_time: start time of the events
+        :param end_time: end time of the events
+        """
+        first_occur_buckets = es.scan_first_occur_documents(search_query=self.search_query,
+                                                            start_time=start_time,
+                                                            end_time=end_time,
+                                                            model_settings=self.model_settings,
+                                                            fetch_documents=False)
+        for first_occur_batch in self._get_first_occur_batches(first_occur_buckets):
+            self._add_first_seen_occurrences(first_seen_store, first_occur_batch)
+
+    def _add_first_seen_occurrences(self, first_seen_store, first_occur_buckets):
+        """
+        Save the first and last occurrence of combinations of aggregator and target values in the first-seen store
+
+        :param first_seen_store: the store of the combinations seen during previous runs
+        :param first_occur_buckets: list of combinations
+        """
+        first_seen_store.add_occurrences(self.config_section_name,
+                                         [(first_occur_bucket["aggregator"], first_occur_bucket["target"],
+                                           first_occur_bucket["first_occur_time"],
+                                           first_occur_bucket["last_occur_time"])
+                                          for first_occur_bucket in first_occur_buckets])
+
+    @staticmethod
+    def _get_first_occur_batches(first_occur_buckets):
+        """
+        Group combinations of aggregator and target values in batches of the size of a multi search request fetching
+        their first documents
+
+        :param first_occur_buckets: generator of combinations
+        :return: generator of lists of combinations
+        """
+        first_occur_batch = list()
+        for first_occur_bucket in first_occur_buckets:
+            first_occur_batch.append(first_occur_bucket)
+            if len(first_occur_batch) >= es.FIRST_OCCUR_DOCUMENTS_MSEARCH_SIZE:
+                yield first_occur_batch
+                first_occur_batch = list()
+        if first_occur_batch:
+            yield first_occur_batch
+
+    def find_sudden_appearance_in_single_pass(self, sliding_windows):
+        """
+        Find sudden apparitions in all time windows at once. The number of events and the first occurrence of each
+        combination of aggregator and target values are computed once for each interval of the history window, with
+        intervals of which the duration divides the size and the step of the time windows. The combinations appearing
+        for the first time in the last step of each time window are then derived from these intervals, and only their
+        first document is fetched, with at most one multi search request per time window.
+
+        :param sliding_windows: list of tuples with the start and the end time of each time window
+        """
+        history_start_time = self.end_time - self.delta_history_win
+        interval = self._get_single_pass_interval()
+
+        # number of events and first occurrence of each combination, for each interval in which it occurs
+        occurrences = defaultdict(dict)
+        for first_occur_bucket in es.scan_first_occur_per_interval(search_query=self.search_query,
+                                                                   start_time=history_start_time,
+                                                                   end_time=self.end_time,
+                                                                   interval=interval,
+                                                                   model_settings=self.model_settings):
+            occurrences[(first_occur_bucket["aggregator"], first_occur_bucket["target"])][
+                first_occur_bucket["interval"]] = first_occur_bucket
+        logging.logger.info("computed the first occurrences of %s terms in intervals of %s",
+                            "{:,}".format(len(occurrences)), interval)
+
+        # intervals of the start of each time window, of its last step and of its end, and time windows of which the
+        # last step contains each interval
+        window_intervals = list()
+        last_step_windows = defaultdict(list)
+        for window_index, (start_slide_win, end_slide_win) in enumerate(sliding_windows):
+            first_occur_start_interval = (end_slide_win - self.jump_win - history_start_time) // interval
+            end_interval = (end_slide_win - history_start_time) // interval
+            window_intervals.append(((start_slide_win - history_start_time) // interval, end_interval))
+            for interval_index in range(first_occur_start_interval, end_interval):
+                last_step_windows[interval_index].append(window_index)
+
+        # sweep the intervals of each combination: a combination appears suddenly in a time window if the first
+        # interval in which it occurs in the time window is part of the last step of the time window
+        window_first_occur_buckets = defaultdict(list)
+        for combination_occurrences in occurrences.values():
+            sorted_intervals = sorted(combination_occurrences)
+            for position, interval_index in enumerate(sorted_intervals):
+                previous_interval_index = sorted_intervals[position - 1] if position > 0 else -1
+                for window_index in last_step_windows.get(interval_index, list()):
+                    start_interval, end_interval = window_intervals[window_index]
+                    if previous_interval_index >= start_interval:
+                        continue
+
+                    first_occur_bucket = combination_occurrences[interval_index]
+                    if first_occur_bucket["first_occur_time"] <= sliding_windows[window_index][1] - self.jump_win:
+                        continue
+
+                    doc_count = sum(combination_occurrences[i]["doc_count"]
+                                    for i in sorted_intervals[position:] if i < end_interval)
+                    window_first_occur_buckets[window_index].append(dict(first_occur_bucket, doc_count=doc_count))
+
+        for window_index, (start_slide_win, end_slide_win) in enumerate(sliding_windows):
+            first_occur_start_time = end_slide_win - self.jump_win
+            first_occur_buckets = window_first_occur_buckets.get(window_index, list())
+            if first_occur_buckets:
+                es.fetch_first_occur_documents(first_occur_buckets, search_query=self.search_query,
+                                               start_time=first_occur_start_time, end_time=end_slide_win,
+                                               model_settings=self.model_settings)
+
+            for first_occur_bucket in first_occur_buckets:
+                self.num_event_proc += first_occur_bucket["doc_count"]
+                raw_doc = first_occur_bucket["top_doc"]
+                if raw_doc is None:
+                    continue
+
+                fields = es.extract_fields_from_document(raw_doc,
+                                                         extract_derived_fields=self.model_settings[
+                                                             "use_derived_fields"])
+                event_timestamp = dateutil.parser.parse(fields[self.model_settings["timestamp_field"]],
+                                                        ignoretz=True)
+                self._process_first_occurrence(first_occur_bucket, fields, event_timestamp, start_slide_win,
+                                               end_slide_win)
+
+            logging.tick(self.num_event_proc)
+
+    def _get_single_pass_interval(self):
+        """
+        Compute the duration of the intervals used to find sudden appearances in a single pass: the greatest duration,
+        in minutes, dividing the history window, the size and the step of the time windows
+
+        :return: the duration of the intervals, as timedelta
+        """
+        interval_minutes = 0
+        for delta in (self.delta_history_win, self.delta_slide_win, self.jump_win):
+            interval_minutes = math.gcd(interval_minutes, int(delta.total_seconds()) // 60)
+        return dt.timedelta(minutes=max(interval_minutes, 1))
+
+    def _process_first_occurrence(self, first_occur_bucket, fields, event_timestamp, start_slide_win, end_slide_win):
+        """
+        Create and process the outlier of a combination of aggregator and target values appearing suddenly
+
+        :param first_occur_bucket: the combination, with its first document in the time window
+        :param fields: the fields of the first document
+        :param event_timestamp: the timestamp of the first document
+        :param start_slide_win: start time of the time window
+        :param end_slide_win: end time of the time window
+        """
+        # retrieve extra information
+        extra_outlier_information = dict()
+        extra_outlier_information["size_time_window"] = str(self.delta_slide_win)
+        extra_outlier_information["start_time_window"] = str(start_slide_win)
+        extra_outlier_information["end_time_window"] = str(end_slide_win)
+        extra_outlier_information["aggregator"] = self.model_settings["aggregator"]
+        extra_outlier_information["aggregator_value"] = first_occur_bucket["aggregator"]
+        extra_outlier_information["target"] = self.model_settings["target"]
+        extra_outlier_information["target_value"] = first_occur_bucket["target"]
+        extra_outlier_information["num_target_value_in_window"] = first_occur_bucket["doc_count"]
+
+        outlier = self.create_outlier(fields,
+                                      first_occur_bucket["top_doc"],
+                                      extra_outlier_information=extra_outlier_information)
+        self.process_outlier(outlier)
+
+        summary = "In aggregator '%s: %s', the field(s) '%s: %s' appear(s) " \
+                  "suddenly at %s of the time window of size %s." % \
+                  (", ".join(self.model_settings["aggregator"]),
+                   first_occur_bucket["aggregator"],
+                   " ,".join(self.model_settings["target"]),
+                   first_occur_bucket["target"],
+                   str(event_timestamp),
+                   self.delta_slide_win)
+        logging.logger.debug(summary)
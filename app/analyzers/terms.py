@@ -1,3 +1,4 @@
+import copy
 import random
 from configparser import NoOptionError
 
@@ -13,10 +14,18 @@ class TermsAnalyzer(Analyzer):
     def __init__(self, model_name, config_section):
         super(TermsAnalyzer, self).__init__("terms", model_name, config_section)
 
+    # maximum number of aggregator values of which the outlier documents are fetched with a single query
+    PUSHDOWN_FETCH_BATCH_SIZE = 500
+
     def evaluate_model(self):
-        self.total_events, documents = es.count_and_scan_documents(index=self.model_settings["es_index"],
-                                                                   search_query=self.search_query,
-                                                                   model_settings=self.model_settings)
+        if self.model_settings["aggregation_pushdown"]:
+            if self._can_push_down_aggregations():
+                self._evaluate_model_with_aggregations()
+                return
+            logging.logger.warning("aggregation pushdown is not possible for use case %s, as it uses derived fields "
+                                   "- scanning all events instead", self.model_name)
+
+        self.total_events, documents = self.count_and_scan_documents()
 
         self.print_analysis_intro(event_type="evaluating " + self.model_name, total_events=self.total_events)
         logging.init_ticker(total_steps=self.total_events, desc=self.model_name + " - evaluating terms model")
@@ -72,6 +81,217 @@ class TermsAnalyzer(Analyzer):
 
         self.print_analysis_summary()
 
+    def _can_push_down_aggregations(self):
+        """
+        Check if the terms of the use case can be counted by Elasticsearch: derived fields only exist in ee-outliers
+
+        :return: True if the terms can be counted with aggregations
+        """
+        return not self.model_settings["use_derived_fields"]
+
+    def _evaluate_model_with_aggregations(self):
+        """
+        Evaluate the model on the counts of the (aggregator, target) pairs computed by Elasticsearch, and only fetch
+        the documents of the pairs flagged as outlier.
+        Contrary to the evaluation in batches, all events of the history window are evaluated at once, and
+        whitelisted outliers are skipped without evaluating the terms again.
+        """
+        self.total_events = es.count_documents(index=self.model_settings["es_index"],
+                                               search_query=self.get_search_query(),
+                                               model_settings=self.model_settings)
+        self.print_analysis_intro(event_type="evaluating " + self.model_name, total_events=self.total_events)
+
+        if self.total_events > 0:
+            target_counts, field_values = self._get_target_counts_from_aggregations()
+            logging.logger.info("evaluating %s terms counted by Elasticsearch",
+                                "{:,}".format(sum(len(counts) for counts in target_counts.values())))
+
+            outlier_terms = self._find_outlier_terms(target_counts)
+            if outlier_terms:
+                self._process_outlier_terms(outlier_terms, field_values)
+            else:
+                logging.logger.info("no outliers processed")
+
+        self.print_analysis_summary()
+
+    def _get_target_counts_from_aggregations(self):
+        """
+        Count the documents of each (aggregator, target) pair with a composite aggregation
+
+        :return: dictionary with a Counter of the targets of each aggregator value, and dictionary with the raw field
+        values of each aggregator and target value
+        """
+        nr_aggregator_fields = len(self.model_settings["aggregator"])
+        target_counts = defaultdict(Counter)
+        field_values = dict()
+
+        for values, doc_count in es.scan_composite_aggregation(
+                index=self.model_settings["es_index"],
+                fields=self.model_settings["aggregator"] + self.model_settings["target"],
+                search_query=self.get_search_query(), model_settings=self.model_settings):
+            aggregator_value = helpers.utils.flatten_sentence(
+                [helpers.utils.flatten_sentence(value) for value in values[:nr_aggregator_fields]])
+            target_value = helpers.utils.flatten_sentence(
+                [helpers.utils.flatten_sentence(value) for value in values[nr_aggregator_fields:]])
+
+            target_counts[aggregator_value][target_value] += doc_count
+            field_values[("aggregator", aggregator_value)] = values[:nr_aggregator_fields]
+            field_values[("target", target_value)] = values[nr_aggregator_fields:]
+
+        return target_counts, field_values
+
+    def _find_outlier_terms(self, target_counts):
+        """
+        Find the outlier (aggregator, target) pairs
+
+        :param target_counts: dictionary with a Counter of the targets of each aggregator value
+        :return: dictionary with, for each aggregator value, a dictionary with the observations of each outlier target
+        """
+        outlier_terms = defaultdict(dict)
+
+        if self.model_settings["target_count_method"] == "across_aggregators":
+            if not target_counts:
+                return outlier_terms
+
+            unique_target_counts_across_aggregators = [len(counted_targets) for counted_targets in
+                                                       target_counts.values()]
+            decision_frontier = helpers.utils.get_decision_frontier(self.model_settings["trigger_method"],
+                                                                    unique_target_counts_across_aggregators,
+                                                                    self.model_settings["trigger_sensitivity"],
+                                                                    self.model_settings["trigger_on"])
+            logging.logger.debug("using %s decision frontier %s across all aggregators",
+                                 self.model_settings["trigger_method"], decision_frontier)
+
+            for aggregator_value, counted_targets in target_counts.items():
+                if helpers.utils.is_outlier(len(counted_targets), decision_frontier,
+                                            self.model_settings["trigger_on"]):
+                    for target_value in counted_targets:
+                        outlier_terms[aggregator_value][target_value] = self._get_observations(
+                            list(), len(counted_targets), aggregator_value, target_value, decision_frontier)
+            return outlier_terms
+
+        for aggregator_value, counted_targets in target_counts.items():
+            if self.model_settings["min_target_buckets"] is not None and \
+                    len(counted_targets) < self.model_settings["min_target_buckets"]:
+                continue
+
+            decision_frontier = helpers.utils.get_decision_frontier(self.model_settings["trigger_method"],
+                                                                    list(counted_targets.values()),
+                                                                    self.model_settings["trigger_sensitivity"],
+                                                                    self.model_settings["trigger_on"])
+
+            if self.model_settings["trigger_method"] == "coeff_of_variation":
+                if helpers.utils.is_outlier(decision_frontier, self.model_settings["trigger_sensitivity"],
+                                            self.model_settings["trigger_on"]):
+                    outlier_targets = set(counted_targets)
+                else:
+                    outlier_targets = set()
+            else:
+                outlier_targets = {target_value for target_value, term_value_count in counted_targets.items()
+                                   if helpers.utils.is_outlier(term_value_count, decision_frontier,
+                                                               self.model_settings["trigger_on"])}
+
+            non_outlier_values = sorted(set(counted_targets) - outlier_targets)
+            for target_value in outlier_targets:
+                outlier_terms[aggregator_value][target_value] = self._get_observations(
+                    non_outlier_values, counted_targets[target_value], aggregator_value, target_value,
+                    decision_frontier)
+
+        return outlier_terms
+
+    def _process_outlier_terms(self, outlier_terms, field_values):
+        """
+        Fetch the documents of the outlier (aggregator, target) pairs and process their outliers
+
+        :param outlier_terms: dictionary with, for each aggregator value, a dictionary with the observations of each
+        outlier target
+        :param field_values: dictionary with the raw field values of each aggregator and target value
+        """
+        fields = self.model_settings["aggregator"] + self.model_settings["target"]
+        aggregatable_fields = es.get_aggregatable_fields(self.model_settings["es_index"], fields)
+        aggregator_values = list(outlier_terms.keys())
+
+        for i in range(0, len(aggregator_values), self.PUSHDOWN_FETCH_BATCH_SIZE):
+            batch_aggregator_values = aggregator_values[i:i + self.PUSHDOWN_FETCH_BATCH_SIZE]
+            terms_filters = [self._build_terms_filter(aggregator_value, outlier_terms[aggregator_value],
+                                                      field_values, aggregatable_fields)
+                             for aggregator_value in batch_aggregator_values]
+
+            # each batch extends the query of the use case with its own filter
+            search_query = copy.deepcopy(self.get_search_query())
+            search_query["filter"] = search_query.get("filter", list()) + \
+                [{"bool": {"should": terms_filters, "minimum_should_match": 1}}]
+
+            # all fetched documents are outliers, so their complete source is fetched right away
+            total_documents, documents = es.count_and_scan_documents(index=self.model_settings["es_index"],
+                                                                     search_query=search_query,
+                                                                     model_settings=self.model_settings)
+            logging.init_ticker(total_steps=total_documents,
+                                desc=self.model_name + " - processing outliers of terms model")
+
+            for doc in documents:
+                logging.tick()
+                doc["_source_complete"] = True
+                self._process_document_outlier_terms(doc, outlier_terms)
+
+    def _build_terms_filter(self, aggregator_value, outlier_targets, field_values, aggregatable_fields):
+        """
+        Build the filter matching the documents of an aggregator value with one of its outlier targets
+
+        :param aggregator_value: the aggregator value
+        :param outlier_targets: the outlier target values of the aggregator value
+        :param field_values: dictionary with the raw field values of each aggregator and target value
+        :param aggregatable_fields: dictionary with the aggregatable field of each field
+        :return: the filter
+        """
+        filters = [{"term": {aggregatable_fields[field]: value}} for field, value in
+                   zip(self.model_settings["aggregator"], field_values[("aggregator", aggregator_value)])]
+
+        if len(self.model_settings["target"]) == 1:
+            target_field = aggregatable_fields[self.model_settings["target"][0]]
+            filters.append({"terms": {target_field: [field_values[("target", target_value)][0]
+                                                     for target_value in outlier_targets]}})
+        else:
+            target_filters = [{"bool": {"filter": [{"term": {aggregatable_fields[field]: value}} for field, value in
+                                                   zip(self.model_settings["target"],
+                                                       field_values[("target", target_value)])]}}
+                              for target_value in outlier_targets]
+            filters.append({"bool": {"should": target_filters, "minimum_should_match": 1}})
+
+        return {"bool": {"filter": filters}}
+
+    def _process_document_outlier_terms(self, doc, outlier_terms):
+        """
+        Process an outlier for each outlier (aggregator, target) pair of a document
+
+        :param doc: the document
+        :param outlier_terms: dictionary with, for each aggregator value, a dictionary with the observations of each
+        outlier target
+        """
+        target_sentences, aggregator_sentences = self._compute_aggregator_and_target_value(
+            doc, self.model_settings["target"])
+        if target_sentences is None or aggregator_sentences is None:
+            return
+
+        for aggregator_sentence in aggregator_sentences:
+            aggregator_value = helpers.utils.flatten_sentence(aggregator_sentence)
+            if aggregator_value not in outlier_terms:
+                continue
+
+            for target_sentence in target_sentences:
+                target_value = helpers.utils.flatten_sentence(target_sentence)
+                if target_value not in outlier_terms[aggregator_value]:
+                    continue
+
+                fields = es.extract_fields_from_document(
+                    doc, extract_derived_fields=self.model_settings["use_derived_fields"])
+                outlier = self.create_outlier(fields, doc, extra_outlier_information=dict(
+                    outlier_terms[aggregator_value][target_value]))
+                if outlier.is_whitelisted(self.model_whitelist_literals, self.model_whitelist_regexps):
+                    self.nr_whitelisted_elements += 1
+                else:
+                    self.process_outlier(outlier)
+
     @staticmethod
     def _add_document_to_batch(current_batch, target_sentences, aggregator_sentences, doc):
         """
@@ -298,6 +518,7 @@ class TermsAnalyzer(Analyzer):
         list_documents_need_to_be_removed = list()
         non_outlier_values = set()
 
+        self.complete_documents(batch[aggregator_value]["raw_docs"])
         for ii, term_value in enumerate(batch[aggregator_value]["targets"]):
             outlier = self._create_outlier(non_outlier_values, unique_target_count_across_aggregators,
                                            aggregator_value, term_value, decision_frontier, batch, ii)
@@ -384,6 +605,7 @@ class TermsAnalyzer(Analyzer):
             is_outlier = helpers.utils.is_outlier(decision_frontier, self.model_settings["trigger_sensitivity"],
                                                   self.model_settings["trigger_on"])
             if is_outlier:
+                self.complete_documents(batch[aggregator_value]["raw_docs"])
                 for ii, term_value in enumerate(batch[aggregator_value]["targets"]):
                     term_value_count = counted_targets[term_value]
                     outlier = self._create_outlier(non_outlier_values, term_value_count, aggregator_value,
@@ -395,6 +617,10 @@ class TermsAnalyzer(Analyzer):
                         list_documents_need_to_be_removed.append(ii)
 
         else:
+            self.complete_documents([raw_doc for raw_doc, term_value in zip(batch[aggregator_value]["raw_docs"],
+                                                                            batch[aggregator_value]["targets"])
+                                     if helpers.utils.is_outlier(counted_targets[term_value], decision_frontier,
+                                                                 self.model_settings["trigger_on"])])
             for ii, term_value in enumerate(batch[aggregator_value]["targets"]):
                 term_value_count = counted_targets[term_value]
                 is_outlier = helpers.utils.is_outlier(term_value_count, decision_frontier,
@@ -429,6 +655,29 @@ class TermsAnalyzer(Analyzer):
         :return: the created outlier
         """
 
+        observations = self._get_observations(non_outlier_values, term_value_count, aggregator_value, term_value,
+                                              decision_frontier)
+
+        calculated_observations = batch[observations["aggregator"]]["observations"][ii]
+        calculated_observations.update(observations)
+
+        raw_doc = batch[observations["aggregator"]]["raw_docs"][ii]
+        fields = es.extract_fields_from_document(raw_doc,
+                                                 extract_derived_fields=self.model_settings["use_derived_fields"])
+        return self.create_outlier(fields, raw_doc, extra_outlier_information=calculated_observations)
+
+    def _get_observations(self, non_outlier_values, term_value_count, aggregator_value, term_value,
+                          decision_frontier):
+        """
+        Get the observations of an outlier
+
+        :param non_outlier_values: list of values that aren't outliers
+        :param term_value_count: number of term
+        :param aggregator_value: aggregator value
+        :param term_value: term value
+        :param decision_frontier: value of the decision frontier
+        :return: dictionary with the observations
+        """
         observations = dict()
         if non_outlier_values:
             non_outlier_values_sample = ",".join(random.sample(
@@ -442,14 +691,7 @@ class TermsAnalyzer(Analyzer):
         observations["term"] = term_value
         observations["decision_frontier"] = decision_frontier
         observations["trigger_method"] = str(self.model_settings["trigger_method"])
-
-        calculated_observations = batch[observations["aggregator"]]["observations"][ii]
-        calculated_observations.update(observations)
-
-        raw_doc = batch[observations["aggregator"]]["raw_docs"][ii]
-        fields = es.extract_fields_from_document(raw_doc,
-                                                 extract_derived_fields=self.model_settings["use_derived_fields"])
-        return self.create_outlier(fields, raw_doc, extra_outlier_information=calculated_observations)
+        return observations
 
     def _extract_additional_model_settings(self):
         """
@@ -473,6 +715,9 @@ class TermsAnalyzer(Analyzer):
 
         self.model_settings["min_target_buckets"] = self.config_section.getint("min_target_buckets", None)
 
+        self.model_settings["aggregation_pushdown"] = self.extract_parameter("aggregation_pushdown", "boolean",
+                                                                             default=False)
+
         if self.model_settings["min_target_buckets"]:
             if self.model_settings["target_count_method"] != "within_aggregator":
                 logging.logger.warning("'min_target_buckets' is only useful when 'target_count_method' is set "
@@ -138,9 +138,7 @@ class Word2VecAnalyzer(Analyzer):
 
         target_fields = self.model_settings["target"]
         aggr_fields = self.model_settings["aggregator"]
-        self.total_events, documents = es.count_and_scan_documents(index=self.model_settings["es_index"],
-                                                                   search_query=self.search_query,
-                                                                   model_settings=self.model_settings)
+        self.total_events, documents = self.count_and_scan_documents()
         self.print_analysis_intro(event_type="evaluating " + self.model_name, total_events=self.total_events)
         logging.init_ticker(total_steps=self.total_events, desc=self.model_name + " - evaluating word2vec model")
         if documents:
@@ -355,6 +353,7 @@ class Word2VecAnalyzer(Analyzer):
                                 "FP": 0,
                                 "FN": 0}
         outliers = list()
+        outlier_documents = list()
 
         # Find all type of metrics concerning the text and the words
         word_scores_info, text_scores_info, compo_scores_info = self._find_all_scores(model_eval_outputs)
@@ -406,11 +405,14 @@ class Word2VecAnalyzer(Analyzer):
                     text_analyzer.print_most_expected_window_words()
 
                 observations = text_analyzer.get_observations()
-
-                outlier = self.create_outlier(fields,
-                                              raw_doc,
-                                              extra_outlier_information=observations)
-                outliers.append(outlier)
+                outlier_documents.append((fields, raw_doc, observations))
+
+        self.complete_documents([raw_doc for _, raw_doc, _ in outlier_documents])
+        for fields, raw_doc, observations in outlier_documents:
+            outlier = self.create_outlier(fields,
+                                          raw_doc,
+                                          extra_outlier_information=observations)
+            outliers.append(outlier)
 
         self._print_confusion_matrix_and_metrics(confusion_matrix_val, self.model_settings["print_confusion_matrix"])
 
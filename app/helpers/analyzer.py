@@ -1,4 +1,5 @@
 import abc
+import re
 from dateutil import parser
 
 from configparser import NoOptionError
@@ -35,10 +36,16 @@ class Analyzer(abc.ABC):
         self.unknown_error_analysis = False
 
         self.nr_whitelisted_elements = 0
+        # outliers that were not written because they were already saved before
+        self.nr_unchanged_outliers = 0
 
         self.model_whitelist_literals = list()
         self.model_whitelist_regexps = list()
 
+        # when the documents of this use case are scanned together with other use cases, they are delivered through
+        # this feed instead of being scanned separately
+        self.shared_scan_feed = None
+
         # extract all settings for this use case
         self.configuration_parsing_error = False
 
@@ -98,6 +105,24 @@ class Analyzer(abc.ABC):
         except NoOptionError:
             model_settings["should_notify"] = False
 
+        model_settings["es_scan_slices"] = self.extract_parameter("es_scan_slices", param_type="int",
+                                                                  section_name="general", default=1)
+
+        model_settings["es_scan_time_partitions"] = self.extract_parameter("es_scan_time_partitions", param_type="int",
+                                                                           section_name="general", default=1)
+
+        model_settings["es_use_point_in_time"] = self.extract_parameter("es_use_point_in_time", param_type="boolean",
+                                                                        section_name="general", default=False)
+
+        model_settings["es_source_projection"] = self.extract_parameter("es_source_projection", param_type="boolean",
+                                                                        section_name="general", default=False)
+
+        model_settings["es_docvalue_fields"] = self.extract_parameter("es_docvalue_fields", param_type="boolean",
+                                                                      section_name="general", default=False)
+
+        model_settings["es_shared_scan"] = self.extract_parameter("es_shared_scan", param_type="boolean",
+                                                                  section_name="general", default=False)
+
         model_settings["use_derived_fields"] = self.config_section.getboolean("use_derived_fields", fallback=False)
 
         model_settings["es_index"] = self.config_section.get("es_index")
@@ -151,6 +176,8 @@ class Analyzer(abc.ABC):
                       "{:,}".format(unique_summaries) + " unique summaries]"
             if self.nr_whitelisted_elements > 0:
                 message += " - ignored " + "{:,}".format(self.nr_whitelisted_elements) + " whitelisted outliers"
+            if self.nr_unchanged_outliers > 0:
+                message += " - skipped " + "{:,}".format(self.nr_unchanged_outliers) + " unchanged outliers"
             logging.logger.info(message)
         else:
             logging.logger.info("no outliers detected for use case")
@@ -199,6 +226,11 @@ class Analyzer(abc.ABC):
         if extra_outlier_information is None:
             extra_outlier_information = dict()
 
+        # the document was scanned with only the fields needed by the analyzer, fetch it completely before it gets
+        # checked against the whitelist and written back
+        if self.get_source_includes() is not None:
+            doc = es.complete_document_source(doc, extract_derived_fields=self.model_settings["use_derived_fields"])
+
         outlier_type, outlier_reason, outlier_summary, outlier_assets = \
             self._prepare_outlier_parameters(extra_outlier_information, fields)
         outlier = Outlier(outlier_type=outlier_type, outlier_reason=outlier_reason, outlier_summary=outlier_summary,
@@ -217,6 +249,81 @@ class Analyzer(abc.ABC):
 
         return outlier
 
+    def complete_documents(self, docs):
+        """
+        Fetch at once the complete source of the documents that were scanned with only the fields needed by the
+        analyzer, before outliers are created for them
+
+        :param docs: documents that will be linked to outliers
+        """
+        if self.get_source_includes() is not None:
+            es.complete_documents_source(docs, extract_derived_fields=self.model_settings["use_derived_fields"])
+
+    @property
+    def config_section_name(self):
+        """
+        Name of the configuration section of the use case, which is unique across all use cases
+        """
+        return self.model_type + "_" + self.model_name
+
+    def get_search_query(self):
+        """
+        Get the query used to select the documents analyzed by the use case.
+        This method can be overridden by children that need to extend the query of the use case.
+
+        :return: the search query
+        """
+        return self.search_query
+
+    def count_and_scan_documents(self):
+        """
+        Count and fetch the documents analyzed by the use case, either by scanning Elasticsearch or from the shared
+        scan feed when the use case is part of a shared scan
+
+        :return: the number of documents and a generator/list of all documents
+        """
+        if self.shared_scan_feed is not None:
+            return self.shared_scan_feed.count_and_get_documents()
+
+        return es.count_and_scan_documents(index=self.model_settings["es_index"],
+                                           search_query=self.get_search_query(),
+                                           query_fields=self.get_source_includes(),
+                                           model_settings=self.model_settings)
+
+    def get_source_includes(self):
+        """
+        Compute the list of document fields needed by the analyzer, so that only these fields are requested when
+        scanning documents: the target and aggregator fields, the placeholders of the outlier summary, type and
+        reason, the asset fields, the fields used to extract derived fields and the timestamp field. Scanning documents
+        from doc values also only requests these fields.
+
+        :return: list of fields to include in the scanned documents, or None if the complete documents must be scanned
+        """
+        if not self.model_settings["es_source_projection"] and not self.model_settings["es_docvalue_fields"]:
+            return None
+
+        source_includes = [self.model_settings["timestamp_field"]]
+
+        for setting_name in ("target", "aggregator"):
+            setting_value = self.model_settings.get(setting_name)
+            if isinstance(setting_value, list):
+                source_includes.extend(setting_value)
+            elif setting_value:
+                source_includes.append(setting_value)
+
+        placeholder_regex = re.compile(r'\{([^\}]*)\}')
+        for setting_name in ("outlier_summary", "outlier_type", "outlier_reason"):
+            if self.model_settings[setting_name]:
+                source_includes.extend(placeholder_regex.findall(self.model_settings[setting_name]))
+
+        source_includes.extend(asset_field_name for asset_field_name, _ in settings.list_assets)
+
+        if self.model_settings["use_derived_fields"]:
+            source_includes.extend(derived_field_name for derived_field_name, _ in settings.list_derived_fields)
+
+        # remove duplicates but keep the order, to always build the same query
+        return list(dict.fromkeys(source_includes))
+
     def process_outlier(self, outlier):
         """
         Save outlier (in statistic and) in ES database if not whitelisted (and if settings is configured to save in ES)
@@ -230,9 +337,11 @@ class Analyzer(abc.ABC):
             if settings.print_outliers_to_console:
                 logging.logger.debug("%s [whitelisted outlier]", outlier.outlier_dict["summary"])
         else:
-            es.process_outlier(outlier=outlier,
-                               should_notify=self.model_settings["should_notify"],
-                               extract_derived_fields=self.model_settings["use_derived_fields"])
+            outlier_unchanged = es.process_outlier(outlier=outlier,
+                                                   should_notify=self.model_settings["should_notify"],
+                                                   extract_derived_fields=self.model_settings["use_derived_fields"])
+            if outlier_unchanged:
+                self.nr_unchanged_outliers += 1
 
     def print_analysis_intro(self, event_type, total_events):
         """
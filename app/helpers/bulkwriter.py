@@ -0,0 +1,93 @@
+import queue
+import threading
+
+
+class BulkRequest:
+    """
+    Batch of bulk actions waiting to be sent to Elasticsearch by a writer thread
+    """
+
+    def __init__(self, actions, refresh=False):
+        self.actions = actions
+        self.refresh = refresh
+        self.error = None
+        self.done = threading.Event()
+
+
+class BulkWriter:
+    """
+    Send batches of bulk actions to Elasticsearch from background writer threads, so that scanning and evaluating
+    documents overlaps with writing the results.
+
+    The batches are put on a bounded queue: producers block once the writer threads can't keep up. Each producer
+    thread keeps track of its own pending batches, so that it can wait for them to be written (for example at the
+    end of a use case) without waiting for the batches of other producers.
+    """
+
+    def __init__(self, send_bulk_actions, writer_threads=1, max_queue_size=4):
+        """
+        :param send_bulk_actions: function sending a list of bulk actions to Elasticsearch, taking a refresh parameter
+        :param writer_threads: number of threads sending bulk requests in parallel
+        :param max_queue_size: maximum number of batches waiting to be sent
+        """
+        self.send_bulk_actions = send_bulk_actions
+        self.bulk_requests_queue = queue.Queue(maxsize=max_queue_size)
+        self.producer_state = threading.local()
+
+        self.writer_threads = list()
+        for _ in range(writer_threads):
+            writer_thread = threading.Thread(target=self._write_bulk_requests, daemon=True)
+            writer_thread.start()
+            self.writer_threads.append(writer_thread)
+
+    def submit(self, actions, refresh=False):
+        """
+        Queue a batch of bulk actions, waiting for room in the queue if the writer threads can't keep up
+
+        :param actions: list of bulk actions
+        :param refresh: refresh or not in Elasticsearch
+        """
+        bulk_request = BulkRequest(actions, refresh=refresh)
+        self._get_pending_requests().append(bulk_request)
+        self.bulk_requests_queue.put(bulk_request)
+
+    def wait_for_pending_requests(self):
+        """
+        Wait until all the batches submitted by the current thread have been sent to Elasticsearch.
+        The first error raised while sending one of these batches is raised again.
+        """
+        pending_requests = self._get_pending_requests()
+        error = None
+        while pending_requests:
+            bulk_request = pending_requests.pop(0)
+            bulk_request.done.wait()
+            if error is None:
+                error = bulk_request.error
+
+        if error is not None:
+            raise error
+
+    def _get_pending_requests(self):
+        """
+        Get the batches submitted by the current thread that have not been waited for yet
+
+        :return: list of bulk requests
+        """
+        if not hasattr(self.producer_state, "pending_requests"):
+            self.producer_state.pending_requests = list()
+        return self.producer_state.pending_requests
+
+    def _write_bulk_requests(self):
+        """
+        Send the queued batches to Elasticsearch, until the end of the process
+        """
+        while True:
+            bulk_request = self.bulk_requests_queue.get()
+            try:
+                self.send_bulk_actions(bulk_request.actions, refresh=bulk_request.refresh)
+            except Exception as e:  # pylint: disable=broad-except
+                # the error is raised in the thread that submitted the batch, once it waits for it
+                bulk_request.error = e
+            finally:
+                bulk_request.done.set()
+                self.bulk_requests_queue.task_done()
@@ -1,15 +1,22 @@
 import json
 import datetime as dt
+import hashlib
 import math
 import copy
 import os
+import queue
+import threading
+import time
+import random
+import re
 
-from collections import defaultdict
+from collections import defaultdict, deque
 from itertools import chain
 
+import dateutil.parser
 from pygrok import Grok
 from elasticsearch import helpers as eshelpers, Elasticsearch
-from elasticsearch.exceptions import AuthenticationException, ConnectionError, RequestError
+from elasticsearch.exceptions import AuthenticationException, ConnectionError, RequestError, TransportError
 
 from configparser import NoOptionError
 
@@ -19,9 +26,147 @@ import helpers.logging
 from helpers.singleton import singleton
 from helpers.notifier import Notifier
 from helpers.outlier import Outlier
+from helpers.bulkwriter import BulkWriter
+from helpers.serializer import FastJSONSerializer, is_fast_json_available
 
 DEFAULT_TIMESTAMP_FIELD = "@timestamp"
 
+# marker put on the queue by a scan worker once it has no more documents to deliver
+END_OF_SCAN = object()
+
+# key marking the documents of which a shared scan gave a copy to several use cases
+SHARED_DOCUMENT_KEY = "_shared_between_use_cases"
+
+OUTLIERS_WRITE_MODES = ("full", "partial", "append")
+DEFAULT_OUTLIERS_INDEX = "outliers-eagleeye"
+# index template mapping the fields of the outlier records used to find the outliers of a use case
+OUTLIERS_INDEX_TEMPLATE_NAME = "ee-outliers-records"
+
+ADD_OUTLIERS_SCRIPT_ID = "ee-outliers-add-outliers"
+# merges the outliers of the list "outliers" into the event, params.tag is the tag added to the event
+_MERGE_OUTLIERS_SCRIPT = """
+boolean changed = false;
+if (ctx._source.tags == null) {
+    ctx._source.tags = new ArrayList();
+} else if (!(ctx._source.tags instanceof List)) {
+    ctx._source.tags = [ctx._source.tags];
+}
+if (!ctx._source.tags.contains(params.tag)) {
+    ctx._source.tags.add(params.tag);
+    changed = true;
+}
+for (outlier in outliers) {
+    if (ctx._source.outliers == null) {
+        Map outliers = new HashMap();
+        for (entry in outlier.entrySet()) {
+            outliers.put(entry.getKey(), new ArrayList(entry.getValue()));
+        }
+        outliers.total_outliers = 1;
+        ctx._source.outliers = outliers;
+        changed = true;
+    } else if (!ctx._source.outliers.summary.contains(outlier.summary[0])) {
+        for (entry in outlier.entrySet()) {
+            def values = ctx._source.outliers[entry.getKey()];
+            if (values == null) {
+                values = new ArrayList();
+            } else if (!(values instanceof List)) {
+                values = [values];
+            }
+            values.addAll(entry.getValue());
+            ctx._source.outliers[entry.getKey()] = values;
+        }
+        ctx._source.outliers.total_outliers += 1;
+        changed = true;
+    }
+}
+if (!changed) {
+    ctx.op = "noop";
+}
+"""
+# stored script adding outliers to an event in Elasticsearch, the equivalent of add_outlier_dict_to_document
+ADD_OUTLIERS_SCRIPT = "List outliers = params.outliers;" + _MERGE_OUTLIERS_SCRIPT
+
+# script adding the same outlier to all events matching an update by query, the assets of the outlier being extracted
+# from each event like helpers.utils.extract_outlier_asset_information does
+ADD_OUTLIER_BY_QUERY_SCRIPT = """
+String toSentence(def value) {
+    if (value instanceof Boolean) {
+        return value ? "True" : "False";
+    }
+    return value.toString();
+}
+String flattenSentence(def value) {
+    if (value == null || value instanceof Map) {
+        return null;
+    }
+    if (value instanceof List) {
+        List items = new ArrayList();
+        for (item in value) {
+            if (item instanceof List || item instanceof Map) {
+                return null;
+            }
+            items.add(item == null ? "None" : toSentence(item));
+        }
+        return String.join(" - ", items);
+    }
+    return toSentence(value);
+}
+Map newOutlier = new HashMap();
+for (entry in params.outlier.entrySet()) {
+    newOutlier.put(entry.getKey(), new ArrayList(entry.getValue()));
+}
+List assets = new ArrayList();
+for (asset in params.assets) {
+    def value = ctx._source;
+    for (key in asset.path) {
+        def matched = null;
+        if (value instanceof Map) {
+            for (entry in value.entrySet()) {
+                if (entry.getKey().toLowerCase() == key) {
+                    matched = entry.getValue();
+                    break;
+                }
+            }
+        }
+        value = matched;
+        if (value == null) {
+            break;
+        }
+    }
+    List values = value instanceof List ? value : [value];
+    for (item in values) {
+        String sentence = flattenSentence(item);
+        if (sentence != null && !sentence.isEmpty()) {
+            assets.add(asset.type + ": " + sentence);
+        }
+    }
+}
+if (!assets.isEmpty()) {
+    newOutlier.assets = assets;
+}
+List outliers = [newOutlier];
+""" + _MERGE_OUTLIERS_SCRIPT
+
+
+def _bulk_actions_property(name, default_factory):
+    """
+    Create a property of which the value is stored per thread, so that each thread producing bulk actions (analyzers,
+    housekeeping) fills and flushes its own batch
+
+    :param name: name of the attribute
+    :param default_factory: function returning the initial value of the attribute in a thread
+    :return: the property
+    """
+    def getter(self):
+        if not hasattr(self.bulk_actions_state, name):
+            setattr(self.bulk_actions_state, name, default_factory())
+        return getattr(self.bulk_actions_state, name)
+
+    def setter(self, value):
+        setattr(self.bulk_actions_state, name, value)
+
+    return property(getter, setter)
+
 
 @singleton
 class ES:
@@ -42,9 +187,74 @@ class ES:
 
     notifier = None
 
-    bulk_actions = []
+    bulk_actions_state = threading.local()
+    bulk_actions = _bulk_actions_property("bulk_actions", list)
+    # approximate size in bytes of the bulk actions of the thread
+    bulk_actions_bytes = _bulk_actions_property("bulk_actions_bytes", int)
+    # serialized size of the last bulk action of the thread that was measured
+    bulk_action_bytes_estimate = _bulk_actions_property("bulk_action_bytes_estimate", int)
+
+    bulk_writer = None
+    bulk_writer_lock = threading.Lock()
 
     BULK_FLUSH_SIZE = 1000
+    # bounds of the number of bulk actions per request, when it is adapted to the observed bulk latency
+    BULK_MIN_FLUSH_SIZE = 100
+    BULK_MAX_FLUSH_SIZE = 10000
+    # only one bulk action out of this number is serialized to estimate the size of the bulk actions
+    BULK_ACTION_BYTES_SAMPLE_INTERVAL = 100
+    # number of outlier records for which the events are fetched at once, in append write mode
+    OUTLIER_RECORDS_MGET_SIZE = 1000
+    # number of first occurrence documents fetched with a single multi search request
+    FIRST_OCCUR_DOCUMENTS_MSEARCH_SIZE = 500
+    # number of times bulk actions rejected by Elasticsearch (429) are retried before they are dropped
+    BULK_MAX_RETRIES = 8
+
+    bulk_flush_size = None
+    bulk_flush_size_lock = threading.Lock()
+
+    outliers_script_stored = False
+    outliers_script_lock = threading.Lock()
+
+    outliers_index_template_stored = False
+    outliers_index_template_lock = threading.Lock()
+
+    # (index, id, summary) of the outliers written during the current run
+    saved_outliers = set()
+    saved_outliers_lock = threading.Lock()
+
+    # outliers waiting to be written, by (index, id) of their document, when outlier updates are coalesced
+    pending_outlier_updates = dict()
+    pending_outlier_updates_lock = threading.Lock()
+
+    # time up to which the events are processed during the current run, shared by the time filters of all use cases so
+    # that identical requests can be answered from the request cache of Elasticsearch
+    run_end_time = None
+    # request cache statistics of the indices when the current run started
+    request_cache_stats = None
+
+    # time range of the events of each index matched by an index pattern, resolved once per run, by (index pattern,
+    # timestamp field)
+    index_time_ranges = dict()
+    index_time_ranges_lock = threading.Lock()
+    # number of indices of which the time range is probed with a single multi search request
+    INDEX_PROBES_MSEARCH_SIZE = 100
+    # longest comma separated list of indices sent instead of an index pattern, to stay within the URL length limit
+    MAX_PRUNED_INDICES_LENGTH = 3000
+
+    # time in seconds between two checks of the progress of a task running in Elasticsearch
+    TASK_POLL_INTERVAL = 5
+
+    # number of documents of which the complete source is fetched with a single multi get request
+    COMPLETE_DOCUMENTS_MGET_SIZE = 1000
+
+    # whether the cluster supports scanning with a point in time, checked once
+    point_in_time_supported = None
+    POINT_IN_TIME_MIN_VERSION = (7, 12)
+
+    # number of times a failing page request is retried before giving up on a point in time scan
+    SCAN_MAX_RETRIES = 5
+    SCAN_RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
 
     def __init__(self, settings=None, logging=None):
         self.settings = settings
@@ -72,7 +282,14 @@ class ES:
                                   timeout=self.settings.config.getint("general", "es_timeout"),
                                   verify_certs=verify_certs,
                                   ca_certs=ca_certs,
-                                  retry_on_timeout=True)
+                                  retry_on_timeout=True,
+                                  serializer=FastJSONSerializer(),
+                                  http_compress=self.settings.config.getboolean("general", "es_http_compress",
+                                                                                fallback=False),
+                                  maxsize=self.settings.config.getint("general", "es_connection_pool_size",
+                                                                      fallback=10))
+        if not is_fast_json_available():
+            self.logging.logger.debug("orjson is not installed, using the json module to serialize requests")
 
         try:
             self.conn.info()
@@ -107,6 +324,97 @@ class ES:
             history_window_hours = model_settings["history_window_hours"]
         return timestamp_field, history_window_days, history_window_hours
 
+    def prune_indices(self, index, search_range):
+        """
+        Restrict an index pattern to the indices that can contain events within the time range of a search, when
+        index pruning is enabled. The time range of the events of each index is derived from the date at the end of
+        its name if es_index_date_format is set, or probed with min and max aggregations on the timestamp field
+        otherwise.
+
+        :param index: the index pattern
+        :param search_range: the range of the search, built by get_time_filter
+        :return: comma separated list of indices, or the index pattern if it can't be pruned
+        """
+        if not search_range or "*" not in index or \
+                not self.settings.config.getboolean("general", "es_index_pruning", fallback=False):
+            return index
+
+        timestamp_field, time_range = next(iter(search_range["range"].items()))
+        start_time = dateutil.parser.parse(time_range["gte"], ignoretz=True)
+        end_time = dateutil.parser.parse(time_range["lte"], ignoretz=True)
+
+        indices = [index_name for index_name, (index_start_time, index_end_time)
+                   in self._get_index_time_ranges(index, timestamp_field).items()
+                   if index_start_time is None or (index_start_time <= end_time and index_end_time >= start_time)]
+
+        pruned_indices = ",".join(sorted(indices))
+        # without any index left, the index pattern is kept so that requests still behave as if nothing was pruned
+        if not pruned_indices or len(pruned_indices) > self.MAX_PRUNED_INDICES_LENGTH:
+            return index
+        return pruned_indices
+
+    def _get_index_time_ranges(self, index, timestamp_field):
+        """
+        Get the time range of the events of each index matched by an index pattern, once per run
+
+        :param index: the index pattern
+        :param timestamp_field: the name of the timestamp field
+        :return: dictionary with the name of each index and a tuple with the time of its first and last event, or
+        (None, None) if the time range of the index is unknown
+        """
+        with self.index_time_ranges_lock:
+            if (index, timestamp_field) not in self.index_time_ranges:
+                index_names = sorted(self.conn.indices.get_alias(index=index, expand_wildcards="open"))
+
+                index_date_format = self.settings.config.get("general", "es_index_date_format", fallback="")
+                if index_date_format:
+                    index_time_ranges = {index_name: get_index_time_range_from_name(index_name, index_date_format)
+                                         for index_name in index_names}
+                else:
+                    index_time_ranges = self._probe_index_time_ranges(index_names, timestamp_field)
+
+                self.logging.logger.debug("resolved time range of %d indices matching %s", len(index_time_ranges),
+                                          index)
+                self.index_time_ranges[(index, timestamp_field)] = index_time_ranges
+            return self.index_time_ranges[(index, timestamp_field)]
+
+    def _probe_index_time_ranges(self, index_names, timestamp_field):
+        """
+        Get the time of the first and last event of indices, with min and max aggregations
+
+        :param index_names: list of index names
+        :param timestamp_field: the name of the timestamp field
+        :return: dictionary with the name of each index and a tuple with the time of its first and last event
+        """
+        index_time_ranges = dict()
+        request_timeout = self.settings.config.getint("general", "es_timeout", fallback=300)
+        probe_query = {"size": 0,
+                       "aggs": {"first_event": {"min": {"field": timestamp_field}},
+                                "last_event": {"max": {"field": timestamp_field}}}}
+
+        for i in range(0, len(index_names), self.INDEX_PROBES_MSEARCH_SIZE):
+            batch_index_names = index_names[i:i + self.INDEX_PROBES_MSEARCH_SIZE]
+            searches = list()
+            for index_name in batch_index_names:
+                searches.extend([{"index": index_name}, probe_query])
+
+            results = self.conn.msearch(body=searches, request_timeout=request_timeout)
+            for index_name, response in zip(batch_index_names, results["responses"]):
+                if "error" in response:
+                    # keep the index, as its events can't be excluded
+                    index_time_ranges[index_name] = (None, None)
+                    continue
+
+                first_event = response["aggregations"]["first_event"]["value"]
+                last_event = response["aggregations"]["last_event"]["value"]
+                if first_event is None or last_event is None:
+                    # no event has a timestamp, so the index never matches a time range
+                    index_time_ranges[index_name] = (dt.datetime.max, dt.datetime.min)
+                else:
+                    index_time_ranges[index_name] = (dt.datetime.utcfromtimestamp(first_event / 1000),
+                                                     dt.datetime.utcfromtimestamp(last_event / 1000))
+        return index_time_ranges
+
     def _scan(self, index, search_range, bool_clause=None, sort_clause=None, query_fields=None, search_query=None,
               model_settings=None):
         """
@@ -122,6 +430,7 @@ class ES:
         :return: generator to fetch documents
         """
         preserve_order = False
+        index = self.prune_indices(index, search_range)
 
         highlight_settings = self._get_highlight_settings(model_settings)
 
@@ -129,16 +438,261 @@ class ES:
             sort_clause = {"sort": [{model_settings["timestamp_field"]: "asc"}]}
             preserve_order = True
 
-        return eshelpers.scan(self.conn, request_timeout=self.settings.config.getint("general", "es_timeout"),
-                              index=index, query=build_search_query(bool_clause=bool_clause,
-                                                                    sort_clause=sort_clause,
-                                                                    search_range=search_range,
-                                                                    query_fields=query_fields,
-                                                                    search_query=search_query,
-                                                                    highlight_settings=highlight_settings),
-                              size=self.settings.config.getint("general", "es_scan_size"),
-                              scroll=self.settings.config.get("general", "es_scroll_time"),
-                              preserve_order=preserve_order, raise_on_error=False)
+        query = build_search_query(bool_clause=bool_clause,
+                                   sort_clause=sort_clause,
+                                   search_range=search_range,
+                                   query_fields=query_fields,
+                                   search_query=search_query,
+                                   highlight_settings=highlight_settings)
+
+        docvalue_fields = None
+        if query_fields and model_settings is not None and model_settings.get("es_docvalue_fields"):
+            docvalue_fields = self.get_docvalue_fields(index, query_fields)
+            if docvalue_fields:
+                query["docvalue_fields"] = docvalue_fields
+                query["_source"] = [field for field in query_fields if field not in docvalue_fields] or False
+
+        time_partitions = model_settings.get("es_scan_time_partitions", 1) if model_settings is not None else 1
+        if preserve_order and search_range and time_partitions > 1:
+            documents = self._time_partitioned_scan(index, query, search_range, model_settings, time_partitions)
+        else:
+            documents = self._scan_query(index, query, model_settings, preserve_order)
+        if docvalue_fields:
+            return merge_docvalue_fields_into_source(documents)
+        return documents
+
+    def _scan_query(self, index, query, model_settings, preserve_order):
+        """
+        Scan the documents matching a query, using a point in time, scroll slices or a single scroll depending on the
+        configuration of the model
+
+        :param index: on which index the request must be done
+        :param query: the query used to scan the documents
+        :param model_settings: part of the configuration linked to the model
+        :param preserve_order: True if the documents must be returned in the sort order of the query
+        :return: generator to fetch documents
+        """
+        scan_slices = self._get_scan_slices(model_settings)
+
+        # slices are read concurrently, so the order in which documents are returned can't be guaranteed
+        if scan_slices > 1 and not preserve_order:
+            return self._sliced_scan(index, query, scan_slices)
+
+        if preserve_order and model_settings.get("es_use_point_in_time") and self.supports_point_in_time():
+            documents = self._point_in_time_scan(index, query)
+        else:
+            documents = eshelpers.scan(self.conn, request_timeout=self.settings.config.getint("general", "es_timeout"),
+                                       index=index, query=query,
+                                       size=self.settings.config.getint("general", "es_scan_size"),
+                                       scroll=self.settings.config.get("general", "es_scroll_time"),
+                                       preserve_order=preserve_order, raise_on_error=False)
+
+        # read the next pages while the documents of the current page are processed
+        prefetch_pages = self.settings.config.getint("general", "es_scan_prefetch_pages", fallback=0)
+        if prefetch_pages > 0:
+            return prefetch_generator(documents,
+                                      page_size=self.settings.config.getint("general", "es_scan_size"),
+                                      max_pages=prefetch_pages,
+                                      max_bytes=self.settings.config.getint("general", "es_scan_prefetch_max_bytes",
+                                                                            fallback=0))
+        return documents
+
+    def _time_partitioned_scan(self, index, query, search_range, model_settings, time_partitions):
+        """
+        Scan documents in chronological order, by splitting the time range of the search in contiguous partitions
+        that are scanned concurrently, each one with its own sorted scan. The documents of each partition are
+        returned once all documents of the previous partitions were returned.
+
+        :param index: on which index the request must be done
+        :param query: the query used to scan the documents, which must contain the search range and a sort clause
+        :param search_range: the range of the search
+        :param model_settings: part of the configuration linked to the model
+        :param time_partitions: number of partitions of the time range
+        :return: generator to fetch documents
+        """
+        partition_generators = list()
+        for partition_range in split_time_filter(search_range, time_partitions):
+            partition_query = copy.deepcopy(query)
+            filters = partition_query["query"]["bool"]["filter"]
+            filters[filters.index(search_range)] = partition_range
+            partition_generators.append(self._scan_query(index, partition_query, model_settings,
+                                                         preserve_order=True))
+
+        return chain_generators_concurrently(partition_generators,
+                                             max_queue_size=self.settings.config.getint("general", "es_scan_size"))
+
+    def _get_scan_slices(self, model_settings=None):
+        """
+        Get the number of scroll slices that should be used to scan documents
+
+        :param model_settings: part of the configuration linked to the model
+        :return: number of slices, 1 if the documents should be scanned with a single scroll
+        """
+        if model_settings is not None and model_settings.get("es_scan_slices"):
+            return model_settings["es_scan_slices"]
+        return self.settings.config.getint("general", "es_scan_slices", fallback=1)
+
+    def _sliced_scan(self, index, query, scan_slices):
+        """
+        Scan documents using multiple scroll slices that are read concurrently, each one in its own thread.
+        The documents of all slices are merged into a single generator.
+
+        :param index: on which index the request must be done
+        :param query: the query used to scan the documents
+        :param scan_slices: the number of slices
+        :return: generator to fetch documents
+        """
+        scan_size = self.settings.config.getint("general", "es_scan_size")
+        slice_generators = list()
+
+        for slice_id in range(scan_slices):
+            slice_query = copy.deepcopy(query)
+            slice_query["slice"] = {"id": slice_id, "max": scan_slices}
+            slice_generators.append(eshelpers.scan(self.conn,
+                                                   request_timeout=self.settings.config.getint("general",
+                                                                                               "es_timeout"),
+                                                   index=index, query=slice_query, size=scan_size,
+                                                   scroll=self.settings.config.get("general", "es_scroll_time"),
+                                                   raise_on_error=False))
+
+        return merge_generators_concurrently(slice_generators, max_queue_size=scan_size * scan_slices)
+
+    def supports_point_in_time(self):
+        """
+        Check if the cluster supports scanning with a point in time and the _shard_doc tiebreaker, which requires
+        Elasticsearch 7.12 or later. The version is only checked once.
+
+        :return: True if documents can be scanned with a point in time
+        """
+        if self.point_in_time_supported is None:
+            version = self.conn.info()["version"]["number"]
+            version_numbers = tuple(int(number) for number in re.findall(r"\d+", version)[:2])
+            self.point_in_time_supported = version_numbers >= self.POINT_IN_TIME_MIN_VERSION
+            if not self.point_in_time_supported:
+                self.logging.logger.warning("scanning with a point in time requires Elasticsearch 7.12 or later, "
+                                            "using a sorted scroll instead on Elasticsearch %s", version)
+        return self.point_in_time_supported
+
+    def _point_in_time_scan(self, index, query):
+        """
+        Scan documents in the sort order of the query, by opening a point in time on the index and paging through it
+        with search_after. The _shard_doc tiebreaker is added to the sort, so that documents with the same sort
+        values at the edge of a page are neither skipped nor returned twice. When a page request fails, it is retried
+        from the sort values of the last returned document, so a temporary failure doesn't require to restart the
+        complete scan.
+
+        :param index: on which index the request must be done
+        :param query: the query used to scan the documents, which must contain a sort clause
+        :return: generator to fetch documents
+        """
+        keep_alive = self.settings.config.get("general", "es_scroll_time")
+        request_timeout = self.settings.config.getint("general", "es_timeout")
+
+        query = copy.deepcopy(query)
+        query["sort"] = list(query.get("sort", list())) + [{"_shard_doc": "asc"}]
+
+        pit = self.conn.transport.perform_request("POST", "/" + index + "/_pit", params={"keep_alive": keep_alive})
+        pit_id = pit["id"]
+
+        search_after = None
+        try:
+            while True:
+                body = copy.deepcopy(query)
+                body["size"] = self.settings.config.getint("general", "es_scan_size")
+                body["pit"] = {"id": pit_id, "keep_alive": keep_alive}
+                if search_after is not None:
+                    body["search_after"] = search_after
+
+                results = self._search_with_retries(body=body, request_timeout=request_timeout)
+
+                # the point in time id can change between requests, always use the most recent one
+                pit_id = results.get("pit_id", pit_id)
+                hits = results["hits"]["hits"]
+                if not hits:
+                    break
+
+                for hit in hits:
+                    yield hit
+
+                search_after = hits[-1]["sort"]
+        finally:
+            try:
+                self.conn.transport.perform_request("DELETE", "/_pit", body={"id": pit_id})
+            except TransportError as e:
+                self.logging.logger.debug("could not close point in time: " + str(e))
+
+    def use_request_cache(self):
+        """
+        Check if requests without hits should be answered from the shard request cache of Elasticsearch
+
+        :return: True if the request cache is used
+        """
+        return self.settings.config.getboolean("general", "es_request_cache", fallback=False)
+
+    def _get_request_cache_params(self):
+        """
+        Get the parameters of a search request without hits, to opt into the request cache when it's enabled
+
+        :return: dictionary of search request parameters
+        """
+        if self.use_request_cache():
+            return {"request_cache": True}
+        return dict()
+
+    def _get_request_cache_stats(self):
+        """
+        Get the number of hits and misses of the request cache of the indices analyzed by the use cases
+
+        :return: tuple with the number of hits and misses, or None if the statistics can't be fetched
+        """
+        try:
+            stats = self.conn.indices.stats(index=self.settings.config.get("general", "es_index_pattern"),
+                                            metric="request_cache")
+        except TransportError as e:
+            self.logging.logger.debug("could not fetch request cache statistics: " + str(e))
+            return None
+
+        request_cache = stats["_all"]["total"]["request_cache"]
+        return request_cache["hit_count"], request_cache["miss_count"]
+
+    def log_request_cache_stats(self):
+        """
+        Log the hit rate of the request cache since the start of the run, when the request cache is used
+        """
+        if not self.use_request_cache() or self.request_cache_stats is None:
+            return
+
+        request_cache_stats = self._get_request_cache_stats()
+        if request_cache_stats is None:
+            return
+
+        hits = request_cache_stats[0] - self.request_cache_stats[0]
+        misses = request_cache_stats[1] - self.request_cache_stats[1]
+        if hits + misses > 0:
+            self.logging.logger.info("request cache hit rate during this run: %.1f%% (%s hits, %s misses)",
+                                     100.0 * hits / (hits + misses), "{:,}".format(hits), "{:,}".format(misses))
+
+    def _search_with_retries(self, **kwargs):
+        """
+        Perform a search request, retrying it with an exponential backoff in case of a connection error or a
+        temporary failure of Elasticsearch
+
+        :param kwargs: arguments of the search request
+        :return: the search results
+        """
+        retries = 0
+        while True:
+            try:
+                return self.conn.search(**kwargs)
+            except TransportError as e:
+                retryable = isinstance(e, ConnectionError) or e.status_code in self.SCAN_RETRY_STATUS_CODES
+                if not retryable or retries >= self.SCAN_MAX_RETRIES:
+                    raise
+
+                retries += 1
+                self.logging.logger.warning("search request failed, retrying (%d/%d): %s", retries,
+                                            self.SCAN_MAX_RETRIES, str(e))
+                time.sleep(get_retry_backoff(retries))
 
     def _count_documents(self, index, search_range, bool_clause=None, query_fields=None, search_query=None):
         """
@@ -147,15 +701,22 @@ class ES:
         :param index: on which index the request must be done
         :param search_range: the range of research
         :param bool_clause: boolean condition
-        :param query_fields: the query field
+        :param query_fields: the query field, not used as the count API only accepts a query
         :param search_query: the search query
         :return: number of document
         """
-        res = self.conn.count(index=index, body=build_search_query(bool_clause=bool_clause, search_range=search_range,
-                                                                   query_fields=query_fields,
-                                                                   search_query=search_query))
+        query = build_search_query(bool_clause=bool_clause, search_range=search_range, search_query=search_query)
+        index = self.prune_indices(index, search_range)
 
-        return res["count"]
+        if not self.use_request_cache():
+            return self.conn.count(index=index, body=query)["count"]
+
+        # count API requests don't use the request cache, unlike searches without hits
+        query["size"] = 0
+        query["track_total_hits"] = True
+        res = self.conn.search(index=index, body=query, request_cache=True)
+        total_hits = res["hits"]["total"]
+        return total_hits["value"] if isinstance(total_hits, dict) else total_hits
 
     def count_and_scan_documents(self, index, bool_clause=None, sort_clause=None, query_fields=None, search_query=None,
                                  model_settings=None):
@@ -195,45 +756,382 @@ class ES:
                                             timestamp_field=timestamp_field)
         return self._count_documents(index, search_range, bool_clause, query_fields, search_query)
 
-    def scan_first_occur_documents(self, search_query, start_time, end_time, model_settings):
+    def count_documents_per_search_query(self, index, search_range, search_queries):
         """
-        Retrieve from Elasticsearch in aggregation defined by model_settings["aggregator"], the first occurrence of a
-        term field defined by model_settings["target"], of events within the time window defined by start_time and
-        end_time.
+        Count, in a single request, the number of documents matching each of the search queries
+
+        :param index: on which index the request must be done
+        :param search_range: the range of the search
+        :param search_queries: dictionary with the name and the search query to count documents for
+        :return: dictionary with the name and the number of documents matching each search query
+        """
+        query = build_search_query(search_range=search_range)
+        query["size"] = 0
+        query["aggs"] = {
+            "search_queries": {
+                "filters": {
+                    "filters": {name: {"bool": {"filter": copy.deepcopy(search_query["filter"])}}
+                                for name, search_query in search_queries.items()}
+                }
+            }
+        }
+
+        results = self.conn.search(index=self.prune_indices(index, search_range), body=query,
+                                   **self._get_request_cache_params())
+        buckets = results["aggregations"]["search_queries"]["buckets"]
+        return {name: bucket["doc_count"] for name, bucket in buckets.items()}
+
+    def get_aggregatable_fields(self, index, fields):
+        """
+        Get the fields on which the values of the given fields can be aggregated: the field itself if it is
+        aggregatable (keyword, numeric, ...), or its keyword sub-field otherwise
+
+        :param index: on which index the request must be done
+        :param fields: list of field names
+        :return: dictionary with the aggregatable field of each field
+        """
+        field_names = list(fields) + [field + ".keyword" for field in fields]
+        field_capabilities = self.conn.field_caps(index=index, fields=",".join(field_names))["fields"]
+
+        def is_aggregatable(field_name):
+            capabilities = field_capabilities.get(field_name, dict()).values()
+            return len(capabilities) > 0 and all(capability["aggregatable"] for capability in capabilities)
+
+        aggregatable_fields = dict()
+        for field in fields:
+            if is_aggregatable(field):
+                aggregatable_fields[field] = field
+            elif is_aggregatable(field + ".keyword"):
+                aggregatable_fields[field] = field + ".keyword"
+            else:
+                raise ValueError("field " + field + " can not be aggregated in index " + index)
+        return aggregatable_fields
+
+    def get_exact_match_fields(self, index):
+        """
+        Get the fields of an index on which term queries match exactly the values of the documents: keyword fields,
+        and the keyword sub-field of text fields
+
+        :param index: on which index the request must be done
+        :return: list of field names, or None if the values of some fields can't be matched exactly
+        """
+        field_capabilities = self.conn.field_caps(index=index, fields="*")["fields"]
+
+        exact_match_fields = list()
+        for field, capabilities in field_capabilities.items():
+            field_types = set(capabilities.keys())
+            # metadata fields, and objects of which the sub-fields are checked on their own
+            if field.startswith("_") or field_types <= {"object", "nested"}:
+                continue
+
+            if field_types == {"keyword"}:
+                exact_match_fields.append(field)
+            elif field_types != {"text"} or \
+                    set(field_capabilities.get(field + ".keyword", dict()).keys()) != {"keyword"}:
+                return None
+        return exact_match_fields
+
+    def get_docvalue_fields(self, index, fields):
+        """
+        Get the fields of which the values can be read from doc values instead of the source of the documents:
+        keyword, numeric, date, ip, ... fields, but not text fields. Keyword fields with ignore_above or a normalizer
+        are read from the source, as the values longer than ignore_above have no doc values and the doc values of a
+        normalizer are normalized.
+
+        :param index: on which index the request must be done
+        :param fields: list of field names
+        :return: list of the fields that have doc values equal to their values in all indices
+        """
+        field_capabilities = self.conn.field_caps(index=index, fields=",".join(fields))["fields"]
+
+        altered_fields = set()
+        field_mappings = self.conn.indices.get_field_mapping(index=index, fields=",".join(fields))
+        for index_mappings in field_mappings.values():
+            for field, field_mapping in index_mappings.get("mappings", dict()).items():
+                for mapping in field_mapping.get("mapping", dict()).values():
+                    if "ignore_above" in mapping or "normalizer" in mapping:
+                        altered_fields.add(field)
+
+        docvalue_fields = list()
+        for field in fields:
+            capabilities = field_capabilities.get(field, dict()).values()
+            if len(capabilities) > 0 and all(capability["aggregatable"] for capability in capabilities) and \
+                    field not in altered_fields:
+                docvalue_fields.append(field)
+        return docvalue_fields
+
+    def scan_composite_aggregation(self, index, fields, search_query, model_settings):
+        """
+        Page through the combinations of values of the given fields in the history window of a model, with a
+        composite aggregation
+
+        :param index: on which index the request must be done
+        :param fields: list of field names
+        :param search_query: the search query
+        :param model_settings: part of the configuration linked to the model
+        :return: generator of tuples with the values of the fields, in the order of the fields, and the number of
+        documents with these values
+        """
+        for values, bucket in self._scan_composite_buckets(index, fields, search_query, model_settings):
+            yield values, bucket["doc_count"]
+
+    def scan_metric_aggregation(self, index, aggregator_fields, target_field, metric, search_query, model_settings,
+                                percents=(50,)):
+        """
+        Page through the values of the aggregator fields in the history window of a model, with the statistics of the
+        metric of the target field for each of them, computed by Elasticsearch
+
+        :param index: on which index the request must be done
+        :param aggregator_fields: list of aggregator field names
+        :param target_field: the target field name
+        :param metric: the metric, numerical_value or length
+        :param search_query: the search query
+        :param model_settings: part of the configuration linked to the model
+        :param percents: percentiles to compute
+        :return: generator of tuples with the values of the aggregator fields and a dictionary with the statistics
+        of the metric (count, min, max, avg, std_deviation, mad and percentiles)
+        """
+        metric_source = self.get_metric_source(index, target_field, metric)
+
+        search_query = copy.deepcopy(search_query)
+        search_query["filter"] = search_query.get("filter", list()) + [{"exists": {"field": target_field}}]
+        aggregations = {"stats": {"extended_stats": dict(metric_source)},
+                        "mad": {"median_absolute_deviation": dict(metric_source)},
+                        "percentiles": {"percentiles": dict(metric_source, percents=list(percents), keyed=False)}}
+
+        for values, bucket in self._scan_composite_buckets(index, aggregator_fields, search_query, model_settings,
+                                                           aggregations=aggregations):
+            stats = {name: bucket["stats"][name] for name in ("count", "min", "max", "avg", "std_deviation")}
+            stats["mad"] = bucket["mad"]["value"]
+            stats["percentiles"] = {percentile["key"]: percentile["value"]
+                                    for percentile in bucket["percentiles"]["values"]}
+            yield values, stats
+
+    def get_metric_source(self, index, target_field, metric):
+        """
+        Get the source of the values of a metric in an aggregation or a script query: the target field for a
+        numerical value, or a script computing the length of the target field
+
+        :param index: on which index the request must be done
+        :param target_field: the target field name
+        :param metric: the metric, numerical_value or length
+        :return: dictionary with the field or the script of the metric
+        """
+        if metric == "numerical_value":
+            return {"field": target_field}
+        if metric == "length":
+            aggregatable_field = self.get_aggregatable_fields(index, [target_field])[target_field]
+            return {"script": {"source": "doc[params.field].size() == 0 ? null : doc[params.field].value.length()", "lang": "painless",
+                               "params": {"field": aggregatable_field}}}
+        raise ValueError("metric " + metric + " can not be computed by Elasticsearch")
+
+    def _scan_composite_buckets(self, index, fields, search_query, model_settings, aggregations=None):
+        """
+        Page through the buckets of a composite aggregation on the given fields, in the history window of a model
+
+        :param index: on which index the request must be done
+        :param fields: list of field names
+        :param search_query: the search query
+        :param model_settings: part of the configuration linked to the model
+        :param aggregations: sub-aggregations computed for each bucket
+        :return: generator of tuples with the values of the fields, in the order of the fields, and the bucket
+        """
+        aggregatable_fields = self.get_aggregatable_fields(index, fields)
+
+        timestamp_field, history_window_days, history_window_hours = self._get_history_window(model_settings)
+        search_range = self.get_time_filter(days=history_window_days, hours=history_window_hours,
+                                            timestamp_field=timestamp_field)
+
+        query = build_search_query(search_range=search_range, search_query=search_query)
+        query["size"] = 0
+        sources = [{"field_" + str(i): {"terms": {"field": aggregatable_fields[field]}}}
+                   for i, field in enumerate(fields)]
+        composite = {"size": self.settings.config.getint("general", "es_composite_size", fallback=10000),
+                     "sources": sources}
+        query["aggs"] = {"composite_buckets": {"composite": composite}}
+        if aggregations:
+            query["aggs"]["composite_buckets"]["aggs"] = aggregations
+
+        request_timeout = self.settings.config.getint("general", "es_timeout", fallback=300)
+        index = self.prune_indices(index, search_range)
+        while True:
+            results = self._search_with_retries(index=index, body=query, request_timeout=request_timeout,
+                                                **self._get_request_cache_params())
+            composite_buckets = results["aggregations"]["composite_buckets"]
+
+            for bucket in composite_buckets["buckets"]:
+                yield tuple(bucket["key"]["field_" + str(i)] for i in range(len(fields))), bucket
+
+            if not composite_buckets["buckets"] or "after_key" not in composite_buckets:
+                return
+            composite["after"] = composite_buckets["after_key"]
+
+    def scan_first_occur_documents(self, search_query, start_time, end_time, model_settings,
+                                   first_occur_start_time=None, fetch_documents=True):
+        """
+        Page through the combinations of aggregator values, defined by model_settings["aggregator"], and term values,
+        defined by model_settings["target"], of events within the time window defined by start_time and end_time,
+        with the number of events and the time of the first and last occurrence of each combination. The first
+        document of a combination is only fetched if the combination occurred for the first time after
+        first_occur_start_time.
+
+        :param search_query: the search query
+        :param start_time: start time of the time window
+        :param end_time: end time of the time window
+        :param model_settings: part of the configuration linked to the model
+        :param first_occur_start_time: time after which the first document of a combination is fetched, or None to
+        fetch the first document of all combinations
+        :param fetch_documents: if False, the first document of the combinations is never fetched
+        :return: generator of dictionaries with the aggregator value, the target value, the number of events
+        (doc_count), the time of the first occurrence (first_occur_time), the time of the last occurrence
+        (last_occur_time) and the first document (top_doc, None if it was not fetched) of each combination
+        """
+        for first_occur_buckets in self._scan_first_occur_pages(search_query, start_time, end_time, model_settings):
+            if fetch_documents:
+                self.fetch_first_occur_documents([bucket for bucket in first_occur_buckets
+                                                  if _is_first_occur_after(bucket, first_occur_start_time)],
+                                                 search_query, start_time, end_time, model_settings)
+            for bucket in first_occur_buckets:
+                yield bucket
+
+    def scan_first_occur_per_interval(self, search_query, start_time, end_time, interval, model_settings):
+        """
+        Page through the combinations of aggregator values, defined by model_settings["aggregator"], and term values,
+        defined by model_settings["target"], of events within the time window defined by start_time and end_time,
+        for each interval of the given duration since start_time in which the combination occurs, with the number of
+        events and the time of the first occurrence of the combination in the interval. No document is fetched.
 
         :param search_query: the search query
         :param start_time: start time of the time window
         :param end_time: end time of the time window
+        :param interval: duration of the intervals, as timedelta
         :param model_settings: part of the configuration linked to the model
-        :return aggregator_buckets: list of aggregation buckets
+        :return: generator of dictionaries with the aggregator value, the target value, the index of the interval
+        since start_time (interval), the number of events in the interval (doc_count) and the time of the first
+        occurrence in the interval (first_occur_time)
+        """
+        # the intervals are computed by a script, as the offset of a composite date histogram can't be set in all
+        # supported versions of Elasticsearch
+        interval_source = {"terms": {"script": {
+            "source": "(doc[params.field].value.toInstant().toEpochMilli() - params.start) / params.interval",
+            "lang": "painless",
+            "params": {"field": model_settings["timestamp_field"],
+                       "start": int((start_time - dt.datetime(1970, 1, 1)).total_seconds() * 1000),
+                       "interval": int(interval.total_seconds() * 1000)}}}}
+
+        for first_occur_buckets in self._scan_first_occur_pages(search_query, start_time, end_time, model_settings,
+                                                                interval_source=interval_source):
+            for bucket in first_occur_buckets:
+                yield bucket
+
+    def _scan_first_occur_pages(self, search_query, start_time, end_time, model_settings, interval_source=None):
+        """
+        Page through the combinations of aggregator and target values of events within a time window, with a
+        composite aggregation
+
+        :param search_query: the search query
+        :param start_time: start time of the time window
+        :param end_time: end time of the time window
+        :param model_settings: part of the configuration linked to the model
+        :param interval_source: composite source of the interval of the events, or None to aggregate the complete
+        time window
+        :return: generator of lists of dictionaries with the aggregator value, the target value, the raw field values
+        (values), the number of events (doc_count), the time of the first and last occurrence (first_occur_time and
+        last_occur_time), the first document (top_doc, not fetched yet) and the interval (if interval_source is set)
+        of each combination
         """
         search_range = self.get_time_filter(start_time=start_time,
                                             end_time=end_time,
                                             timestamp_field=model_settings["timestamp_field"])
+        composite_size = self.settings.config.getint("general", "es_composite_size", fallback=10000)
         first_occur_search_query = build_first_occur_search_query(search_query=search_query,
                                                                   search_range=search_range,
                                                                   target_list=model_settings["target"],
                                                                   aggregator_list=model_settings["aggregator"],
                                                                   timestamp=model_settings["timestamp_field"],
-                                                                  max_num_aggs=model_settings["max_num_aggs"],
-                                                                  max_num_targets=model_settings["max_num_targets"])
-        try:
-            results = self.conn.search(index=model_settings["es_index"], body=first_occur_search_query)
-        except RequestError as e:
-            self.logging.logger.error(e.error)
-            self.logging.logger.error(json.dumps(e.info, indent=4))
-            return []
-
-        if results["_shards"]["failed"] > 0:
-            self.logging.logger.warning("Search query failure(s): ")
-            for failure in results["_shards"]["failures"]:
-                self.logging.logger.warning("Failed script: %s caused by %s: %s" %
-                                            (failure["reason"]["script"],
-                                             failure["reason"]["caused_by"]["type"],
-                                             failure["reason"]["caused_by"]["reason"]))
-
-        aggregator_buckets = results["aggregations"]["aggregator"]["buckets"]
-        return aggregator_buckets
+                                                                  composite_size=composite_size)
+        composite = first_occur_search_query["aggs"]["first_occur"]["composite"]
+        if interval_source is not None:
+            composite["sources"].append({"interval": interval_source})
+        nr_aggregator_fields = len(model_settings["aggregator"])
+        nr_fields = nr_aggregator_fields + len(model_settings["target"])
+        index = self.prune_indices(model_settings["es_index"], search_range)
+
+        while True:
+            try:
+                results = self._search_with_retries(index=index, body=first_occur_search_query,
+                                                    **self._get_request_cache_params())
+            except RequestError as e:
+                self.logging.logger.error(e.error)
+                self.logging.logger.error(json.dumps(e.info, indent=4))
+                return
+
+            if results["_shards"]["failed"] > 0:
+                self.logging.logger.warning("Search query failure(s): ")
+                for failure in results["_shards"]["failures"]:
+                    self.logging.logger.warning("Failed search caused by %s: %s" %
+                                                (failure["reason"]["type"], failure["reason"]["reason"]))
+
+            composite_buckets = results["aggregations"]["first_occur"]
+            first_occur_buckets = list()
+            for bucket in composite_buckets["buckets"]:
+                values = [bucket["key"]["field_" + str(i)] for i in range(nr_fields)]
+                first_occur_bucket = {
+                    "aggregator": helpers.utils.flatten_sentence(values[:nr_aggregator_fields]),
+                    "target": helpers.utils.flatten_sentence(values[nr_aggregator_fields:]),
+                    "doc_count": bucket["doc_count"],
+                    "first_occur_time": dt.datetime.utcfromtimestamp(bucket["first_occur_time"]["value"] / 1000),
+                    "last_occur_time": dt.datetime.utcfromtimestamp(bucket["last_occur_time"]["value"] / 1000),
+                    "top_doc": None,
+                    "values": values}
+                if interval_source is not None:
+                    first_occur_bucket["interval"] = int(bucket["key"]["interval"])
+                first_occur_buckets.append(first_occur_bucket)
+
+            yield first_occur_buckets
+
+            if not composite_buckets["buckets"] or "after_key" not in composite_buckets:
+                return
+            composite["after"] = composite_buckets["after_key"]
+
+    def fetch_first_occur_documents(self, first_occur_buckets, search_query, start_time, end_time, model_settings):
+        """
+        Fetch the first document within a time window of combinations of aggregator and target values, with multi
+        search requests
+
+        :param first_occur_buckets: list of combinations returned by scan_first_occur_documents or
+        scan_first_occur_per_interval, of which the top_doc is set
+        :param search_query: the search query
+        :param start_time: start time of the time window
+        :param end_time: end time of the time window
+        :param model_settings: part of the configuration linked to the model
+        """
+        search_range = self.get_time_filter(start_time=start_time,
+                                            end_time=end_time,
+                                            timestamp_field=model_settings["timestamp_field"])
+        fields = model_settings["aggregator"] + model_settings["target"]
+        request_timeout = self.settings.config.getint("general", "es_timeout", fallback=300)
+        index = self.prune_indices(model_settings["es_index"], search_range)
+
+        for i in range(0, len(first_occur_buckets), self.FIRST_OCCUR_DOCUMENTS_MSEARCH_SIZE):
+            batch_buckets = first_occur_buckets[i:i + self.FIRST_OCCUR_DOCUMENTS_MSEARCH_SIZE]
+            searches = list()
+            for bucket in batch_buckets:
+                filters = [{"term": {field: value}} for field, value in zip(fields, bucket["values"])]
+                query = build_search_query(search_range=search_range,
+                                           search_query={"filter": search_query["filter"] + filters},
+                                           sort_clause={"sort": [{model_settings["timestamp_field"]: "asc"}]})
+                query["size"] = 1
+                searches.extend([dict(), query])
+
+            results = self.conn.msearch(index=index, body=searches,
+                                        request_timeout=request_timeout)
+            for bucket, response in zip(batch_buckets, results["responses"]):
+                if "error" in response:
+                    self.logging.logger.warning("could not fetch first occurrence of %s - %s: %s", bucket["aggregator"],
+                                                bucket["target"], str(response["error"]))
+                elif response["hits"]["hits"]:
+                    bucket["top_doc"] = response["hits"]["hits"][0]
 
     @staticmethod
     def filter_by_query_string(query_string=None):
@@ -278,6 +1176,9 @@ class ES:
 
         :return: the number of outliers removed
         """
+        if self.get_outliers_write_mode() == "append":
+            return self._remove_all_whitelisted_outlier_records(dict_with_analyzer)
+
         outliers_filter_query = {"filter": [{"term": {"tags": "outlier"}}]}
 
         total_outliers_whitelisted = 0
@@ -329,43 +1230,128 @@ class ES:
                     doc = remove_outliers_from_document(doc)
                     self.add_remove_outlier_bulk_action(doc)
 
-                # we don't use the ticker from the logger singleton, as this will be called from the housekeeping thread
-                # if we share a same ticker between multiple threads, strange results would start to appear in
-                # progress logging
-                # so, we duplicate part of the functionality from the logger singleton
-                if self.logging.verbosity >= 5:
-                    should_log = True
+                self._log_whitelisting_progress(total_outliers_processed, total_nr_outliers,
+                                                total_outliers_whitelisted, start_time)
+
+            self.drain_bulk_actions()
+
+        return total_outliers_whitelisted
+
+    def _remove_all_whitelisted_outlier_records(self, dict_with_analyzer):
+        """
+        Remove all whitelisted outlier records from the outliers index, in append write mode.
+        As each record holds a single outlier, whitelisted outliers can be removed one by one.
+
+        :param dict_with_analyzer: dictionary of the analyzers, by config section name
+        :return: the number of outlier records removed
+        """
+        total_outliers_whitelisted = 0
+        total_outliers_processed = 0
+
+        total_nr_outliers, records = self.count_and_scan_documents(index=self.get_outliers_index())
+
+        if total_nr_outliers > 0:
+            self.logging.logger.info("going to analyze %s outliers and remove all whitelisted items", "{:,}"
+                                     .format(total_nr_outliers))
+            start_time = dt.datetime.today().timestamp()
+
+            for record, doc in self._get_outlier_records_with_documents(records):
+                total_outliers_processed = total_outliers_processed + 1
+
+                config_section_name = record["_source"]["model_type"] + "_" + record["_source"]["model_name"]
+                if config_section_name not in dict_with_analyzer:
+                    self.logging.logger.debug("Outlier '%s' was not found in configuration, could not check "
+                                              "whitelist", config_section_name)
                 else:
-                    should_log = total_outliers_processed % max(1,
-                                                                int(math.pow(10, (6 - self.logging.verbosity)))) == 0 \
-                                 or total_outliers_processed == total_nr_outliers
+                    analyzer = dict_with_analyzer[config_section_name]
+                    record_outliers = record["_source"]["outliers"]
 
-                if should_log:
-                    # avoid a division by zero
-                    time_diff = max(float(1), float(dt.datetime.today().timestamp() - start_time))
-                    ticks_per_second = "{:,}".format(round(float(total_outliers_processed) / time_diff))
+                    # the outlier observations are part of the event when they are written into it, keep checking them
+                    doc["_source"]["outliers"] = record_outliers
+                    outlier = Outlier(outlier_type=record_outliers["type"], outlier_reason=record_outliers["reason"],
+                                      outlier_summary=record_outliers["summary"], doc=doc)
+                    if outlier.is_whitelisted(extra_literals_whitelist_value=analyzer.model_whitelist_literals,
+                                              extra_regexps_whitelist_value=analyzer.model_whitelist_regexps):
+                        total_outliers_whitelisted += 1
+                        self.add_bulk_action({'_op_type': 'delete', '_index': record["_index"], '_id': record["_id"]})
 
-                    self.logging.logger.info("whitelisting historical outliers " + " [" + ticks_per_second + " eps." +
-                                             " - " + '{:.2f}'.format(round(float(total_outliers_processed) /
-                                                                           float(total_nr_outliers) * 100, 2)) +
-                                             "% done" + " - " + "{:,}".format(total_outliers_whitelisted) +
-                                             " outliers whitelisted]")
+                self._log_whitelisting_progress(total_outliers_processed, total_nr_outliers,
+                                                total_outliers_whitelisted, start_time)
 
-            self.flush_bulk_actions()
+            self.drain_bulk_actions()
 
         return total_outliers_whitelisted
 
+    def _get_outlier_records_with_documents(self, records):
+        """
+        Fetch the events referenced by outlier records, in batches
+
+        :param records: generator of outlier records
+        :return: generator of outlier records with their event (with an empty source if the event doesn't exist)
+        """
+        batch = list()
+        for record in chain(records, [None]):
+            if record is not None:
+                batch.append(record)
+                if len(batch) < self.OUTLIER_RECORDS_MGET_SIZE:
+                    continue
+            if not batch:
+                break
+
+            docs_to_get = [{"_index": record["_source"]["outlier_doc"]["index"],
+                            "_id": record["_source"]["outlier_doc"]["id"]} for record in batch]
+            docs = self.conn.mget(body={"docs": docs_to_get})["docs"]
+            for batch_record, doc in zip(batch, docs):
+                if not doc.get("found"):
+                    doc["_source"] = dict()
+                yield batch_record, doc
+            batch = list()
+
+    def _log_whitelisting_progress(self, total_outliers_processed, total_nr_outliers, total_outliers_whitelisted,
+                                   start_time):
+        """
+        Log the progress of the removal of whitelisted outliers
+
+        :param total_outliers_processed: number of outliers processed so far
+        :param total_nr_outliers: total number of outliers to process
+        :param total_outliers_whitelisted: number of outliers whitelisted so far
+        :param start_time: timestamp of the start of the removal
+        """
+        # we don't use the ticker from the logger singleton, as this will be called from the housekeeping thread
+        # if we share a same ticker between multiple threads, strange results would start to appear in
+        # progress logging
+        # so, we duplicate part of the functionality from the logger singleton
+        if self.logging.verbosity >= 5:
+            should_log = True
+        else:
+            log_interval = max(1, int(math.pow(10, (6 - self.logging.verbosity))))
+            should_log = total_outliers_processed % log_interval == 0 or total_outliers_processed == total_nr_outliers
+
+        if should_log:
+            # avoid a division by zero
+            time_diff = max(float(1), float(dt.datetime.today().timestamp() - start_time))
+            ticks_per_second = "{:,}".format(round(float(total_outliers_processed) / time_diff))
+
+            percent_done = '{:.2f}'.format(round(float(total_outliers_processed) / float(total_nr_outliers) * 100, 2))
+            self.logging.logger.info("whitelisting historical outliers [%s eps. - %s%% done - %s outliers whitelisted]",
+                                     ticks_per_second, percent_done, "{:,}".format(total_outliers_whitelisted))
+
     def remove_all_outliers(self):
         """
         Remove all outliers present in Elasticsearch
         """
-        idx = self.settings.config.get("general", "es_index_pattern")
-
-        must_clause = {"filter": [{"term": {"tags": "outlier"}}]}
         timestamp_field, history_window_days, history_window_hours = self._get_history_window()
         search_range = self.get_time_filter(days=history_window_days,
                                             hours=history_window_hours,
                                             timestamp_field=timestamp_field)
+
+        if self.get_outliers_write_mode() == "append":
+            self._remove_all_outlier_records(search_range)
+            return
+
+        idx = self.settings.config.get("general", "es_index_pattern")
+
+        must_clause = {"filter": [{"term": {"tags": "outlier"}}]}
         total_outliers = self._count_documents(index=idx, search_range=search_range, bool_clause=must_clause)
 
         if total_outliers > 0:
@@ -380,11 +1366,127 @@ class ES:
             query["script"] = script
 
             self.logging.logger.info("wiping %s existing outliers", "{:,}".format(total_outliers))
-            self.conn.update_by_query(index=idx, body=query, refresh=True, wait_for_completion=True)
+            self.conn.update_by_query(index=self.prune_indices(idx, search_range), body=query, refresh=True,
+                                      wait_for_completion=True)
             self.logging.logger.info("wiped outlier information of " + "{:,}".format(total_outliers) + " documents")
         else:
             self.logging.logger.info("no existing outliers were found, so nothing was wiped")
 
+    def _remove_all_outlier_records(self, search_range):
+        """
+        Remove all outlier records from the outliers index, in append write mode
+
+        :param search_range: the range of the events of which the outlier records are removed
+        """
+        idx = self.get_outliers_index()
+        total_outliers = self._count_documents(index=idx, search_range=search_range)
+
+        if total_outliers > 0:
+            query = build_search_query(search_range=search_range)
+
+            self.logging.logger.info("wiping %s existing outliers", "{:,}".format(total_outliers))
+            self.conn.delete_by_query(index=idx, body=query, refresh=True, wait_for_completion=True)
+            self.logging.logger.info("wiped " + "{:,}".format(total_outliers) + " outlier records")
+        else:
+            self.logging.logger.info("no existing outliers were found, so nothing was wiped")
+
+    def add_outlier_by_query(self, index, search_query, model_settings, outlier_dict_of_arrays):
+        """
+        Add the same outlier to all events matching the search query within the history window, with a sliced update
+        by query running in Elasticsearch. The assets of the outlier are extracted from each event by the update
+        script. Events already containing an outlier with the same summary are left unchanged, and events modified
+        while the update is running are skipped.
+
+        :param index: on which index the request must be done
+        :param search_query: the search query
+        :param model_settings: part of the configuration linked to the model
+        :param outlier_dict_of_arrays: outlier dictionary where all values are lists, without assets
+        :return: dictionary with the number of events matching the search query (total), of updated events (updated),
+        of events that already contained the outlier (noops) and of skipped events (version_conflicts)
+        """
+        timestamp_field, history_window_days, history_window_hours = self._get_history_window(model_settings)
+        search_range = self.get_time_filter(days=history_window_days, hours=history_window_hours,
+                                            timestamp_field=timestamp_field)
+        query = build_search_query(search_range=search_range, search_query=search_query)
+
+        assets = [{"path": asset_field_name.lower().split("."), "type": asset_field_type}
+                  for asset_field_name, asset_field_type in self.settings.list_assets]
+        query["script"] = {
+            "source": ADD_OUTLIER_BY_QUERY_SCRIPT,
+            "lang": "painless",
+            "params": {
+                "tag": "outlier",
+                "outlier": outlier_dict_of_arrays,
+                "assets": assets
+            }
+        }
+
+        task = self.conn.update_by_query(index=self.prune_indices(index, search_range), body=query, conflicts="proceed",
+                                         refresh=True, slices="auto",
+                                         wait_for_completion=False,
+                                         request_timeout=self.settings.config.getint("general", "es_timeout"))
+        result = self._wait_for_task(task["task"], description="adding outliers")
+
+        if result.get("failures"):
+            self.logging.logger.error("unable to add outliers to %d events on index %s", len(result["failures"]),
+                                      index)
+            self.logging.logger.debug("first update by query failure: %s", str(result["failures"][0]))
+        if result.get("version_conflicts"):
+            self.logging.logger.warning("skipped %s events modified while adding outliers, they will be evaluated "
+                                        "again during the next run", "{:,}".format(result["version_conflicts"]))
+        return result
+
+    def _wait_for_task(self, task_id, description):
+        """
+        Wait for a task running in Elasticsearch to complete, logging its progress
+
+        :param task_id: id of the task
+        :param description: description of the task, for the progress messages
+        :return: the response of the task
+        """
+        while True:
+            task = self.conn.tasks.get(task_id=task_id)
+            if task.get("completed"):
+                return task.get("response", dict())
+
+            status = task["task"]["status"]
+            processed = status.get("updated", 0) + status.get("noops", 0) + status.get("version_conflicts", 0)
+            self.logging.logger.info("%s - processed %s of %s events", description, "{:,}".format(processed),
+                                     "{:,}".format(status.get("total", 0)))
+            time.sleep(self.TASK_POLL_INTERVAL)
+
+    def get_outlier_document_ids(self, model_type, model_name, model_settings, max_ids=None):
+        """
+        Get the ids of the events in the history window of a use case that have been flagged as outlier by this use
+        case, in append write mode
+
+        :param model_type: type of the use case
+        :param model_name: name of the use case
+        :param model_settings: part of the configuration linked to the model
+        :param max_ids: maximum number of event ids to get, None to get all of them
+        :return: list of event ids, or None if more than max_ids events have been flagged
+        """
+        # outlier records are timestamped with the timestamp field of the general settings
+        timestamp_field, _, _ = self._get_history_window()
+        search_range = self.get_time_filter(days=model_settings["history_window_days"],
+                                            hours=model_settings["history_window_hours"],
+                                            timestamp_field=timestamp_field)
+        # model_type and model_name are keyword fields in the outliers index template
+        search_query = {"filter": [{"term": {"model_type": model_type}},
+                                   {"term": {"model_name": model_name}}]}
+
+        records = self._scan(self.get_outliers_index(), search_range, query_fields=["outlier_doc.id"],
+                             search_query=search_query)
+
+        document_ids = set()
+        for record in records:
+            document_ids.add(record["_source"]["outlier_doc"]["id"])
+            if max_ids is not None and len(document_ids) > max_ids:
+                if hasattr(records, "close"):
+                    records.close()
+                return None
+        return list(document_ids)
+
     def process_outlier(self, outlier=None, should_notify=False, extract_derived_fields=False):
         """
         Save outlier (if configuration is setup for that), notify (also depending of configuration) and print.
@@ -392,10 +1494,11 @@ class ES:
         :param outlier: the detected outlier
         :param should_notify: True if notification need to be send
         :param extract_derived_fields: True to save derived fields
+        :return: True if the outlier was not saved because it was already saved before
         """
-
+        outlier_unchanged = False
         if self.settings.es_save_results:
-            self.save_outlier(outlier=outlier, extract_derived_fields=extract_derived_fields)
+            outlier_unchanged = self.save_outlier(outlier=outlier, extract_derived_fields=extract_derived_fields)
 
         if should_notify:
             self.notifier.notify_on_outlier(outlier=outlier)
@@ -403,6 +1506,8 @@ class ES:
         if self.settings.print_outliers_to_console:
             self.logging.logger.info("outlier - " + outlier.outlier_dict["summary"])
 
+        return outlier_unchanged
+
     def add_update_bulk_action(self, document):
         """
         Add a bulk action of "update" type
@@ -419,6 +1524,62 @@ class ES:
         }
         self.add_bulk_action(action)
 
+    def add_outliers_bulk_action(self, document, outlier_dicts):
+        """
+        Add a bulk action of "update" type only sending the outliers, that are merged with the outliers already
+        present in the document by a stored script
+
+        :param document: document to which the outliers are added
+        :param outlier_dicts: list of outlier dictionaries where all values are lists
+        """
+        action = {
+            '_op_type': 'update',
+            '_index': document["_index"],
+            '_type': document["_type"],
+            '_id': document["_id"],
+            'retry_on_conflict': 10,
+            '_source': {
+                "script": {
+                    "id": ADD_OUTLIERS_SCRIPT_ID,
+                    "params": {
+                        "tag": "outlier",
+                        "outliers": outlier_dicts
+                    }
+                }
+            }
+        }
+        self.add_bulk_action(action)
+
+    def add_outlier_record_bulk_action(self, outlier):
+        """
+        Add a bulk action of "create" type, indexing a record of the outlier in the outliers index. The id of the
+        record is derived from the event and the outlier, so that a record that already exists is not indexed again.
+
+        :param outlier: the outlier to index
+        """
+        timestamp_field, _, _ = self._get_history_window()
+        try:
+            timestamp = helpers.utils.get_dotkey_value(outlier.doc["_source"], timestamp_field)
+        except KeyError:
+            timestamp = None
+
+        action = {
+            '_op_type': 'create',
+            '_index': self.get_outliers_index(),
+            '_id': get_outlier_record_id(outlier),
+            '_source': {
+                timestamp_field: timestamp,
+                "outlier_doc": {
+                    "index": outlier.doc["_index"],
+                    "id": outlier.doc["_id"]
+                },
+                "outliers": outlier.outlier_dict,
+                "model_name": outlier.outlier_dict.get("model_name"),
+                "model_type": outlier.outlier_dict.get("model_type")
+            }
+        }
+        self.add_bulk_action(action)
+
     def add_remove_outlier_bulk_action(self, document):
         """
         Creates the bulk action to remove all the outlier traces from all events.
@@ -449,31 +1610,233 @@ class ES:
 
         :param action: action that need to be added
         """
+        if not self.bulk_actions:
+            self.bulk_actions_bytes = 0
+
+        # the actions are serialized again when they are sent, so their size is estimated from a sample of them. The
+        # bulk requests themselves are still split on the byte budget by the bulk helper.
+        if len(self.bulk_actions) % self.BULK_ACTION_BYTES_SAMPLE_INTERVAL == 0:
+            self.bulk_action_bytes_estimate = len(json.dumps(action, default=str))
+
         self.bulk_actions.append(action)
-        if len(self.bulk_actions) > self.BULK_FLUSH_SIZE:
+        self.bulk_actions_bytes += self.bulk_action_bytes_estimate
+
+        if len(self.bulk_actions) > self._get_bulk_flush_size() or \
+                self.bulk_actions_bytes > self._get_bulk_max_bytes():
             self.flush_bulk_actions()
 
     def flush_bulk_actions(self, refresh=False):
         """
-        Force bulk action to be process
+        Force bulk action to be process. If background bulk writers are enabled, the bulk actions are only queued:
+        use drain_bulk_actions to wait until they are written.
 
         :param refresh: refresh or not in Elasticsearch
         """
         if not self.bulk_actions:
             return
-        try:
-            eshelpers.bulk(self.conn, self.bulk_actions, stats_only=True, refresh=refresh)
-        except eshelpers.BulkIndexError:
-            self.logging.logger.error("BulkIndexError: Unable to write on index %s" % self.bulk_actions[0]["_index"])
 
+        bulk_actions = self.bulk_actions
         self.bulk_actions = []
+        self.bulk_actions_bytes = 0
+
+        bulk_writer = self._get_bulk_writer()
+        if bulk_writer is None:
+            self._send_bulk_actions(bulk_actions, refresh=refresh)
+        else:
+            bulk_writer.submit(bulk_actions, refresh=refresh)
+
+    def drain_bulk_actions(self):
+        """
+        Flush the bulk actions of the current thread, and wait until all the bulk actions it flushed have been written
+        to Elasticsearch
+        """
+        self.flush_bulk_actions()
+        if self.bulk_writer is not None:
+            self.bulk_writer.wait_for_pending_requests()
+
+    def _get_bulk_writer(self):
+        """
+        Get the background bulk writer, starting it the first time it is needed
+
+        :return: the bulk writer, or None if bulk actions should be written synchronously
+        """
+        with self.bulk_writer_lock:
+            if self.bulk_writer is None:
+                writer_threads = self.settings.config.getint("general", "es_bulk_writer_threads", fallback=0)
+                if writer_threads > 0:
+                    max_queue_size = self.settings.config.getint("general", "es_bulk_queue_size", fallback=4)
+                    self.bulk_writer = BulkWriter(self._send_bulk_actions, writer_threads=writer_threads,
+                                                  max_queue_size=max_queue_size)
+            return self.bulk_writer
+
+    def _get_bulk_flush_size(self):
+        """
+        Get the number of bulk actions above which the bulk actions of a thread are flushed
+
+        :return: the number of bulk actions
+        """
+        if self.bulk_flush_size is None:
+            return self.BULK_FLUSH_SIZE
+        return self.bulk_flush_size
+
+    def _get_bulk_max_bytes(self):
+        """
+        Get the size in bytes above which the bulk actions of a thread are flushed
+
+        :return: the size in bytes
+        """
+        return self.settings.config.getint("general", "es_bulk_max_bytes", fallback=10485760)
+
+    def _adapt_bulk_flush_size(self, nr_bulk_actions, latency, rejected=False):
+        """
+        Adapt the number of bulk actions per request to the latency of the last bulk request: shrink it when the
+        request was slow or when Elasticsearch rejected actions, and grow it when a full request was fast
+
+        :param nr_bulk_actions: number of bulk actions sent in the request
+        :param latency: duration of the request in seconds
+        :param rejected: True if Elasticsearch rejected some of the bulk actions
+        """
+        target_latency = self.settings.config.getfloat("general", "es_bulk_target_latency", fallback=0)
+        if target_latency <= 0:
+            return
+
+        with self.bulk_flush_size_lock:
+            bulk_flush_size = self._get_bulk_flush_size()
+            if rejected or latency > target_latency:
+                bulk_flush_size = bulk_flush_size // 2
+            elif latency < target_latency / 2 and nr_bulk_actions >= bulk_flush_size:
+                bulk_flush_size = int(bulk_flush_size * 1.25)
+
+            self.bulk_flush_size = min(self.BULK_MAX_FLUSH_SIZE, max(self.BULK_MIN_FLUSH_SIZE, bulk_flush_size))
+
+    def _send_bulk_actions(self, bulk_actions, refresh=False):
+        """
+        Send a batch of bulk actions to Elasticsearch. The actions rejected because Elasticsearch is overloaded (429)
+        are retried with an exponential backoff, the other failed actions are logged.
+
+        :param bulk_actions: list of bulk actions
+        :param refresh: refresh or not in Elasticsearch
+        """
+        if any(action.get("_source", dict()).get("script", dict()).get("id") == ADD_OUTLIERS_SCRIPT_ID
+               for action in bulk_actions):
+            self._store_outliers_script()
+        if any(action["_op_type"] == "create" for action in bulk_actions):
+            self._store_outliers_index_template()
+
+        failed_items = list()
+        retries = 0
+
+        while True:
+            rejected_actions = list()
+            start_time = time.time()
+
+            results = eshelpers.streaming_bulk(self.conn, bulk_actions, chunk_size=len(bulk_actions),
+                                               max_chunk_bytes=self._get_bulk_max_bytes(), raise_on_error=False,
+                                               raise_on_exception=False, refresh=refresh)
+            for action, (success, item) in zip(bulk_actions, results):
+                if success:
+                    continue
+
+                op_type, item_info = next(iter(item.items()))
+                if op_type == "create" and item_info.get("status") == 409:
+                    # the outlier record was already indexed during a previous run
+                    continue
+                if item_info.get("status") == 429:
+                    rejected_actions.append(action)
+                elif isinstance(item_info.get("exception"), ConnectionError):
+                    # the request didn't reach Elasticsearch, keep the same behavior as a failing search
+                    raise item_info["exception"]
+                else:
+                    failed_items.append(item_info)
+
+            if retries == 0:
+                self._adapt_bulk_flush_size(len(bulk_actions), time.time() - start_time,
+                                            rejected=len(rejected_actions) > 0)
+
+            if not rejected_actions:
+                break
+
+            if retries >= self.BULK_MAX_RETRIES:
+                failed_items.extend({"_index": action["_index"], "status": 429} for action in rejected_actions)
+                break
+
+            retries += 1
+            self.logging.logger.warning("%d bulk actions rejected by Elasticsearch, retrying (%d/%d)",
+                                        len(rejected_actions), retries, self.BULK_MAX_RETRIES)
+            time.sleep(get_retry_backoff(retries))
+            bulk_actions = rejected_actions
+
+        if failed_items:
+            self.logging.logger.error("BulkIndexError: Unable to write %d bulk actions on index %s",
+                                      len(failed_items), failed_items[0].get("_index"))
+            self.logging.logger.debug("first bulk action error: %s", str(failed_items[0].get("error")))
+
+    def _store_outliers_script(self):
+        """
+        Store the script used to add outliers to events in Elasticsearch, once per process
+        """
+        with self.outliers_script_lock:
+            if not self.outliers_script_stored:
+                self.conn.put_script(id=ADD_OUTLIERS_SCRIPT_ID,
+                                     body={"script": {"lang": "painless", "source": ADD_OUTLIERS_SCRIPT}})
+                self.outliers_script_stored = True
+
+    def _store_outliers_index_template(self):
+        """
+        Store the index template of the outliers index once per process, so that the fields used to find the outlier
+        records of a use case are mapped as keywords
+        """
+        with self.outliers_index_template_lock:
+            if not self.outliers_index_template_stored:
+                timestamp_field, _, _ = self._get_history_window()
+                self.conn.indices.put_template(name=OUTLIERS_INDEX_TEMPLATE_NAME, body={
+                    "index_patterns": [self.get_outliers_index() + "*"],
+                    "mappings": {
+                        "properties": {
+                            timestamp_field: {"type": "date"},
+                            "outlier_doc": {
+                                "properties": {
+                                    "index": {"type": "keyword"},
+                                    "id": {"type": "keyword"}
+                                }
+                            },
+                            "model_name": {"type": "keyword"},
+                            "model_type": {"type": "keyword"}
+                        }
+                    }
+                })
+                self.outliers_index_template_stored = True
+
+    def get_outliers_write_mode(self):
+        """
+        Get how outliers are written to Elasticsearch: "full" sends the complete updated event, "partial" only sends
+        the outliers and lets Elasticsearch merge them into the event, "append" indexes outlier records in a
+        dedicated outliers index and leaves the events untouched
+
+        :return: the write mode
+        """
+        write_mode = self.settings.config.get("general", "es_outliers_write_mode", fallback="full")
+        if write_mode not in OUTLIERS_WRITE_MODES:
+            raise ValueError("unknown es_outliers_write_mode {}, should be one of {}".format(
+                write_mode, ", ".join(OUTLIERS_WRITE_MODES)))
+        return write_mode
+
+    def get_outliers_index(self):
+        """
+        Get the index in which outlier records are indexed, in append write mode
+
+        :return: the name of the index
+        """
+        return self.settings.config.get("general", "es_outliers_index", fallback=DEFAULT_OUTLIERS_INDEX)
 
     def save_outlier(self, outlier=None, extract_derived_fields=False):
         """
-        Complete (with derived fields) and save outlier to Elasticsearch (via bulk action)
+        Complete (with derived fields) and save outlier to Elasticsearch (via bulk action), unless the outlier is
+        already part of the document or was already saved during this run
 
         :param outlier: the outlier that need to be save
         :param extract_derived_fields: True to save derived fields
+        :return: True if the outlier was not saved because it was already saved before
         """
         if extract_derived_fields:
             # add the derived fields as outlier observations
@@ -483,8 +1846,124 @@ class ES:
                 # delete temporary derived fields
                 del outlier.doc["_source"][derived_field]
 
+        if self._is_outlier_already_saved(outlier):
+            return True
+
         doc = add_outlier_to_document(outlier)
-        self.add_update_bulk_action(doc)
+        write_mode = self.get_outliers_write_mode()
+        if write_mode == "append":
+            self.add_outlier_record_bulk_action(outlier)
+        elif self.settings.config.getboolean("general", "es_coalesce_outlier_updates", fallback=False):
+            self._coalesce_outlier_update(doc, outlier.get_outlier_dict_of_arrays())
+        elif self._use_partial_update(doc):
+            self.add_outliers_bulk_action(doc, [outlier.get_outlier_dict_of_arrays()])
+        else:
+            self.add_update_bulk_action(doc)
+        return False
+
+    def _use_partial_update(self, doc):
+        """
+        Check if only the outliers must be sent to Elasticsearch to update a document. This is always the case for
+        documents given to several use cases by a shared scan: the copy of each use case only contains its own
+        outliers, so sending the complete copies would keep the outliers of the last use case only.
+
+        :param doc: the document to update
+        :return: True if the outliers must be merged into the document by the stored script
+        """
+        return self.get_outliers_write_mode() == "partial" or doc.get(SHARED_DOCUMENT_KEY, False)
+
+    def start_new_run(self):
+        """
+        Forget the outliers saved and the time ranges of the indices resolved during the previous run, and fix the
+        time up to which the events of the new run are processed
+        """
+        self.run_end_time = get_aligned_time(dt.datetime.now(),
+                                             self.settings.config.getint("general", "es_time_filter_rounding",
+                                                                         fallback=0))
+        if self.use_request_cache():
+            self.request_cache_stats = self._get_request_cache_stats()
+        with self.saved_outliers_lock:
+            self.saved_outliers = set()
+        with self.index_time_ranges_lock:
+            self.index_time_ranges = dict()
+
+    def _is_outlier_already_saved(self, outlier):
+        """
+        Check if saving an outlier would leave Elasticsearch unchanged: either the scanned document already contains
+        an outlier with the same summary, or an outlier with the same summary was already saved for the document
+        during this run. Outliers that are not already saved are remembered for the rest of the run.
+
+        :param outlier: the outlier to check
+        :return: True if the outlier was already saved
+        """
+        doc_source = outlier.doc["_source"]
+        summary = outlier.outlier_dict["summary"]
+        if "outlier" in doc_source.get("tags", list()) and \
+                summary in doc_source.get("outliers", dict()).get("summary", list()):
+            return True
+
+        saved_outlier_key = (outlier.doc["_index"], outlier.doc["_id"], summary)
+        with self.saved_outliers_lock:
+            if saved_outlier_key in self.saved_outliers:
+                return True
+            self.saved_outliers.add(saved_outlier_key)
+        return False
+
+    def _coalesce_outlier_update(self, doc, outlier_dict_of_arrays):
+        """
+        Keep an outlier in memory until the outlier updates are flushed, merged with the other outliers of the same
+        document, so that a single update is written per document
+
+        :param doc: the document of the outlier
+        :param outlier_dict_of_arrays: outlier dictionary where all values are lists
+        """
+        max_documents = self.settings.config.getint("general", "es_coalesce_max_documents", fallback=10000)
+
+        with self.pending_outlier_updates_lock:
+            pending_outlier_update = self.pending_outlier_updates.get((doc["_index"], doc["_id"]))
+            if pending_outlier_update is None:
+                self.pending_outlier_updates[(doc["_index"], doc["_id"])] = (doc, [outlier_dict_of_arrays])
+            else:
+                pending_doc, outlier_dicts = pending_outlier_update
+                # another use case can have flagged its own copy of the document
+                if pending_doc is not doc:
+                    add_outlier_dict_to_document(pending_doc, outlier_dict_of_arrays)
+                outlier_dicts.append(outlier_dict_of_arrays)
+
+            should_flush = len(self.pending_outlier_updates) >= max_documents
+
+        if should_flush:
+            self.flush_outlier_updates()
+
+    def get_coalesced_use_cases(self):
+        """
+        Get the use cases of which outliers are kept in memory until the outlier updates are flushed
+
+        :return: set of (model type, model name) tuples
+        """
+        with self.pending_outlier_updates_lock:
+            return {(model_type, model_name)
+                    for _, outlier_dicts in self.pending_outlier_updates.values()
+                    for outlier_dict in outlier_dicts
+                    for model_type, model_name in zip(outlier_dict.get("model_type", list()),
+                                                      outlier_dict.get("model_name", list()))}
+
+    def flush_outlier_updates(self):
+        """
+        Add the bulk actions of all coalesced outlier updates, one per document
+        """
+        with self.pending_outlier_updates_lock:
+            pending_outlier_updates = self.pending_outlier_updates
+            self.pending_outlier_updates = dict()
+
+        if not pending_outlier_updates:
+            return
+
+        for doc, outlier_dicts in pending_outlier_updates.values():
+            if self._use_partial_update(doc):
+                self.add_outliers_bulk_action(doc, outlier_dicts)
+            else:
+                self.add_update_bulk_action(doc)
 
     def extract_derived_fields(self, doc_fields):
         """
@@ -516,6 +1995,49 @@ class ES:
 
         return derived_fields
 
+    def complete_document_source(self, doc, extract_derived_fields=False):
+        """
+        Replace the partial source of a document that was scanned with only a subset of its fields by its complete
+        source. The document is modified in place, so it is only fetched once even if it is linked to multiple outliers.
+
+        :param doc: document that was scanned with a partial source
+        :param extract_derived_fields: True to extract derived fields from the complete source
+        :return: the completed document
+        """
+        self.complete_documents_source([doc], extract_derived_fields=extract_derived_fields)
+        return doc
+
+    def complete_documents_source(self, docs, extract_derived_fields=False):
+        """
+        Replace the partial source of documents that were scanned with only a subset of their fields by their
+        complete source, fetching the documents of all indices with one multi get request per
+        COMPLETE_DOCUMENTS_MGET_SIZE documents. Documents that are already complete are skipped.
+
+        :param docs: documents that were scanned with a partial source
+        :param extract_derived_fields: True to extract derived fields from the complete source
+        """
+        # the same document can be given several times, it is only fetched once
+        incomplete_docs = defaultdict(list)
+        for doc in docs:
+            if not doc.get("_source_complete"):
+                incomplete_docs[(doc["_index"], doc["_id"])].append(doc)
+        doc_keys = list(incomplete_docs.keys())
+
+        for i in range(0, len(doc_keys), self.COMPLETE_DOCUMENTS_MGET_SIZE):
+            batch_keys = doc_keys[i:i + self.COMPLETE_DOCUMENTS_MGET_SIZE]
+            result = self.conn.mget(body={"docs": [{"_index": doc_index, "_id": doc_id}
+                                                   for doc_index, doc_id in batch_keys]})
+
+            for doc_key, complete_doc in zip(batch_keys, result["docs"]):
+                for doc in incomplete_docs[doc_key]:
+                    if complete_doc.get("found"):
+                        doc["_source"] = copy.deepcopy(complete_doc["_source"])
+                        self.extract_fields_from_document(doc, extract_derived_fields=extract_derived_fields)
+                    else:
+                        self.logging.logger.debug("could not fetch complete document %s, keeping partial source",
+                                                  doc["_id"])
+                    doc["_source_complete"] = True
+
     def extract_fields_from_document(self, doc, extract_derived_fields=False):
         """
         Extract fields information of a document (and also extract derived field if specified)
@@ -534,10 +2056,21 @@ class ES:
 
         return doc_fields
 
-    @staticmethod
-    def get_time_filter(start_time=None, end_time=None, days=None, hours=None, timestamp_field=DEFAULT_TIMESTAMP_FIELD):
+    def get_run_end_time(self):
+        """
+        Get the time up to which the events of the current run are processed
+
+        :return: the end time of the run, or the current time if no run was started
         """
-        Create a filter to limit the time
+        if self.run_end_time is None:
+            return dt.datetime.now()
+        return self.run_end_time
+
+    def get_time_filter(self, start_time=None, end_time=None, days=None, hours=None,
+                        timestamp_field=DEFAULT_TIMESTAMP_FIELD):
+        """
+        Create a filter to limit the time. Without start and end time, the filter covers the given number of days
+        and hours up to the end time of the run.
 
         :param start_time: start time
         :param end_time: end time
@@ -547,8 +2080,8 @@ class ES:
         :return: the query
         """
         if start_time is None or end_time is None:
-            start_time = (dt.datetime.now() - dt.timedelta(days=days, hours=hours))
-            end_time = dt.datetime.now()
+            end_time = self.get_run_end_time()
+            start_time = end_time - dt.timedelta(days=days, hours=hours)
 
         start_time_iso = start_time.isoformat()
         end_time_iso = end_time.isoformat()
@@ -587,6 +2120,19 @@ class ES:
         return highlight_settings
 
 
+def get_outlier_record_id(outlier):
+    """
+    Compute the id of the record of an outlier in the outliers index, from the event and the use case that flagged it
+    and the outlier summary, so that each run computes the same id for the same outlier
+
+    :param outlier: the outlier of which the record is indexed
+    :return: the id of the record
+    """
+    record_key = json.dumps([outlier.doc["_index"], outlier.doc["_id"], outlier.outlier_dict.get("model_name"),
+                             outlier.outlier_dict.get("summary")], default=str)
+    return hashlib.sha256(record_key.encode("utf-8")).hexdigest()
+
+
 def add_outlier_to_document(outlier):
     """
     Add outliers information to a document (this method also add tag to the document)
@@ -594,13 +2140,25 @@ def add_outlier_to_document(outlier):
     :param outlier: the outlier that need to be added (note that document is contain in the outlier)
     :return: the modified document
     """
-    doc = add_tag_to_document(outlier.doc, "outlier")
+    return add_outlier_dict_to_document(outlier.doc, outlier.get_outlier_dict_of_arrays())
+
+
+def add_outlier_dict_to_document(doc, outlier_dict_of_arrays):
+    """
+    Add the information of an outlier to a document, unless an outlier with the same summary is already present (this
+    method also add tag to the document)
+
+    :param doc: document that need to be modified
+    :param outlier_dict_of_arrays: outlier dictionary where all values are lists
+    :return: the modified document
+    """
+    doc = add_tag_to_document(doc, "outlier")
 
     if "outliers" in doc["_source"]:
-        if outlier.outlier_dict["summary"] not in doc["_source"]["outliers"]["summary"]:
+        if outlier_dict_of_arrays["summary"][0] not in doc["_source"]["outliers"]["summary"]:
             merged_outliers = defaultdict(list)
             for outlier_key, outlier_value in chain(doc["_source"]["outliers"].items(),
-                                                    outlier.get_outlier_dict_of_arrays().items()):
+                                                    outlier_dict_of_arrays.items()):
 
                 # merge ["reason 1"] and ["reason 2"]] into ["reason 1", "reason 2"]
                 if isinstance(outlier_value, list):
@@ -611,7 +2169,7 @@ def add_outlier_to_document(outlier):
             merged_outliers["total_outliers"] = doc["_source"]["outliers"]["total_outliers"] + 1
             doc["_source"]["outliers"] = merged_outliers
     else:
-        doc["_source"]["outliers"] = outlier.get_outlier_dict_of_arrays()
+        doc["_source"]["outliers"] = dict(outlier_dict_of_arrays)
         doc["_source"]["outliers"]["total_outliers"] = 1
 
     return doc
@@ -710,30 +2268,318 @@ def build_search_query(bool_clause=None,
     return query
 
 
+def get_index_time_range_from_name(index_name, index_date_format):
+    """
+    Get the time range covered by an index from the date at the end of its name, such as logstash-2020.01.31 for the
+    date format %Y.%m.%d. The time range spans the smallest unit of the date format.
+
+    :param index_name: name of the index
+    :param index_date_format: strftime format of the date at the end of the index names (%Y, %m, %d and %H)
+    :return: tuple with the start and end time of the index, or (None, None) if the index name doesn't end with a date
+    """
+    date_regex = ""
+    for format_part in re.split(r"(%[YmdH])", index_date_format):
+        if format_part == "%Y":
+            date_regex += r"\d{4}"
+        elif format_part in ("%m", "%d", "%H"):
+            date_regex += r"\d{2}"
+        else:
+            date_regex += re.escape(format_part)
+
+    match = re.search("(" + date_regex + ")$", index_name)
+    if match is None:
+        return None, None
+    try:
+        start_time = dt.datetime.strptime(match.group(1), index_date_format)
+    except ValueError:
+        return None, None
+
+    if "%H" in index_date_format:
+        end_time = start_time + dt.timedelta(hours=1)
+    elif "%d" in index_date_format:
+        end_time = start_time + dt.timedelta(days=1)
+    elif "%m" in index_date_format:
+        end_time = (start_time.replace(day=28) + dt.timedelta(days=4)).replace(day=1)
+    else:
+        end_time = start_time.replace(year=start_time.year + 1)
+    return start_time, end_time - dt.timedelta(microseconds=1)
+
+
+def merge_docvalue_fields_into_source(documents):
+    """
+    Add the values of the fields read from doc values to the source of scanned documents, so that they can be
+    processed like documents scanned with their source. Fields with a single value get this value, fields with
+    multiple values get the list of their values.
+
+    :param documents: generator of scanned documents
+    :return: generator of documents
+    """
+    for doc in documents:
+        source = doc.get("_source") or dict()
+        for field_name, values in doc.pop("fields", dict()).items():
+            field_source = source
+            *parent_keys, key = field_name.split(".")
+            for parent_key in parent_keys:
+                if not isinstance(field_source.get(parent_key), dict):
+                    field_source[parent_key] = dict()
+                field_source = field_source[parent_key]
+            field_source[key] = values[0] if len(values) == 1 else values
+        doc["_source"] = source
+        yield doc
+
+
+def get_aligned_time(time, rounding):
+    """
+    Round a time down to a multiple of a number of seconds (since midnight, for roundings dividing a day)
+
+    :param time: the time
+    :param rounding: number of seconds, or 0 to keep the time unchanged
+    :return: the rounded time
+    """
+    if rounding <= 0:
+        return time
+    elapsed_time = time - dt.datetime.min
+    seconds = elapsed_time.days * 86400 + elapsed_time.seconds
+    return dt.datetime.min + dt.timedelta(seconds=seconds - seconds % rounding)
+
+
+def get_retry_backoff(retries):
+    """
+    Get the time to wait before retrying a request: an exponential backoff, with a random jitter so that threads
+    retrying at the same time don't all hit Elasticsearch again at once
+
+    :param retries: number of times the request has been retried, including the upcoming retry
+    :return: time to wait in seconds
+    """
+    return min(60, 2 ** retries) * random.uniform(0.5, 1)
+
+
+def merge_generators_concurrently(generators, max_queue_size=0):
+    """
+    Consume multiple generators concurrently (one thread per generator) and merge their items into a single
+    generator. Items are returned in the order in which they are produced, so no ordering is guaranteed between the
+    different generators. An exception raised by one of the generators is raised again to the consumer.
+
+    :param generators: list of generators to consume
+    :param max_queue_size: maximum number of items waiting to be consumed, 0 for no limit
+    :return: generator returning the items of all generators
+    """
+    items_queue = queue.Queue(maxsize=max_queue_size)
+    stop_event = threading.Event()
+
+    def _put(item):
+        # don't block forever if the consumer stopped before all the items were consumed
+        while not stop_event.is_set():
+            try:
+                items_queue.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _consume(generator):
+        try:
+            for item in generator:
+                if not _put(item):
+                    return
+        except Exception as e:  # pylint: disable=broad-except
+            _put(e)
+        _put(END_OF_SCAN)
+
+    for generator in generators:
+        threading.Thread(target=_consume, args=(generator,), daemon=True).start()
+
+    remaining_generators = len(generators)
+    try:
+        while remaining_generators > 0:
+            item = items_queue.get()
+            if item is END_OF_SCAN:
+                remaining_generators -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield item
+    finally:
+        stop_event.set()
+
+
+def prefetch_generator(generator, page_size, max_pages, max_bytes=0):
+    """
+    Consume a generator in a background thread, keeping pages of its items ready for the consumer. The generator is
+    consumed ahead until max_pages pages are waiting, or until the estimated size of the waiting pages would exceed
+    max_bytes. Items are returned in the order of the generator, and an exception raised by the generator is raised
+    again to the consumer.
+
+    :param generator: generator to consume
+    :param page_size: number of items per page
+    :param max_pages: maximum number of pages waiting to be consumed
+    :param max_bytes: maximum estimated size in bytes of the pages waiting to be consumed, 0 for no limit
+    :return: generator returning the items of the generator
+    """
+    pages = deque()
+    pages_condition = threading.Condition()
+    stop_event = threading.Event()
+    waiting_bytes = [0]
+
+    def _put(page, page_bytes=0):
+        with pages_condition:
+            # a page is always accepted when no page is waiting, even if it exceeds the size limit on its own
+            while not stop_event.is_set() and pages and \
+                    (len(pages) >= max_pages or (max_bytes > 0 and waiting_bytes[0] + page_bytes > max_bytes)):
+                pages_condition.wait(timeout=1)
+            if stop_event.is_set():
+                return False
+            pages.append((page, page_bytes))
+            waiting_bytes[0] += page_bytes
+            pages_condition.notify_all()
+            return True
+
+    def _estimate_page_bytes(page):
+        # serializing the first item only keeps the estimation cheap, items of a page usually have a similar size
+        if max_bytes <= 0:
+            return 0
+        return len(json.dumps(page[0], default=str)) * len(page)
+
+    def _read_ahead():
+        try:
+            page = list()
+            for item in generator:
+                page.append(item)
+                if len(page) >= page_size:
+                    if not _put(page, _estimate_page_bytes(page)):
+                        return
+                    page = list()
+            if page and not _put(page, _estimate_page_bytes(page)):
+                return
+            _put(END_OF_SCAN)
+        except Exception as e:  # pylint: disable=broad-except
+            _put(e)
+        finally:
+            # release the resources of the generator (scroll context, point in time) if the consumer stopped early
+            if hasattr(generator, "close"):
+                generator.close()
+
+    threading.Thread(target=_read_ahead, daemon=True).start()
+
+    try:
+        while True:
+            with pages_condition:
+                while not pages:
+                    pages_condition.wait()
+                page, page_bytes = pages.popleft()
+                waiting_bytes[0] -= page_bytes
+                pages_condition.notify_all()
+
+            if page is END_OF_SCAN:
+                return
+            if isinstance(page, Exception):
+                raise page
+            yield from page
+    finally:
+        stop_event.set()
+        with pages_condition:
+            pages_condition.notify_all()
+
+
+def chain_generators_concurrently(generators, max_queue_size=0):
+    """
+    Consume multiple generators concurrently (one thread per generator) and return all items of the first generator,
+    then all items of the second generator, and so on. Each generator is consumed ahead until max_queue_size of its
+    items are waiting. An exception raised by one of the generators is raised again to the consumer when its items
+    are reached.
+
+    :param generators: list of generators to consume
+    :param max_queue_size: maximum number of items of each generator waiting to be consumed, 0 for no limit
+    :return: generator returning the items of all generators, in the order of the generators
+    """
+    items_queues = [queue.Queue(maxsize=max_queue_size) for _ in generators]
+    stop_event = threading.Event()
+
+    def _put(items_queue, item):
+        # don't block forever if the consumer stopped before all the items were consumed
+        while not stop_event.is_set():
+            try:
+                items_queue.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _consume(generator, items_queue):
+        try:
+            for item in generator:
+                if not _put(items_queue, item):
+                    return
+        except Exception as e:  # pylint: disable=broad-except
+            _put(items_queue, e)
+        finally:
+            # release the resources of the generator (scroll context, point in time) if the consumer stopped early
+            if hasattr(generator, "close"):
+                generator.close()
+        _put(items_queue, END_OF_SCAN)
+
+    for generator, items_queue in zip(generators, items_queues):
+        threading.Thread(target=_consume, args=(generator, items_queue), daemon=True).start()
+
+    try:
+        for items_queue in items_queues:
+            while True:
+                item = items_queue.get()
+                if item is END_OF_SCAN:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+    finally:
+        stop_event.set()
+
+
+def split_time_filter(search_range, partitions):
+    """
+    Split the time range of a filter built by ES.get_time_filter in contiguous partitions of the same duration
+
+    :param search_range: the time filter
+    :param partitions: number of partitions
+    :return: list of time filters, in chronological order
+    """
+    timestamp_field, time_range = next(iter(search_range["range"].items()))
+    start_time = dateutil.parser.parse(time_range["gte"])
+    end_time = dateutil.parser.parse(time_range["lte"])
+    partition_duration = (end_time - start_time) / partitions
+    if partition_duration <= dt.timedelta(0):
+        return [search_range]
+
+    partition_ranges = list()
+    for i in range(partitions):
+        partition_range = {"gte": (start_time + partition_duration * i).isoformat()}
+        # boundaries belong to the next partition, so that no document is returned twice
+        if i < partitions - 1:
+            partition_range["lt"] = (start_time + partition_duration * (i + 1)).isoformat()
+        else:
+            partition_range["lte"] = time_range["lte"]
+        partition_ranges.append({"range": {timestamp_field: partition_range}})
+    partition_ranges[0]["range"][timestamp_field]["gte"] = time_range["gte"]
+    return partition_ranges
+
+
 def build_first_occur_search_query(search_query,
                                    search_range,
                                    target_list,
                                    aggregator_list,
                                    timestamp,
-                                   max_num_aggs,
-                                   max_num_targets):
+                                   composite_size):
     """
-    Build specific Elasticsearch query for retrieving aggregation of first occurrence of a term field in events matching
-    with the search_query.
+    Build specific Elasticsearch query for retrieving a page of the combinations of aggregator and target values of
+    events matching with the search_query, with the time of their first and last occurrence.
 
     :param search_query: search query
     :param search_range: search range
     :param target_list: list of target fields
     :param aggregator_list: list of fields that we want to aggregate
     :param timestamp: timestamp field name
-    :param max_num_aggs: number maximum of estimate aggregation
-    :param max_num_targets: number maximum of estimate targets
+    :param composite_size: number of combinations per page
     :return: the build Elasticsearch query
     """
-    order_dict = dict()
-    order_dict[timestamp] = dict()
-    order_dict[timestamp]["order"] = "asc"
-
     filter_list = list()
     filter_list.append(search_range)
 
@@ -742,6 +2588,8 @@ def build_first_occur_search_query(search_query,
 
     filter_list.extend(copy.deepcopy(search_query["filter"]))
 
+    sources = [{"field_" + str(i): {"terms": {"field": field}}} for i, field in enumerate(aggregator_list + target_list)]
+
     query = {"size": 0,
              "query": {
                  "bool": {
@@ -749,26 +2597,20 @@ def build_first_occur_search_query(search_query,
                  }
              },
              "aggs": {
-                 "aggregator": {
-                     "terms": {
-                         "script": build_script(aggregator_list),
-                         "size": max_num_aggs,
-                         "collect_mode": "breadth_first"
+                 "first_occur": {
+                     "composite": {
+                         "size": composite_size,
+                         "sources": sources
                      },
                      "aggs": {
-                         "target": {
-                             "terms": {
-                                 "script": build_script(target_list),
-                                 "size": max_num_targets,
-                                 "collect_mode": "breadth_first"
-                             },
-                             "aggs": {
-                                 "top_doc": {
-                                     "top_hits": {
-                                         "sort": [order_dict],
-                                         "size": 1
-                                     }
-                                 }
+                         "first_occur_time": {
+                             "min": {
+                                 "field": timestamp
+                             }
+                         },
+                         "last_occur_time": {
+                             "max": {
+                                 "field": timestamp
                              }
                          }
                      }
@@ -778,6 +2620,22 @@ def build_first_occur_search_query(search_query,
     return query
 
 
+def _is_first_occur_after(first_occur_bucket, first_occur_start_time):
+    """
+    Check if a combination of aggregator and target values may have occurred for the first time after a given time.
+    Elasticsearch rounds the time of the first occurrence to the millisecond, so the combinations that occurred for the
+    first time during the millisecond of the given time are included.
+
+    :param first_occur_bucket: combination returned by ES.scan_first_occur_documents
+    :param first_occur_start_time: the time, or None
+    :return: True if the combination may have occurred for the first time after the given time
+    """
+    if first_occur_start_time is None:
+        return True
+    return first_occur_bucket["first_occur_time"] >= first_occur_start_time.replace(
+        microsecond=first_occur_start_time.microsecond // 1000 * 1000)
+
+
 def build_aggr_and_target_exists_query(target_list, aggregator_list):
     """
     Build query to select events where fields defined in target_list and aggregator_list exist.
@@ -791,13 +2649,3 @@ def build_aggr_and_target_exists_query(target_list, aggregator_list):
     query = " AND ".join(["_exists_: " + field for field in field_list])
     aggr_and_target_exists_query = {"query_string": {"query": query}}
     return aggr_and_target_exists_query
-
-
-def build_script(field_list):
-    """
-    Build painless script to create aggregation from multiple fields
-
-    :param field_list: list of event field
-    :return:  painless script format
-    """
-    return " + ' - ' + ".join(["doc['" + field + "'].value" for field in field_list])
@@ -0,0 +1,98 @@
+import datetime as dt
+import os
+import sqlite3
+
+
+class FirstSeenStore:
+    """
+    On-disk store of the first and last time each combination of aggregator and target values of a use case was seen,
+    and of the last time up to which the events of each use case were processed. It allows a use case to only process
+    the events that are new since its previous run, while remembering all combinations seen before.
+    """
+
+    STORE_FILE_NAME = "first_seen.sqlite"
+    TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+    # use cases evaluated concurrently share the store file: time in seconds a use case waits for another one to
+    # finish writing, before failing with "database is locked"
+    BUSY_TIMEOUT = 300
+
+    def __init__(self, state_directory):
+        """
+        :param state_directory: directory in which the store file is kept, created if it doesn't exist
+        """
+        os.makedirs(state_directory, exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(state_directory, self.STORE_FILE_NAME), timeout=self.BUSY_TIMEOUT)
+        # with write-ahead logging, looking up combinations doesn't block the use cases saving theirs
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS first_seen (use_case TEXT, aggregator TEXT, target TEXT, "
+                          "first_seen TEXT, last_seen TEXT, PRIMARY KEY (use_case, aggregator, target))")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS processed (use_case TEXT PRIMARY KEY, last_processed TEXT)")
+        # combinations looked up at once by joining them with the saved combinations
+        self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS lookup (position INTEGER, aggregator TEXT, target TEXT)")
+        self.conn.commit()
+
+    def get_last_processed_time(self, use_case):
+        """
+        Get the time up to which the events of a use case were processed
+
+        :param use_case: name of the use case
+        :return: the time, or None if the events of the use case were never processed
+        """
+        row = self.conn.execute("SELECT last_processed FROM processed WHERE use_case = ?", (use_case,)).fetchone()
+        if row is None:
+            return None
+        return dt.datetime.strptime(row[0], self.TIME_FORMAT)
+
+    def set_last_processed_time(self, use_case, last_processed_time):
+        """
+        Save the time up to which the events of a use case were processed
+
+        :param use_case: name of the use case
+        :param last_processed_time: the time
+        """
+        self.conn.execute("INSERT OR REPLACE INTO processed (use_case, last_processed) VALUES (?, ?)",
+                          (use_case, last_processed_time.strftime(self.TIME_FORMAT)))
+        self.conn.commit()
+
+    def get_seen_combinations(self, use_case, combinations):
+        """
+        Get the combinations of aggregator and target values that were already seen
+
+        :param use_case: name of the use case
+        :param combinations: list of tuples with an aggregator value and a target value
+        :return: set of the given combinations that were already seen
+        """
+        combinations = list(combinations)
+        self.conn.executemany("INSERT INTO lookup (position, aggregator, target) VALUES (?, ?, ?)",
+                              ((position, aggregator, target)
+                               for position, (aggregator, target) in enumerate(combinations)))
+        # the positions give back the combinations as they were given, the values are stored as text
+        rows = self.conn.execute("SELECT lookup.position FROM lookup JOIN first_seen "
+                                 "ON first_seen.use_case = ? AND first_seen.aggregator = lookup.aggregator "
+                                 "AND first_seen.target = lookup.target", (use_case,)).fetchall()
+        self.conn.execute("DELETE FROM lookup")
+        self.conn.commit()
+        return {combinations[position] for position, in rows}
+
+    def add_occurrences(self, use_case, occurrences):
+        """
+        Save occurrences of combinations of aggregator and target values, keeping the earliest first seen time and the
+        latest last seen time of each combination
+
+        :param use_case: name of the use case
+        :param occurrences: list of tuples with an aggregator value, a target value, the time of the first occurrence
+        and the time of the last occurrence
+        """
+        rows = [(first_seen.strftime(self.TIME_FORMAT), last_seen.strftime(self.TIME_FORMAT), use_case, aggregator,
+                 target) for aggregator, target, first_seen, last_seen in occurrences]
+        self.conn.executemany("INSERT OR IGNORE INTO first_seen (first_seen, last_seen, use_case, aggregator, target) "
+                              "VALUES (?, ?, ?, ?, ?)", rows)
+        self.conn.executemany("UPDATE first_seen SET first_seen = MIN(first_seen, ?), last_seen = MAX(last_seen, ?) "
+                              "WHERE use_case = ? AND aggregator = ? AND target = ?", rows)
+        self.conn.commit()
+
+    def close(self):
+        """
+        Close the store file
+        """
+        self.conn.close()
@@ -1,5 +1,6 @@
 import math
 import logging
+import threading
 from logging.handlers import WatchedFileHandler
 
 import datetime as dt
@@ -8,6 +9,23 @@ import urllib3
 from helpers.singleton import singleton
 
 
+def _ticker_property(name):
+    """
+    Create a property of which the value is stored per thread, so that analyzers running in different threads each
+    have their own ticker
+
+    :param name: name of the ticker attribute
+    :return: the property
+    """
+    def getter(self):
+        return getattr(self.ticker_state, name, None)
+
+    def setter(self, value):
+        setattr(self.ticker_state, name, value)
+
+    return property(getter, setter)
+
+
 @singleton
 class Logging:
     """
@@ -15,10 +33,11 @@ class Logging:
     """
     logger = None
 
-    current_step = None
-    start_time = None
-    total_steps = None
-    desc = None
+    ticker_state = threading.local()
+    current_step = _ticker_property("current_step")
+    start_time = _ticker_property("start_time")
+    total_steps = _ticker_property("total_steps")
+    desc = _ticker_property("desc")
     verbosity = 0
 
     def __init__(self, logger_name):
@@ -52,7 +71,7 @@ class Logging:
     def init_ticker(self, total_steps=None, desc=None):
         """
         Initialize a ticker.
-        Warning: this method is not independant. Call it only one at a time
+        Each thread has its own ticker, but within a thread only one ticker can be used at a time
 
         :param total_steps: number of total step
         :param desc: description of the ticker
@@ -0,0 +1,44 @@
+from elasticsearch.serializer import JSONSerializer
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY if orjson is not None else None
+
+
+def is_fast_json_available():
+    """
+    Check if the fast JSON library is installed
+
+    :return: True if orjson can be used to serialize and deserialize JSON
+    """
+    return orjson is not None
+
+
+class FastJSONSerializer(JSONSerializer):
+    """
+    Serializer of the requests and responses of Elasticsearch, using orjson when it is installed and the json module
+    of the standard library otherwise. Data that orjson can't handle, such as integers bigger than 64 bits, is
+    handled by the json module.
+    """
+
+    def loads(self, s):
+        if orjson is not None:
+            try:
+                return orjson.loads(s)
+            except orjson.JSONDecodeError:
+                pass
+        return super(FastJSONSerializer, self).loads(s)
+
+    def dumps(self, data):
+        # don't serialize strings
+        if isinstance(data, str) or orjson is None:
+            return super(FastJSONSerializer, self).dumps(data)
+
+        try:
+            # the body of bulk requests is built by joining serialized strings
+            return orjson.dumps(data, default=self.default, option=ORJSON_OPTIONS).decode("utf-8")
+        except orjson.JSONEncodeError:
+            return super(FastJSONSerializer, self).dumps(data)
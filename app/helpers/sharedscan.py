@@ -0,0 +1,247 @@
+import copy
+import queue
+import threading
+
+from helpers.singletons import settings, es, logging
+from helpers.es import END_OF_SCAN, SHARED_DOCUMENT_KEY
+
+# analyzers that scan all the documents of their time window, and can thus consume documents from a shared scan
+SHARED_SCAN_MODEL_TYPES = {"terms", "metrics", "word2vec", "simplequery"}
+
+
+def plan_shared_scans(analyzers):
+    """
+    Group the analyzers that scan the same index over the same time window, so that the documents of all analyzers
+    of a group can be fetched with a single scan
+
+    :param analyzers: list of analyzers to evaluate
+    :return: list of shared scans, and list of analyzers that need to be evaluated separately
+    """
+    analyzer_groups = dict()
+    separate_analyzers = list()
+
+    for analyzer in analyzers:
+        if not _can_share_scan(analyzer):
+            separate_analyzers.append(analyzer)
+            continue
+
+        group_key = (analyzer.model_settings["es_index"],
+                     analyzer.model_settings["history_window_days"],
+                     analyzer.model_settings["history_window_hours"],
+                     analyzer.model_settings["timestamp_field"],
+                     analyzer.model_settings["process_documents_chronologically"])
+        analyzer_groups.setdefault(group_key, list()).append(analyzer)
+
+    shared_scans = list()
+    for group in analyzer_groups.values():
+        if len(group) > 1:
+            shared_scans.append(SharedScan(group))
+        else:
+            separate_analyzers.extend(group)
+
+    return shared_scans, separate_analyzers
+
+
+def _can_share_scan(analyzer):
+    """
+    Check if the documents of an analyzer can be fetched through a shared scan. Analyzers pushing their
+    aggregations down to Elasticsearch, or letting Elasticsearch add their outliers, don't scan all their documents.
+
+    :param analyzer: the analyzer to check
+    :return: True if the analyzer can be part of a shared scan
+    """
+    return analyzer.model_settings["es_shared_scan"] and analyzer.model_type in SHARED_SCAN_MODEL_TYPES and \
+        not analyzer.model_settings.get("highlight_match") and hasattr(analyzer, "search_query") and \
+        not analyzer.model_settings.get("aggregation_pushdown") and \
+        not analyzer.model_settings.get("server_side_tagging")
+
+
+class SharedScanFeed:
+    """
+    Queue of documents delivered by a shared scan to one of its analyzers
+    """
+
+    def __init__(self, max_queue_size=0):
+        self.total_documents = 0
+        self.error = None
+        self.documents_queue = queue.Queue(maxsize=max_queue_size)
+        self.closed = threading.Event()
+
+    def count_and_get_documents(self):
+        """
+        Get the documents of the analyzer, with the same interface as ES.count_and_scan_documents
+
+        :return: the number of documents and a generator/list of all documents
+        """
+        if self.error is not None:
+            raise self.error
+
+        if self.total_documents > 0:
+            return self.total_documents, self._get_documents()
+        return self.total_documents, []
+
+    def _get_documents(self):
+        """
+        Generator returning the documents put in the feed until the end of the shared scan
+
+        :return: generator to fetch documents
+        """
+        while True:
+            document = self.documents_queue.get()
+            if document is END_OF_SCAN:
+                return
+            if isinstance(document, Exception):
+                raise document
+            yield document
+
+    def put(self, document):
+        """
+        Add a document to the feed, waiting for the analyzer to consume documents if the feed is full.
+        Documents added once the feed is closed are dropped.
+
+        :param document: the document to add
+        """
+        while not self.closed.is_set():
+            try:
+                self.documents_queue.put(document, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def close(self):
+        """
+        Close the feed, once the analyzer doesn't consume documents anymore
+        """
+        self.closed.set()
+
+
+class SharedScan:
+    """
+    Scan the documents of a group of analyzers once, by combining the search queries of all analyzers in named
+    queries. Each analyzer is evaluated in its own thread, and each scanned document is dispatched to the analyzers
+    of which the search query matched the document.
+    """
+
+    def __init__(self, analyzers):
+        self.analyzers = analyzers
+
+        self.model_settings = dict(analyzers[0].model_settings)
+        self.model_settings["es_scan_slices"] = max(analyzer.model_settings["es_scan_slices"]
+                                                    for analyzer in analyzers)
+        self.model_settings["es_scan_time_partitions"] = max(analyzer.model_settings["es_scan_time_partitions"]
+                                                             for analyzer in analyzers)
+        self.model_settings["es_docvalue_fields"] = all(analyzer.model_settings["es_docvalue_fields"]
+                                                        for analyzer in analyzers)
+
+        self.search_queries = {analyzer.config_section_name: analyzer.get_search_query() for analyzer in analyzers}
+        self.feeds = dict()
+
+    def run(self, evaluate_analyzer):
+        """
+        Scan the documents and evaluate all analyzers of the shared scan
+
+        :param evaluate_analyzer: function evaluating a single analyzer
+        """
+        logging.logger.info("scanning %d use cases at once on index %s", len(self.analyzers),
+                            self.model_settings["es_index"])
+
+        search_range = es.get_time_filter(days=self.model_settings["history_window_days"],
+                                          hours=self.model_settings["history_window_hours"],
+                                          timestamp_field=self.model_settings["timestamp_field"])
+
+        max_queue_size = settings.config.getint("general", "es_scan_size", fallback=10000)
+        self.feeds = {name: SharedScanFeed(max_queue_size) for name in self.search_queries}
+
+        try:
+            total_documents = es.count_documents_per_search_query(index=self.model_settings["es_index"],
+                                                                  search_range=search_range,
+                                                                  search_queries=self.search_queries)
+            for name, feed in self.feeds.items():
+                feed.total_documents = total_documents.get(name, 0)
+        except Exception as e:  # pylint: disable=broad-except
+            # each analyzer will handle the error as if it happened while scanning its own documents
+            for feed in self.feeds.values():
+                feed.error = e
+
+        analyzer_threads = list()
+        for analyzer in self.analyzers:
+            analyzer_thread = threading.Thread(target=self._evaluate_analyzer,
+                                               args=(analyzer, evaluate_analyzer))
+            analyzer_thread.start()
+            analyzer_threads.append(analyzer_thread)
+
+        if any(feed.total_documents > 0 for feed in self.feeds.values()):
+            self._dispatch_documents(search_range)
+
+        for analyzer_thread in analyzer_threads:
+            analyzer_thread.join()
+
+    def _evaluate_analyzer(self, analyzer, evaluate_analyzer):
+        """
+        Evaluate an analyzer on the documents of its feed
+
+        :param analyzer: the analyzer to evaluate
+        :param evaluate_analyzer: function evaluating a single analyzer
+        """
+        feed = self.feeds[analyzer.config_section_name]
+        analyzer.shared_scan_feed = feed
+        try:
+            evaluate_analyzer(analyzer)
+        finally:
+            feed.close()
+            analyzer.shared_scan_feed = None
+
+    def _dispatch_documents(self, search_range):
+        """
+        Scan the documents matching at least one of the search queries, and add each document to the feed of the
+        analyzers of which the search query matched
+
+        :param search_range: the range of the search
+        """
+        named_queries = [{"bool": {"filter": copy.deepcopy(search_query["filter"]), "_name": name}}
+                         for name, search_query in self.search_queries.items()]
+        shared_search_query = {"filter": [{"bool": {"should": named_queries, "minimum_should_match": 1}}]}
+
+        source_includes = self._get_source_includes()
+
+        try:
+            documents = es._scan(self.model_settings["es_index"], search_range,  # pylint: disable=protected-access
+                                 query_fields=source_includes,
+                                 search_query=shared_search_query, model_settings=self.model_settings)
+
+            for doc in documents:
+                feeds = [self.feeds[name] for name in doc.get("matched_queries", list())
+                         if name in self.feeds and not self.feeds[name].closed.is_set()]
+                if not feeds:
+                    if all(feed.closed.is_set() for feed in self.feeds.values()):
+                        break
+                    continue
+
+                # analyzers modify the documents they process, so each one needs its own copy
+                if len(feeds) > 1:
+                    doc[SHARED_DOCUMENT_KEY] = True
+                docs = [doc] + [copy.deepcopy(doc) for _ in feeds[1:]]
+                for feed, feed_doc in zip(feeds, docs):
+                    feed.put(feed_doc)
+
+        except Exception as e:  # pylint: disable=broad-except
+            for feed in self.feeds.values():
+                feed.put(e)
+
+        for feed in self.feeds.values():
+            feed.put(END_OF_SCAN)
+
+    def _get_source_includes(self):
+        """
+        Combine the fields needed by all analyzers of the shared scan
+
+        :return: list of fields to include in the scanned documents, or None if the complete documents must be scanned
+        """
+        source_includes = list()
+        for analyzer in self.analyzers:
+            analyzer_source_includes = analyzer.get_source_includes()
+            if analyzer_source_includes is None:
+                return None
+            source_includes.extend(analyzer_source_includes)
+
+        return list(dict.fromkeys(source_includes))
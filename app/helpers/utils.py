@@ -358,6 +358,80 @@ def get_decision_frontier(trigger_method, values_array, trigger_sensitivity, tri
     return decision_frontier
 
 
+def get_decision_frontier_from_stats(trigger_method, stats, trigger_sensitivity, trigger_on=None):
+    """
+    Compute the decision frontier from statistics on the values instead of the values themselves, like the ones
+    computed by an Elasticsearch aggregation. Same computation as get_decision_frontier, except for the percentile
+    trigger method, which takes all values into account instead of the unique values.
+
+    :param trigger_method: method to be used to make this computation
+    :param stats: dictionary with the max, avg, std_deviation and mad of the values, and a dictionary with their
+    percentiles (including the median, the 50th percentile)
+    :param trigger_sensitivity: sensitivity
+    :param trigger_on: high or low
+    :return: the decision frontier
+    """
+    if trigger_method == "percentile":
+        decision_frontier = np.float64(stats["percentiles"][trigger_sensitivity])
+
+    elif trigger_method == "pct_of_max_value":
+        decision_frontier = np.float64(stats["max"] * (trigger_sensitivity / 100))
+
+    elif trigger_method == "pct_of_median_value":
+        decision_frontier = np.float64(stats["percentiles"][50] * (trigger_sensitivity / 100))
+
+    elif trigger_method == "pct_of_avg_value":
+        decision_frontier = np.float64(stats["avg"] * (trigger_sensitivity / 100))
+
+    elif trigger_method == "mad" or trigger_method == "madpos":
+        decision_frontier = _get_deviation_decision_frontier(stats["percentiles"][50], stats["mad"],
+                                                             trigger_sensitivity, trigger_on)
+
+        # special case - if MAD is zero, then we use stdev instead of MAD, since more than half of all values are equal
+        if decision_frontier == stats["percentiles"][50]:
+            decision_frontier = _get_deviation_decision_frontier(stats["avg"], stats["std_deviation"], 1, trigger_on)
+
+        # special case - if MADPOS is being used, we never want to return a negative MAD, so cap it at 0
+        if trigger_method == "madpos":
+            decision_frontier = np.float64(max([decision_frontier, 0]))
+
+    elif trigger_method == "stdev":
+        decision_frontier = _get_deviation_decision_frontier(stats["avg"], stats["std_deviation"],
+                                                             trigger_sensitivity, trigger_on)
+    elif trigger_method == "float":
+        decision_frontier = np.float64(trigger_sensitivity)
+    elif trigger_method == "coeff_of_variation":
+        # like the numpy division of get_decision_frontier, an average of 0 doesn't raise an error
+        decision_frontier = np.float64(stats["std_deviation"]) / np.float64(stats["avg"])
+    else:
+        raise ValueError("Unexpected trigger method " + trigger_method + ", could not calculate decision frontier")
+
+    if decision_frontier < 0:
+        # Could not do "from helpers.singletons import logging" due to circle import
+        helpers.singletons.logging.logger.debug("negative decision frontier %.2f, this will not generate any outliers",
+                                                decision_frontier)
+
+    return decision_frontier
+
+
+def _get_deviation_decision_frontier(center, deviation, trigger_sensitivity, trigger_on):
+    """
+    Compute a decision frontier at a number of deviations above or below a central value
+
+    :param center: the central value (mean or median)
+    :param deviation: the deviation (standard deviation or median absolute deviation)
+    :param trigger_sensitivity: sensitivity
+    :param trigger_on: high or low
+    :return: the decision frontier
+    """
+    if trigger_on == "high":
+        return np.float64(center + trigger_sensitivity * deviation)
+    elif trigger_on == "low":
+        return np.float64(center - trigger_sensitivity * deviation)
+    else:
+        raise ValueError("Unexpected trigger condition " + str(trigger_on) + ", could not calculate decision frontier")
+
+
 # Calculate percentile decision frontier
 # Example: values array is [0 5 10 20 30 2 5 5]
 # trigger_sensitivity is 10 (meaning: 10th percentile)
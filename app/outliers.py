@@ -1,4 +1,5 @@
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import random
 import time
@@ -17,6 +18,7 @@ import logging as base_logging
 from helpers.singletons import settings, logging, es
 from helpers.watchers import FileModificationWatcher
 from helpers.housekeeping import HousekeepingJob
+from helpers.sharedscan import plan_shared_scans
 from helpers.analyzerfactory import AnalyzerFactory
 from configparser import MissingSectionHeaderError, DuplicateSectionError, DuplicateOptionError
 
@@ -251,6 +253,9 @@ def perform_analysis(housekeeping_job):
     """ The entrypoint for analysis
     :return: List of analyzers that have been processed and analyzed
     """
+    # all use cases of the run process events up to the same time
+    es.start_new_run()
+
     analyzers = load_analyzers()
     housekeeping_job.update_analyzer_list(analyzers)
 
@@ -268,33 +273,128 @@ def perform_analysis(housekeeping_job):
     # shuffle will prevent this analyzer from blocking all the analyzers from running that come after it.
     random.shuffle(analyzers_to_evaluate)
 
+    # analyzers that scan the same index over the same time window can share a single scan of their documents
+    shared_scans, separate_analyzers = plan_shared_scans(analyzers_to_evaluate)
+
     # Now it's time actually evaluate all the models. We also make sure to add some information that will be useful
     # in the summary presented to the user at the end of running all the models.
-    for index, analyzer in enumerate(analyzers_to_evaluate):
-        try:
-            analyzer.analysis_start_time = datetime.today().timestamp()
-            analyzer.evaluate_model()
-            analyzer.analysis_end_time = datetime.today().timestamp()
-            analyzer.completed_analysis = True
-            es.flush_bulk_actions()
-
-            logging.logger.info("finished processing use case - %d / %d [%s%% done]", index + 1,
-                                len(analyzers_to_evaluate),
-                                '{:.2f}'.format(round((index + 1) / float(len(analyzers_to_evaluate)) * 100, 2)))
-        except elasticsearch.exceptions.NotFoundError:
-            analyzer.index_not_found_analysis = True
-            logging.logger.warning("index %s does not exist, skipping use case", analyzer.model_settings["es_index"])
-        except elasticsearch.helpers.BulkIndexError as e:
-            analyzer.unknown_error_analysis = True
-            logging.logger.error(f"BulkIndexError while analyzing use case: {e.args[0]}", exc_info=False)
-            logging.logger.debug("Full stack trace and error message of BulkIndexError", exc_info=True)
-        except Exception:  # pylint: disable=broad-except
-            analyzer.unknown_error_analysis = True
-            logging.logger.error("error while analyzing use case", exc_info=True)
+    max_concurrent_use_cases = settings.config.getint("general", "max_concurrent_use_cases", fallback=1)
+    if max_concurrent_use_cases > 1:
+        evaluate_analyzers_concurrently(shared_scans, separate_analyzers, max_concurrent_use_cases,
+                                        len(analyzers_to_evaluate))
+    else:
+        total_processed = 0
+        for shared_scan in shared_scans:
+            run_shared_scan(shared_scan)
+            total_processed += len(shared_scan.analyzers)
+            log_analysis_progress(total_processed, len(analyzers_to_evaluate))
+
+        for analyzer in separate_analyzers:
+            evaluate_analyzer(analyzer)
+            total_processed += 1
+            log_analysis_progress(total_processed, len(analyzers_to_evaluate))
+
+    # outliers of all use cases hitting the same document are written with a single update, at the end of the run
+    coalesced_use_cases = es.get_coalesced_use_cases()
+    try:
+        es.flush_outlier_updates()
+        es.drain_bulk_actions()
+    except Exception:  # pylint: disable=broad-except
+        logging.logger.error("error while writing outliers", exc_info=True)
+        # the analysis of the use cases of which the outliers were not written didn't complete
+        for analyzer in analyzers_to_evaluate:
+            if analyzer.completed_analysis and (analyzer.model_type, analyzer.model_name) in coalesced_use_cases:
+                analyzer.completed_analysis = False
+                analyzer.unknown_error_analysis = True
+
+    es.log_request_cache_stats()
 
     return analyzers_to_evaluate
 
 
+def evaluate_analyzers_concurrently(shared_scans, separate_analyzers, max_concurrent_use_cases, total_analyzers):
+    """
+    Evaluate the shared scans and the separate analyzers in worker threads, so that the Elasticsearch requests of
+    several use cases are in flight at the same time
+
+    :param shared_scans: list of shared scans to run
+    :param separate_analyzers: list of analyzers to evaluate separately
+    :param max_concurrent_use_cases: maximum number of shared scans and analyzers evaluated at the same time
+    :param total_analyzers: total number of use cases to process
+    """
+    total_processed = 0
+    with ThreadPoolExecutor(max_workers=max_concurrent_use_cases) as executor:
+        evaluations = {executor.submit(run_shared_scan, shared_scan): shared_scan.analyzers
+                       for shared_scan in shared_scans}
+        evaluations.update({executor.submit(evaluate_analyzer, analyzer): [analyzer]
+                            for analyzer in separate_analyzers})
+
+        for evaluation in as_completed(evaluations):
+            analyzers = evaluations[evaluation]
+            # an error is kept to the use cases that caused it, the other evaluations go on
+            try:
+                evaluation.result()
+            except Exception:  # pylint: disable=broad-except
+                flag_interrupted_analyzers(analyzers)
+            total_processed += len(analyzers)
+            log_analysis_progress(total_processed, total_analyzers)
+
+
+def run_shared_scan(shared_scan):
+    """
+    Run a shared scan, flagging the analyzers it could not evaluate if the scan itself fails
+    :param shared_scan: the shared scan to run
+    """
+    try:
+        shared_scan.run(evaluate_analyzer)
+    except Exception:  # pylint: disable=broad-except
+        flag_interrupted_analyzers(shared_scan.analyzers)
+
+
+def flag_interrupted_analyzers(analyzers):
+    """
+    Log the error that interrupted the evaluation of analyzers, and flag those that did not finish their analysis
+    :param analyzers: analyzers of which the evaluation was interrupted
+    """
+    logging.logger.error("error while analyzing use case", exc_info=True)
+    for analyzer in analyzers:
+        if not (analyzer.completed_analysis or analyzer.index_not_found_analysis):
+            analyzer.unknown_error_analysis = True
+
+
+def evaluate_analyzer(analyzer):
+    """
+    Evaluate a single analyzer, keeping track of the time needed and of the errors that happened
+    :param analyzer: the analyzer to evaluate
+    """
+    try:
+        analyzer.analysis_start_time = datetime.today().timestamp()
+        analyzer.evaluate_model()
+        analyzer.analysis_end_time = datetime.today().timestamp()
+        analyzer.completed_analysis = True
+        es.drain_bulk_actions()
+    except elasticsearch.exceptions.NotFoundError:
+        analyzer.index_not_found_analysis = True
+        logging.logger.warning("index %s does not exist, skipping use case", analyzer.model_settings["es_index"])
+    except elasticsearch.helpers.BulkIndexError as e:
+        analyzer.unknown_error_analysis = True
+        logging.logger.error(f"BulkIndexError while analyzing use case: {e.args[0]}", exc_info=False)
+        logging.logger.debug("Full stack trace and error message of BulkIndexError", exc_info=True)
+    except Exception:  # pylint: disable=broad-except
+        analyzer.unknown_error_analysis = True
+        logging.logger.error("error while analyzing use case", exc_info=True)
+
+
+def log_analysis_progress(total_processed, total_analyzers):
+    """
+    Log the progress of the analysis
+    :param total_processed: number of use cases processed so far
+    :param total_analyzers: total number of use cases to process
+    """
+    logging.logger.info("finished processing use case - %d / %d [%s%% done]", total_processed, total_analyzers,
+                        '{:.2f}'.format(round(total_processed / float(total_analyzers) * 100, 2)))
+
+
 def print_analysis_summary(analyzed_models):
     """
     Print a summary of the analysis
@@ -317,9 +417,11 @@ def print_analysis_summary(analyzed_models):
     total_models_processed = len(completed_models) + len(no_index_models) + len(unknown_error_models)
     total_outliers_detected = sum([analyzer.total_outliers for analyzer in analyzed_models])
     total_outliers_whitelisted = sum([analyzer.nr_whitelisted_elements for analyzer in analyzed_models])
+    total_outliers_unchanged = sum([analyzer.nr_unchanged_outliers for analyzer in analyzed_models])
     logging.logger.info("total use cases processed: %i", total_models_processed)
     logging.logger.info("total outliers detected: %s", "{:,}".format(total_outliers_detected))
     logging.logger.info("total whitelisted outliers: %s", "{:,}".format(total_outliers_whitelisted))
+    logging.logger.info("total unchanged outliers: %s", "{:,}".format(total_outliers_unchanged))
     logging.logger.info("")
     logging.logger.info("succesfully analyzed use cases: %i", len(completed_models))
     logging.logger.info("succesfully analyzed use cases without events: %i",
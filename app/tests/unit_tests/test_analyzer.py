@@ -3,7 +3,7 @@ import unittest
 
 import copy
 
-from helpers.singletons import es
+from helpers.singletons import es, settings
 from tests.unit_tests.test_stubs.test_stub_analyzer import TestStubAnalyzer
 from tests.unit_tests.test_stubs.test_stub_es import TestStubEs
 from tests.unit_tests.utils.update_settings import UpdateSettings
@@ -145,3 +145,32 @@ class TestAnalyzer(unittest.TestCase):
         timestamp_field = analyzer.model_settings["timestamp_field"]
         non_default_timestamp_field = "timestamp"
         self.assertEquals(timestamp_field, non_default_timestamp_field)
+
+    def test_es_scan_slices_of_general_section(self):
+        self.test_settings.change_configuration_path(config_file_analyzer_test_01)
+        settings.config.set("general", "es_scan_slices", "4")
+        analyzer = AnalyzerFactory.create(use_case_analyzer_dummy_test)
+        self.assertEqual(analyzer.model_settings["es_scan_slices"], 4)
+
+    def test_es_scan_slices_overridden_by_use_case(self):
+        self.test_settings.change_configuration_path(config_file_analyzer_test_01)
+        settings.config.set("general", "es_scan_slices", "4")
+        analyzer = AnalyzerFactory.create(use_case_analyzer_dummy_test)
+        analyzer.config_section["es_scan_slices"] = "2"
+        self.assertEqual(analyzer._extract_model_settings()["es_scan_slices"], 2)
+
+    def test_source_includes_disabled_by_default(self):
+        analyzer = AnalyzerFactory.create("/app/tests/unit_tests/files/use_cases/terms/terms_dummy_test.conf")
+        self.assertIsNone(analyzer.get_source_includes())
+
+    def test_source_includes_contain_fields_used_by_use_case(self):
+        analyzer = AnalyzerFactory.create("/app/tests/unit_tests/files/use_cases/terms/terms_dummy_test.conf")
+        analyzer.model_settings["es_source_projection"] = True
+        analyzer.model_settings["outlier_summary"] = "rare command {meta.command.query} on {meta.hostname}"
+
+        source_includes = analyzer.get_source_includes()
+
+        self.assertEqual(source_includes[:4], ["@timestamp", "meta.command.query", "meta.command.name",
+                                               "meta.hostname"])
+        self.assertIn("brofilter.id_orig_h", source_includes)
+        self.assertEqual(len(source_includes), len(set(source_includes)))
@@ -1,7 +1,9 @@
 import json
 import unittest
+from unittest import mock
 
 import copy
+import numpy as np
 
 from tests.unit_tests.test_stubs.test_stub_es import TestStubEs
 from analyzers.metrics import MetricsAnalyzer
@@ -523,3 +525,125 @@ class TestMetricsAnalyzer(unittest.TestCase):
         result = [elem for elem in es._scan()][2]
 
         self.assertEqual(result["_source"]["outliers"]["non_outlier_values_sample"], ["8.0"])
+
+    def _get_ids_of_outlier_documents_with_pushdown(self, use_case_file, documents, aggregation_pushdown,
+                                                    source_projection=False):
+        self.test_es.list_data = dict()
+        self.test_es.add_multiple_docs(copy.deepcopy(documents))
+        es.start_new_run()
+
+        self.test_settings.change_configuration_path("/app/tests/unit_tests/files/metrics_test_01.conf")
+        analyzer = AnalyzerFactory.create(use_case_file)
+        analyzer.model_settings["aggregation_pushdown"] = aggregation_pushdown
+        analyzer.model_settings["es_source_projection"] = source_projection
+        analyzer.evaluate_model()
+
+        return sorted(str(doc["_id"]) for doc in es._scan() if "outliers" in doc["_source"])
+
+    def test_metrics_aggregation_pushdown_detect_same_outliers_as_scan(self):
+        dummy_doc_generate = DummyDocumentsGenerate()
+        documents = list()
+        for command_name, user_id, command_query in (("one", 11, "SELECT * FROM dummy_table"), ("one", 8, "SELECT"),
+                                                     ("two", 12, "ls -la"), ("two", 0, "ls")):
+            documents.append(dummy_doc_generate.generate_document({"command_name": command_name, "user_id": user_id,
+                                                                   "command_query": command_query}))
+
+        for use_case_file in ("metrics_numerical_value_dummy_test.conf", "metrics_length_dummy_test.conf"):
+            use_case_file = "/app/tests/unit_tests/files/use_cases/metrics/" + use_case_file
+            outlier_ids = self._get_ids_of_outlier_documents_with_pushdown(use_case_file, documents, False)
+            pushdown_outlier_ids = self._get_ids_of_outlier_documents_with_pushdown(use_case_file, documents, True)
+
+            self.assertGreater(len(outlier_ids), 0)
+            self.assertEqual(pushdown_outlier_ids, outlier_ids)
+
+    def test_metrics_aggregation_pushdown_with_source_projection(self):
+        dummy_doc_generate = DummyDocumentsGenerate()
+        documents = list()
+        for command_name, user_id, command_query in (("one", 11, "SELECT * FROM dummy_table"), ("one", 8, "SELECT"),
+                                                     ("two", 12, "ls -la"), ("two", 0, "ls")):
+            documents.append(dummy_doc_generate.generate_document({"command_name": command_name, "user_id": user_id,
+                                                                   "command_query": command_query}))
+        use_case_file = "/app/tests/unit_tests/files/use_cases/metrics/metrics_numerical_value_dummy_test.conf"
+        count_documents = self.test_es.default_es_methods["default_count_documents"]
+        default_connection = es.conn
+        es.conn = mock.Mock()
+        es.conn.count.side_effect = lambda index=None, body=None: {"count": len(self.test_es.list_data)}
+        es.conn.mget.side_effect = lambda body=None: {"docs": [dict(self.test_es.list_data[doc["_id"]], found=True)
+                                                               for doc in body["docs"]]}
+        try:
+            outlier_ids = self._get_ids_of_outlier_documents_with_pushdown(use_case_file, documents, False,
+                                                                           source_projection=True)
+            with mock.patch.object(es, "_count_documents", side_effect=count_documents), \
+                    mock.patch.object(es, "_scan", side_effect=es._scan) as scan:
+                pushdown_outlier_ids = self._get_ids_of_outlier_documents_with_pushdown(use_case_file, documents,
+                                                                                        True, source_projection=True)
+            count_bodies = [kwargs["body"] for _, kwargs in es.conn.count.call_args_list]
+        finally:
+            es.conn = default_connection
+
+        self.assertGreater(len(outlier_ids), 0)
+        self.assertEqual(pushdown_outlier_ids, outlier_ids)
+        self.assertGreater(len(count_bodies), 0)
+        self.assertTrue(all("_source" not in count_body for count_body in count_bodies))
+        # the fetched documents are outliers, their complete source is fetched at once
+        fetch_query_fields = [args[4] for args, _ in scan.call_args_list if len(args) > 4]
+        self.assertGreater(len(fetch_query_fields), 0)
+        self.assertTrue(all(query_fields is None for query_fields in fetch_query_fields))
+
+    def test_metrics_aggregation_pushdown_fetch_each_batch_with_its_own_filter(self):
+        dummy_doc_generate = DummyDocumentsGenerate()
+        for command_name, user_id, command_query in (("one", 11, "SELECT * FROM dummy_table"), ("one", 8, "SELECT"),
+                                                     ("two", 12, "ls -la"), ("two", 0, "ls")):
+            self.test_es.add_doc(dummy_doc_generate.generate_document({"command_name": command_name,
+                                                                       "user_id": user_id,
+                                                                       "command_query": command_query}))
+        self.test_settings.change_configuration_path("/app/tests/unit_tests/files/metrics_test_01.conf")
+        analyzer = AnalyzerFactory.create(
+            "/app/tests/unit_tests/files/use_cases/metrics/metrics_numerical_value_dummy_test.conf")
+        analyzer.model_settings["aggregation_pushdown"] = True
+        analyzer.PUSHDOWN_FETCH_BATCH_SIZE = 1
+        use_case_search_query = copy.deepcopy(analyzer.get_search_query())
+
+        # the stub ignores the filters, so the queries of the fetches are checked instead
+        fetch_search_queries = list()
+        count_and_scan_documents = es.count_and_scan_documents
+
+        def record_search_query(**kwargs):
+            fetch_search_queries.append(copy.deepcopy(kwargs["search_query"]))
+            return count_and_scan_documents(**kwargs)
+
+        with mock.patch.object(es, "count_and_scan_documents", side_effect=record_search_query):
+            analyzer.evaluate_model()
+
+        self.assertEqual(len(fetch_search_queries), 2)
+        for search_query in fetch_search_queries:
+            self.assertEqual(search_query["filter"][:-1], use_case_search_query["filter"])
+            self.assertEqual(len(search_query["filter"][-1]["bool"]["should"]), 1)
+        self.assertEqual(analyzer.get_search_query(), use_case_search_query)
+
+    def test_metrics_aggregation_pushdown_coeff_of_variation_with_zero_average(self):
+        dummy_doc_generate = DummyDocumentsGenerate()
+        for command_name, user_id in (("one", 0), ("one", 0), ("two", -1), ("two", 1), ("three", 1), ("three", 3)):
+            self.test_es.add_doc(dummy_doc_generate.generate_document({"command_name": command_name,
+                                                                       "user_id": user_id}))
+        self.test_settings.change_configuration_path("/app/tests/unit_tests/files/metrics_test_01.conf")
+        analyzer = AnalyzerFactory.create(
+            "/app/tests/unit_tests/files/use_cases/metrics/metrics_numerical_value_dummy_test.conf")
+        analyzer.model_settings["aggregation_pushdown"] = True
+        analyzer.model_settings["trigger_method"] = "coeff_of_variation"
+        analyzer.model_settings["trigger_on"] = "low"
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            decision_frontiers, _ = analyzer._get_decision_frontiers_from_aggregations()
+
+        # the decision frontier of the values that are all 0 is undefined, and the other one is infinite
+        self.assertEqual(sorted(decision_frontiers.keys()), ["three", "two"])
+        self.assertEqual(decision_frontiers["two"], np.inf)
+        frontier_filter = analyzer._build_decision_frontier_filter(decision_frontiers["two"], {"field": "user_id"})
+        self.assertEqual(frontier_filter, {"range": {"user_id": {"lt": np.finfo(np.float64).max}}})
+
+    def test_metrics_aggregation_pushdown_not_possible_on_derived_fields(self):
+        self.test_settings.change_configuration_path("/app/tests/unit_tests/files/metrics_test_01.conf")
+        analyzer = AnalyzerFactory.create(
+            "/app/tests/unit_tests/files/use_cases/metrics/metrics_dummy_test_derived.conf")
+        self.assertFalse(analyzer._can_push_down_aggregations())
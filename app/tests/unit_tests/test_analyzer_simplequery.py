@@ -1,11 +1,13 @@
 import json
 import unittest
+from unittest import mock
 
 import copy
 
 from tests.unit_tests.test_stubs.test_stub_es import TestStubEs
-from analyzers.simplequery import SimplequeryAnalyzer
-from helpers.singletons import logging, es
+from analyzers.simplequery import SimplequeryAnalyzer, MAX_EXCLUDED_OUTLIER_IDS
+from helpers.singletons import logging, es, settings
+import helpers.utils
 from helpers.analyzerfactory import AnalyzerFactory
 from tests.unit_tests.utils.update_settings import UpdateSettings
 from tests.unit_tests.utils.dummy_documents_generate import DummyDocumentsGenerate
@@ -23,6 +25,58 @@ doc_with_outlier_test_file_01 = json.load(
 doc_with_outlier_test_file_02 = json.load(
     open("/app/tests/unit_tests/files/doc_with_simple_query_outlier_02.json"))
 
+
+def _get_field_values(doc, field):
+    """
+    Get the values of a field of a document, like the term queries of Elasticsearch see them
+
+    :param doc: the document
+    :param field: the field name, the keyword sub-field of a text field has the values of the text field
+    :return: list of values
+    """
+    if field == "_index":
+        return [doc["_index"]]
+    try:
+        value = helpers.utils.get_dotkey_value(doc["_source"], field)
+    except (KeyError, TypeError):
+        if not field.endswith(".keyword"):
+            return list()
+        return _get_field_values(doc, field[:-len(".keyword")])
+    return value if isinstance(value, list) else [value]
+
+
+def _matches_query(doc, query):
+    """
+    Evaluate the queries built by the simplequery analyzer on a document, like Elasticsearch would. Query strings match
+    all documents.
+
+    :param doc: the document
+    :param query: the query, or a dictionary with the clauses of a bool query
+    :return: True if the document matches the query
+    """
+    if "bool" in query:
+        query = query["bool"]
+    if any(clause in query for clause in ("filter", "should", "must_not")):
+        # the clauses of a bool query are a query or a list of queries
+        clauses = {clause: query.get(clause, list()) for clause in ("filter", "should", "must_not")}
+        clauses = {clause: sub_queries if isinstance(sub_queries, list) else [sub_queries]
+                   for clause, sub_queries in clauses.items()}
+        nr_matching_should = sum(_matches_query(doc, sub_query) for sub_query in clauses["should"])
+        matches_should = not clauses["should"] or nr_matching_should >= query.get("minimum_should_match", 1)
+        return matches_should and all(_matches_query(doc, sub_query) for sub_query in clauses["filter"]) and \
+            not any(_matches_query(doc, sub_query) for sub_query in clauses["must_not"])
+    if "query_string" in query:
+        return True
+    if "ids" in query:
+        return doc["_id"] in query["ids"]["values"]
+    if "term" in query:
+        field, value = next(iter(query["term"].items()))
+        if isinstance(value, dict):
+            value = value["value"]
+        return value in _get_field_values(doc, field)
+    raise NotImplementedError("query not supported: " + str(query))
+
+
 DEFAULT_OUTLIERS_KEY_FIELDS = ["type", "reason", "summary", "model_name", "model_type", "total_outliers",
                                "elasticsearch_filter"]
 
@@ -376,3 +430,132 @@ class TestSimplequeryAnalyzer(unittest.TestCase):
 
         result = [elem for elem in es._scan()][0]
         self.assertFalse("test_arbitrary_key" in result["_source"]["outliers"])
+
+    def test_simplequery_server_side_tagging_add_same_outlier_as_scanning(self):
+        doc_without_outlier = copy.deepcopy(doc_without_outlier_test_file)
+        doc_with_outlier = copy.deepcopy(doc_with_outlier_test_file_01)
+
+        self.test_es.add_doc(doc_without_outlier)
+        self.test_settings.change_configuration_path(config_file_simplequery_test_01)
+        analyzer = AnalyzerFactory.create(use_case_simplequery_dummy_test)
+        analyzer.model_settings["server_side_tagging"] = True
+        with mock.patch.object(es, "_scan", wraps=es._scan) as scan:
+            analyzer.evaluate_model()
+            scan.assert_not_called()
+
+        result = [elem for elem in es._scan()][0]
+        self.assertEqual(result, doc_with_outlier)
+        self.assertEqual(analyzer.total_outliers, 1)
+
+    def test_simplequery_server_side_tagging_translate_literal_whitelist_into_query(self):
+        self.test_settings.change_configuration_path(config_file_simplequery_test_01)
+        analyzer = AnalyzerFactory.create(use_case_whitelist_tests_model_whitelist_01)
+        outlier = analyzer._create_outlier({"_source": dict()})
+
+        self.test_es.add_doc(copy.deepcopy(doc_without_outlier_test_file))
+
+        whitelist_filter = analyzer._build_whitelist_filter(outlier)
+        self.assertEqual(len(whitelist_filter), 1)
+        value_queries = whitelist_filter[0]["bool"]["filter"][0]["bool"]["should"]
+        self.assertIn({"term": {"meta.hostname": "HOSTNAME-WHITELISTED"}}, value_queries)
+        self.assertIn({"ids": {"values": ["HOSTNAME-WHITELISTED"]}}, value_queries)
+        self.assertFalse(any("multi_match" in value_query for value_query in value_queries))
+
+    def test_simplequery_server_side_tagging_not_possible_without_exact_match_fields(self):
+        self.test_settings.change_configuration_path(config_file_simplequery_test_01)
+        analyzer = AnalyzerFactory.create(use_case_whitelist_tests_model_whitelist_01)
+        outlier = analyzer._create_outlier({"_source": dict()})
+
+        with mock.patch.object(es, "get_exact_match_fields", return_value=None):
+            self.assertIsNone(analyzer._build_whitelist_filter(outlier))
+
+    def test_simplequery_server_side_tagging_not_possible_with_asset_whitelist(self):
+        self.test_settings.change_configuration_path(config_file_simplequery_test_01)
+        analyzer = AnalyzerFactory.create(use_case_whitelist_tests_model_whitelist_01)
+        analyzer.model_whitelist_literals = [{"user: dummyuser"}]
+        outlier = analyzer._create_outlier({"_source": dict()})
+
+        with mock.patch.object(settings, "list_assets", [("meta.logged_in_users", "user")]):
+            self.assertIsNone(analyzer._build_whitelist_filter(outlier))
+
+    def _get_ids_of_outlier_documents_with_server_side_tagging(self, documents, server_side_tagging):
+        self.test_es.list_data = dict()
+        self.test_es.add_multiple_docs(copy.deepcopy(documents))
+        es.start_new_run()
+
+        self.test_settings.change_configuration_path(config_file_simplequery_test_01)
+        analyzer = AnalyzerFactory.create(use_case_whitelist_tests_model_whitelist_01)
+        analyzer.model_settings["server_side_tagging"] = server_side_tagging
+
+        stub_scan = es._scan
+        stub_add_outlier_by_query = es.add_outlier_by_query
+
+        def scan(index, search_range=None, bool_clause=None, sort_clause=None, query_fields=None, search_query=None,
+                 model_settings=None):
+            return (doc for doc in stub_scan() if _matches_query(doc, search_query))
+
+        def add_outlier_by_query(index, search_query, model_settings, outlier_dict_of_arrays):
+            all_documents = self.test_es.list_data
+            self.test_es.list_data = {doc_id: doc for doc_id, doc in all_documents.items()
+                                      if _matches_query(doc, search_query)}
+            try:
+                return stub_add_outlier_by_query(index, search_query, model_settings, outlier_dict_of_arrays)
+            finally:
+                all_documents.update(self.test_es.list_data)
+                self.test_es.list_data = all_documents
+
+        with mock.patch.object(es, "_scan", side_effect=scan), \
+                mock.patch.object(es, "add_outlier_by_query", side_effect=add_outlier_by_query) as add_by_query:
+            analyzer.evaluate_model()
+            es.flush_bulk_actions()
+        self.assertEqual(add_by_query.called, server_side_tagging)
+
+        return sorted(doc["_id"] for doc in self.test_es.list_data.values() if "outliers" in doc["_source"])
+
+    def test_simplequery_server_side_tagging_whitelist_same_events_as_scanning(self):
+        documents = list()
+        for doc_id, hostname, logged_in_users in (("whitelisted_hostname", "HOSTNAME-WHITELISTED", ["dummyuser"]),
+                                                  ("whitelisted_user", "DUMMY-PC", ["HOSTNAME-WHITELISTED"]),
+                                                  ("HOSTNAME-WHITELISTED", "DUMMY-PC", ["dummyuser"]),
+                                                  ("partial_hostname", "HOSTNAME-WHITELISTED-2", ["dummyuser"]),
+                                                  ("not_whitelisted", "DUMMY-PC", ["dummyuser"])):
+            doc = copy.deepcopy(doc_without_outlier_test_file)
+            doc["_id"] = doc_id
+            doc["_source"]["meta"]["hostname"] = hostname
+            doc["_source"]["meta"]["logged_in_users"] = logged_in_users
+            documents.append(doc)
+
+        outlier_ids = self._get_ids_of_outlier_documents_with_server_side_tagging(documents, False)
+        server_side_outlier_ids = self._get_ids_of_outlier_documents_with_server_side_tagging(documents, True)
+
+        self.assertEqual(outlier_ids, ["not_whitelisted", "partial_hostname"])
+        self.assertEqual(server_side_outlier_ids, outlier_ids)
+
+    def test_simplequery_server_side_tagging_not_possible_with_regex_whitelist(self):
+        self.test_settings.change_configuration_path(config_file_simplequery_test_01)
+        analyzer = AnalyzerFactory.create(use_case_whitelist_tests_model_whitelist_02)
+        outlier = analyzer._create_outlier({"_source": dict()})
+
+        self.assertIsNone(analyzer._build_whitelist_filter(outlier))
+
+    def test_simplequery_get_search_query_in_append_write_mode_exclude_flagged_events(self):
+        self.test_settings.change_configuration_path(config_file_simplequery_test_01)
+        analyzer = AnalyzerFactory.create(use_case_simplequery_dummy_test)
+
+        with mock.patch.object(es, "get_outliers_write_mode", return_value="append"), \
+                mock.patch.object(es, "get_outlier_document_ids", return_value=["1", "2"]):
+            search_query = analyzer.get_search_query()
+
+        self.assertEqual(search_query["filter"][-1], {"bool": {"must_not": {"ids": {"values": ["1", "2"]}}}})
+
+    def test_simplequery_get_search_query_in_append_write_mode_with_too_many_flagged_events(self):
+        self.test_settings.change_configuration_path(config_file_simplequery_test_01)
+        analyzer = AnalyzerFactory.create(use_case_simplequery_dummy_test)
+
+        with mock.patch.object(es, "get_outliers_write_mode", return_value="append"), \
+                mock.patch.object(es, "get_outlier_document_ids", return_value=None) as get_outlier_document_ids:
+            search_query = analyzer.get_search_query()
+
+        _, kwargs = get_outlier_document_ids.call_args
+        self.assertEqual(kwargs["max_ids"], MAX_EXCLUDED_OUTLIER_IDS)
+        self.assertEqual(search_query, analyzer.search_query)
@@ -7,6 +7,8 @@ from tests.unit_tests.utils.update_settings import UpdateSettings
 from tests.unit_tests.utils.dummy_documents_generate import DummyDocumentsGenerate
 from helpers.analyzerfactory import AnalyzerFactory
 
+import copy
+import tempfile
 import datetime as dt
 
 root_test_conf_files = "/app/tests/unit_tests/files/"
@@ -244,3 +246,125 @@ class TestSuddenAppearanceAnalyzer(unittest.TestCase):
         all_fields_exists = [elem in EXTRA_OUTLIERS_KEY_FIELDS + DEFAULT_OUTLIERS_KEY_FIELDS
                              for elem in list_outlier[0]['_source']['outliers']]
         self.assertTrue(all(all_fields_exists))
+
+    def _get_ids_of_outlier_documents_in_single_pass(self, use_case_file, documents, single_pass_evaluation):
+        self.test_es.list_data = dict()
+        self.test_es.add_multiple_docs(copy.deepcopy(documents))
+        es.start_new_run()
+
+        self.test_settings.change_configuration_path(test_conf_file_01)
+        analyzer = AnalyzerFactory.create(root_test_use_case_files + use_case_file)
+        analyzer.model_settings["single_pass_evaluation"] = single_pass_evaluation
+        set_new_current_date(analyzer)
+        analyzer.evaluate_model()
+
+        return sorted(str(doc["_id"]) for doc in es._scan() if "outliers" in doc["_source"])
+
+    def test_sudden_appearance_single_pass_detect_same_outliers_as_each_window(self):
+        dummy_doc_generate = DummyDocumentsGenerate()
+        list_delta_hour = [1, 1, 1, 3, 3, 3, 4, 5, 5, 5, 15, 15]
+        list_user_id = [1, 2, 1, 2, 1, 2, 1, 3, 1, 2, 1, 3]
+        list_hostname = ["host1", "host1", "host1", "host2", "host1", "host1", "host2", "host1", "host1", "host3",
+                         "host1", "host2"]
+        documents = dummy_doc_generate.generate_doc_time_variable_witt_custom_fields(list_delta_hour, "user_id",
+                                                                                     list_user_id, "hostname",
+                                                                                     list_hostname)
+
+        for use_case_file in ("sudden_appearance_dummy_test_02.conf", "sudden_appearance_dummy_test_03.conf"):
+            outlier_ids = self._get_ids_of_outlier_documents_in_single_pass(use_case_file, documents, False)
+            single_pass_outlier_ids = self._get_ids_of_outlier_documents_in_single_pass(use_case_file, documents,
+                                                                                        True)
+
+            self.assertGreater(len(outlier_ids), 0)
+            self.assertEqual(single_pass_outlier_ids, outlier_ids)
+
+    def test_sudden_appearance_first_seen_store_only_detects_combinations_never_seen_before(self):
+        dummy_doc_generate = DummyDocumentsGenerate()
+        first_run_end_time = dummy_doc_generate.start_timestamp + dt.timedelta(hours=12)
+        # the documents of hours 20 to 23 are only processed by the second run
+        list_delta_hour = [1, 2, 20, 21, 22, 23]
+        list_user_id = [1, 1, 1, 1, 1, 2]
+        list_hostname = ["host1", "host1", "host1", "host2", "host2", "host1"]
+        documents = dummy_doc_generate.generate_doc_time_variable_witt_custom_fields(list_delta_hour, "user_id",
+                                                                                     list_user_id, "hostname",
+                                                                                     list_hostname)
+        self.test_es.add_multiple_docs(documents)
+        self.test_settings.change_configuration_path(test_conf_file_01)
+
+        with tempfile.TemporaryDirectory() as state_directory:
+            outlier_ids = list()
+            for end_time in (first_run_end_time, first_run_end_time + dt.timedelta(hours=12)):
+                es.start_new_run()
+                analyzer = AnalyzerFactory.create(root_test_use_case_files + "sudden_appearance_dummy_test_02.conf")
+                analyzer.model_settings["first_seen_store"] = True
+                analyzer.model_settings["first_seen_store_directory"] = state_directory
+                analyzer.end_time = end_time
+                analyzer.evaluate_model()
+                outlier_ids.append({str(doc["_id"]) for doc in es._scan() if "outliers" in doc["_source"]})
+
+        self.assertEqual(outlier_ids[1] - outlier_ids[0], {"3", "5"})
+
+    def test_sudden_appearance_first_seen_store_detects_events_ingested_late(self):
+        dummy_doc_generate = DummyDocumentsGenerate()
+        first_run_end_time = dummy_doc_generate.start_timestamp.replace(minute=0, second=0) + \
+            dt.timedelta(hours=12, minutes=5)
+        documents = dummy_doc_generate.generate_doc_time_variable_witt_custom_fields([1, 2, 12, 20], "user_id",
+                                                                                     [1, 1, 1, 2], "hostname",
+                                                                                     ["host1", "host1", "host2",
+                                                                                      "host1"])
+        self.test_settings.change_configuration_path(test_conf_file_01)
+        use_case_file = root_test_use_case_files + "sudden_appearance_dummy_test_02.conf"
+
+        outlier_combinations = dict()
+        for overlap_minutes in (0, 10):
+            self.test_es.list_data = dict()
+            # the event of hour 12 is ingested after the first run, which processed the events up to 12:05
+            self.test_es.add_multiple_docs(copy.deepcopy(documents[:2]))
+            run_outlier_combinations = list()
+            with tempfile.TemporaryDirectory() as state_directory:
+                for end_time in (first_run_end_time, first_run_end_time + dt.timedelta(hours=12)):
+                    es.start_new_run()
+                    analyzer = AnalyzerFactory.create(use_case_file)
+                    analyzer.model_settings["first_seen_store"] = True
+                    analyzer.model_settings["first_seen_store_directory"] = state_directory
+                    analyzer.model_settings["first_seen_store_overlap_minutes"] = overlap_minutes
+                    analyzer.end_time = end_time
+                    analyzer.evaluate_model()
+                    run_outlier_combinations.append({(doc["_source"]["meta"]["user_id"],
+                                                      doc["_source"]["meta"]["hostname"])
+                                                     for doc in es._scan() if "outliers" in doc["_source"]})
+                    if end_time == first_run_end_time:
+                        self.test_es.add_multiple_docs(copy.deepcopy(documents[2:]))
+
+            outlier_combinations[overlap_minutes] = run_outlier_combinations[1] - run_outlier_combinations[0]
+
+        self.assertEqual(outlier_combinations[0], {(2, "host1")})
+        self.assertEqual(outlier_combinations[10], {(1, "host2"), (2, "host1")})
+
+    def test_sudden_appearance_parallel_windows_detect_same_outliers_as_each_window(self):
+        dummy_doc_generate = DummyDocumentsGenerate()
+        list_delta_hour = [1, 1, 1, 3, 3, 3, 4, 5, 5, 5, 15, 15]
+        list_user_id = [1, 2, 1, 2, 1, 2, 1, 3, 1, 2, 1, 3]
+        list_hostname = ["host1", "host1", "host1", "host2", "host1", "host1", "host2", "host1", "host1", "host3",
+                         "host1", "host2"]
+        documents = dummy_doc_generate.generate_doc_time_variable_witt_custom_fields(list_delta_hour, "user_id",
+                                                                                     list_user_id, "hostname",
+                                                                                     list_hostname)
+
+        outlier_ids = dict()
+        for max_parallel_windows in (1, 3):
+            self.test_es.list_data = dict()
+            self.test_es.add_multiple_docs(copy.deepcopy(documents))
+            es.start_new_run()
+
+            self.test_settings.change_configuration_path(test_conf_file_01)
+            analyzer = AnalyzerFactory.create(root_test_use_case_files + "sudden_appearance_dummy_test_02.conf")
+            analyzer.model_settings["max_parallel_windows"] = max_parallel_windows
+            set_new_current_date(analyzer)
+            analyzer.evaluate_model()
+
+            outlier_ids[max_parallel_windows] = sorted(str(doc["_id"]) for doc in es._scan()
+                                                       if "outliers" in doc["_source"])
+
+        self.assertGreater(len(outlier_ids[1]), 0)
+        self.assertEqual(outlier_ids[3], outlier_ids[1])
@@ -1,5 +1,6 @@
 import json
 import unittest
+from unittest import mock
 
 import copy
 import random
@@ -690,3 +691,106 @@ class TestTermsAnalyzer(unittest.TestCase):
         result = [elem for elem in es._scan()][4]
 
         self.assertEqual(result["_source"]["outliers"]["non_outlier_values_sample"], list())
+
+    def _get_ids_of_outlier_documents_with_pushdown(self, use_case_file, documents, aggregation_pushdown,
+                                                    source_projection=False):
+        self.test_es.list_data = dict()
+        self.test_es.add_multiple_docs(copy.deepcopy(documents))
+        es.start_new_run()
+
+        self.test_settings.change_configuration_path("/app/tests/unit_tests/files/terms_test_01.conf")
+        analyzer = AnalyzerFactory.create(use_case_file)
+        analyzer.model_settings["aggregation_pushdown"] = aggregation_pushdown
+        analyzer.model_settings["es_source_projection"] = source_projection
+        analyzer.evaluate_model()
+
+        return sorted(str(doc["_id"]) for doc in es._scan() if "outliers" in doc["_source"])
+
+    def test_terms_aggregation_pushdown_detect_same_outliers_as_scan(self):
+        dummy_doc_generate = DummyDocumentsGenerate()
+        documents = list()
+        for hostname, deployment_names in (("one", ["one"]), ("two", ["one", "two", "two", "three", "three", "three"]),
+                                           ("three", ["one", "two"])):
+            for deployment_name in deployment_names:
+                documents.append(dummy_doc_generate.generate_document({"hostname": hostname,
+                                                                       "deployment_name": deployment_name}))
+
+        for use_case_file in ("terms_dummy_test_float_low.conf", "terms_across_dummy_test_float_low.conf"):
+            use_case_file = "/app/tests/unit_tests/files/use_cases/terms/" + use_case_file
+            outlier_ids = self._get_ids_of_outlier_documents_with_pushdown(use_case_file, documents, False)
+            pushdown_outlier_ids = self._get_ids_of_outlier_documents_with_pushdown(use_case_file, documents, True)
+
+            self.assertGreater(len(outlier_ids), 0)
+            self.assertEqual(pushdown_outlier_ids, outlier_ids)
+
+    def test_terms_aggregation_pushdown_with_source_projection(self):
+        dummy_doc_generate = DummyDocumentsGenerate()
+        documents = list()
+        for hostname, deployment_names in (("one", ["one"]), ("two", ["one", "two", "two", "three", "three", "three"]),
+                                           ("three", ["one", "two"])):
+            for deployment_name in deployment_names:
+                documents.append(dummy_doc_generate.generate_document({"hostname": hostname,
+                                                                       "deployment_name": deployment_name}))
+        use_case_file = "/app/tests/unit_tests/files/use_cases/terms/terms_dummy_test_float_low.conf"
+        count_documents = self.test_es.default_es_methods["default_count_documents"]
+        default_connection = es.conn
+        es.conn = mock.Mock()
+        es.conn.count.side_effect = lambda index=None, body=None: {"count": len(self.test_es.list_data)}
+        es.conn.mget.side_effect = lambda body=None: {"docs": [dict(self.test_es.list_data[doc["_id"]], found=True)
+                                                               for doc in body["docs"]]}
+        try:
+            outlier_ids = self._get_ids_of_outlier_documents_with_pushdown(use_case_file, documents, False,
+                                                                           source_projection=True)
+            with mock.patch.object(es, "_count_documents", side_effect=count_documents), \
+                    mock.patch.object(es, "_scan", side_effect=es._scan) as scan:
+                pushdown_outlier_ids = self._get_ids_of_outlier_documents_with_pushdown(use_case_file, documents,
+                                                                                        True, source_projection=True)
+            count_bodies = [kwargs["body"] for _, kwargs in es.conn.count.call_args_list]
+        finally:
+            es.conn = default_connection
+
+        self.assertGreater(len(outlier_ids), 0)
+        self.assertEqual(pushdown_outlier_ids, outlier_ids)
+        self.assertGreater(len(count_bodies), 0)
+        self.assertTrue(all("_source" not in count_body for count_body in count_bodies))
+        # the fetched documents are outliers, their complete source is fetched at once
+        fetch_query_fields = [args[4] for args, _ in scan.call_args_list if len(args) > 4]
+        self.assertGreater(len(fetch_query_fields), 0)
+        self.assertTrue(all(query_fields is None for query_fields in fetch_query_fields))
+
+    def test_terms_aggregation_pushdown_fetch_each_batch_with_its_own_filter(self):
+        dummy_doc_generate = DummyDocumentsGenerate()
+        documents = list()
+        for hostname, deployment_names in (("one", ["one"]), ("two", ["one", "two", "two", "three", "three", "three"]),
+                                           ("three", ["one", "two"])):
+            for deployment_name in deployment_names:
+                documents.append(dummy_doc_generate.generate_document({"hostname": hostname,
+                                                                       "deployment_name": deployment_name}))
+        self.test_es.add_multiple_docs(documents)
+        self.test_settings.change_configuration_path("/app/tests/unit_tests/files/terms_test_01.conf")
+        analyzer = AnalyzerFactory.create("/app/tests/unit_tests/files/use_cases/terms/terms_dummy_test_float_low.conf")
+        analyzer.model_settings["aggregation_pushdown"] = True
+        analyzer.PUSHDOWN_FETCH_BATCH_SIZE = 1
+        use_case_search_query = copy.deepcopy(analyzer.get_search_query())
+
+        # the stub ignores the filters, so the queries of the fetches are checked instead
+        fetch_search_queries = list()
+        count_and_scan_documents = es.count_and_scan_documents
+
+        def record_search_query(**kwargs):
+            fetch_search_queries.append(copy.deepcopy(kwargs["search_query"]))
+            return count_and_scan_documents(**kwargs)
+
+        with mock.patch.object(es, "count_and_scan_documents", side_effect=record_search_query):
+            analyzer.evaluate_model()
+
+        self.assertEqual(len(fetch_search_queries), 3)
+        for search_query in fetch_search_queries:
+            self.assertEqual(search_query["filter"][:-1], use_case_search_query["filter"])
+            self.assertEqual(len(search_query["filter"][-1]["bool"]["should"]), 1)
+        self.assertEqual(analyzer.get_search_query(), use_case_search_query)
+
+    def test_terms_aggregation_pushdown_not_possible_on_derived_fields(self):
+        self.test_settings.change_configuration_path("/app/tests/unit_tests/files/terms_test_01.conf")
+        analyzer = AnalyzerFactory.create("/app/tests/unit_tests/files/use_cases/terms/terms_dummy_test_float.conf")
+        self.assertFalse(analyzer._can_push_down_aggregations())
@@ -0,0 +1,58 @@
+import unittest
+
+import threading
+
+from helpers.bulkwriter import BulkWriter
+
+
+class TestBulkWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.sent_bulk_actions = list()
+        self.sent_bulk_actions_lock = threading.Lock()
+
+    def _send_bulk_actions(self, bulk_actions, refresh=False):
+        with self.sent_bulk_actions_lock:
+            self.sent_bulk_actions.extend(bulk_actions)
+
+    def test_wait_for_pending_requests_returns_once_all_batches_are_sent(self):
+        bulk_writer = BulkWriter(self._send_bulk_actions, writer_threads=2, max_queue_size=1)
+
+        for i in range(10):
+            bulk_writer.submit([{"_id": str(i * 2)}, {"_id": str(i * 2 + 1)}])
+        bulk_writer.wait_for_pending_requests()
+
+        self.assertEqual(sorted(int(action["_id"]) for action in self.sent_bulk_actions), list(range(20)))
+
+    def test_wait_for_pending_requests_raises_error_of_failed_batch(self):
+        def send_bulk_actions(bulk_actions, refresh=False):
+            raise ValueError("bulk request failed")
+
+        bulk_writer = BulkWriter(send_bulk_actions, writer_threads=1)
+        bulk_writer.submit([{"_id": "0"}])
+
+        with self.assertRaises(ValueError):
+            bulk_writer.wait_for_pending_requests()
+
+        # the error is only raised once
+        bulk_writer.wait_for_pending_requests()
+
+    def test_wait_for_pending_requests_only_waits_for_batches_of_current_thread(self):
+        other_thread_may_send = threading.Event()
+
+        def send_bulk_actions(bulk_actions, refresh=False):
+            if bulk_actions[0]["_id"] == "other_thread":
+                other_thread_may_send.wait()
+            self._send_bulk_actions(bulk_actions)
+
+        bulk_writer = BulkWriter(send_bulk_actions, writer_threads=2)
+
+        other_thread = threading.Thread(target=bulk_writer.submit, args=([{"_id": "other_thread"}],))
+        other_thread.start()
+        other_thread.join()
+
+        bulk_writer.submit([{"_id": "current_thread"}])
+        bulk_writer.wait_for_pending_requests()
+        self.assertEqual(self.sent_bulk_actions, [{"_id": "current_thread"}])
+
+        other_thread_may_send.set()
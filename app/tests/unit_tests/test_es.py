@@ -1,6 +1,13 @@
 import unittest
+from unittest import mock
 
 import copy
+import json
+import threading
+import datetime as dt
+
+from elasticsearch.exceptions import ConnectionError as ESConnectionError
+from elasticsearch.serializer import JSONSerializer
 
 from tests.unit_tests.test_stubs.test_stub_es import TestStubEs
 from tests.unit_tests.test_stubs.test_stub_analyzer import TestStubAnalyzer
@@ -9,6 +16,7 @@ from tests.unit_tests.utils.dummy_documents_generate import DummyDocumentsGenera
 from helpers.singletons import es
 import helpers.es
 from helpers.es import build_search_query
+from helpers.outlier import Outlier
 import helpers.analyzerfactory
 from helpers.analyzerfactory import AnalyzerFactory
 
@@ -19,6 +27,84 @@ config_file_simplequery_test_01 = config_file_path + "simplequery_test_01.conf"
 helpers.analyzerfactory.CLASS_MAPPING["analyzer"] = TestStubAnalyzer
 
 
+class FakePointInTimeConnection:
+    """
+    Minimal Elasticsearch connection that serves pages of documents through a point in time, failing once before
+    returning the second page
+    """
+    def __init__(self, pages):
+        self.pages = pages
+        self.transport = self
+        self.search_bodies = list()
+        self.closed_pit_ids = list()
+        self.failed_once = False
+
+    def perform_request(self, method, url, params=None, body=None):
+        if method == "POST":
+            return {"id": "pit_0"}
+        self.closed_pit_ids.append(body["id"])
+        return {"succeeded": True}
+
+    def search(self, body=None, request_timeout=None):
+        self.search_bodies.append(body)
+        page_nr = 0 if "search_after" not in body else body["search_after"][0]
+        if page_nr == 1 and not self.failed_once:
+            self.failed_once = True
+            raise ESConnectionError("N/A", "connection reset", None)
+
+        hits = self.pages[page_nr] if page_nr < len(self.pages) else []
+        return {"pit_id": "pit_" + str(page_nr + 1), "hits": {"hits": hits}}
+
+
+class FakeSortedPointInTimeConnection:
+    """
+    Minimal Elasticsearch connection that pages through documents sorted on the sort fields of the search, starting
+    after the search_after values
+    """
+    def __init__(self, documents):
+        self.documents = documents
+        self.transport = self
+        self.search_bodies = list()
+
+    def perform_request(self, method, url, params=None, body=None):
+        return {"id": "pit_0"}
+
+    def search(self, body=None, request_timeout=None):
+        self.search_bodies.append(body)
+        sort_fields = [next(iter(sort_field)) for sort_field in body["sort"]]
+        hits = sorted(({"_id": doc["_id"], "sort": [doc[sort_field] for sort_field in sort_fields]}
+                       for doc in self.documents), key=lambda hit: hit["sort"])
+        if "search_after" in body:
+            hits = [hit for hit in hits if hit["sort"] > body["search_after"]]
+        return {"hits": {"hits": hits[:body["size"]]}}
+
+
+class FakeBulkConnection:
+    """
+    Minimal Elasticsearch connection that rejects the bulk actions of some documents once
+    """
+    def __init__(self, rejected_ids):
+        self.rejected_ids = set(rejected_ids)
+        self.bulk_ids = list()
+        self.transport = self
+        self.serializer = JSONSerializer()
+
+    def bulk(self, body=None, **kwargs):
+        action_lines = [json.loads(line) for line in body.strip().split("\n")][::2]
+        bulk_ids = [action_line["update"]["_id"] for action_line in action_lines]
+        self.bulk_ids.append(bulk_ids)
+
+        items = list()
+        for bulk_id in bulk_ids:
+            if bulk_id in self.rejected_ids:
+                self.rejected_ids.remove(bulk_id)
+                items.append({"update": {"_id": bulk_id, "status": 429,
+                                         "error": {"type": "es_rejected_execution_exception"}}})
+            else:
+                items.append({"update": {"_id": bulk_id, "status": 200}})
+        return {"errors": True, "items": items}
+
+
 class TestEs(unittest.TestCase):
 
     def setUp(self):
@@ -141,3 +227,615 @@ class TestEs(unittest.TestCase):
         dsl_search_query_2['query']['bool']['filter'].extend(analyzer.search_query["filter"].copy())
 
         self.assertEquals(dsl_search_query_1, dsl_search_query_2)
+
+    def test_merge_generators_concurrently_return_all_items(self):
+        generators = [iter(range(0, 100)), iter(range(100, 150)), iter([])]
+        result = [item for item in helpers.es.merge_generators_concurrently(generators, max_queue_size=10)]
+
+        self.assertEqual(sorted(result), list(range(0, 150)))
+
+    def test_merge_generators_concurrently_raise_exception_of_generator(self):
+        def failing_generator():
+            yield 1
+            raise ValueError("scan failed")
+
+        with self.assertRaises(ValueError):
+            for _ in helpers.es.merge_generators_concurrently([iter(range(10)), failing_generator()]):
+                pass
+
+    def test_get_scan_slices_use_case_override_general_settings(self):
+        self.test_settings.change_configuration_path(config_file_simplequery_test_01)
+        self.assertEqual(es._get_scan_slices(), 1)
+        self.assertEqual(es._get_scan_slices({"es_scan_slices": 4}), 4)
+
+    def test_point_in_time_scan_resume_from_last_sort_value_after_failure(self):
+        pages = [[{"_id": "1", "sort": [1]}, {"_id": "2", "sort": [1]}], [{"_id": "3", "sort": [2]}]]
+        fake_connection = FakePointInTimeConnection(pages)
+        default_connection = es.conn
+        es.conn = fake_connection
+        try:
+            with mock.patch("helpers.es.time.sleep"):
+                result = [doc["_id"] for doc in es._point_in_time_scan("test_index", {"sort": [{"timestamp": "asc"}]})]
+        finally:
+            es.conn = default_connection
+
+        self.assertEqual(result, ["1", "2", "3"])
+        self.assertEqual(fake_connection.search_bodies[1]["search_after"], [1])
+        self.assertEqual(fake_connection.search_bodies[2]["search_after"], [1])
+        self.assertEqual(fake_connection.closed_pit_ids, ["pit_3"])
+
+    def test_point_in_time_scan_with_same_timestamp_at_page_edge(self):
+        documents = [{"_id": str(i), "timestamp": 1 if i < 3 else 2, "_shard_doc": i} for i in range(5)]
+        fake_connection = FakeSortedPointInTimeConnection(documents)
+        default_connection = es.conn
+        es.conn = fake_connection
+        try:
+            with mock.patch.object(es.settings.config, "getint", return_value=2):
+                result = [doc["_id"] for doc in es._point_in_time_scan("test_index", {"sort": [{"timestamp": "asc"}]})]
+        finally:
+            es.conn = default_connection
+
+        self.assertEqual(result, ["0", "1", "2", "3", "4"])
+        self.assertEqual(fake_connection.search_bodies[0]["sort"], [{"timestamp": "asc"}, {"_shard_doc": "asc"}])
+
+    def test_supports_point_in_time_from_elasticsearch_7_12(self):
+        default_connection = es.conn
+        try:
+            for version, supported in (("7.11.2", False), ("7.12.0", True), ("8.1.0", True)):
+                es.conn = mock.Mock(info=mock.Mock(return_value={"version": {"number": version}}))
+                es.point_in_time_supported = None
+                self.assertEqual(es.supports_point_in_time(), supported)
+        finally:
+            es.conn = default_connection
+            es.point_in_time_supported = None
+
+    def test_bulk_actions_are_buffered_per_thread(self):
+        es.bulk_actions = [{"_id": "main_thread"}]
+        other_thread_bulk_actions = list()
+
+        def add_other_thread_bulk_action():
+            es.bulk_actions.append({"_id": "other_thread"})
+            other_thread_bulk_actions.extend(es.bulk_actions)
+
+        other_thread = threading.Thread(target=add_other_thread_bulk_action)
+        other_thread.start()
+        other_thread.join()
+
+        self.assertEqual(es.bulk_actions, [{"_id": "main_thread"}])
+        self.assertEqual(other_thread_bulk_actions, [{"_id": "other_thread"}])
+
+    def test_send_bulk_actions_only_retry_rejected_actions(self):
+        fake_connection = FakeBulkConnection(rejected_ids=["2"])
+        default_connection = es.conn
+        es.conn = fake_connection
+        try:
+            bulk_actions = [{"_op_type": "update", "_index": "index", "_id": str(i), "doc": {"value": i}}
+                            for i in range(4)]
+            with mock.patch("helpers.es.time.sleep"):
+                es._send_bulk_actions(bulk_actions)
+        finally:
+            es.conn = default_connection
+
+        self.assertEqual(fake_connection.bulk_ids, [["0", "1", "2", "3"], ["2"]])
+
+    def test_add_bulk_action_flush_once_byte_budget_is_exceeded(self):
+        es.BULK_FLUSH_SIZE = 1000
+        action = {"_op_type": "update", "_index": "index", "_id": "0", "doc": {"value": "x" * 100}}
+
+        with mock.patch.object(es, "_get_bulk_max_bytes", return_value=400), \
+                mock.patch.object(es, "flush_bulk_actions") as flush_bulk_actions:
+            es.add_bulk_action(action)
+            es.add_bulk_action(action)
+            flush_bulk_actions.assert_not_called()
+            es.add_bulk_action(action)
+            flush_bulk_actions.assert_called_once()
+
+    def test_add_bulk_action_only_serialize_sample_of_actions(self):
+        es.BULK_FLUSH_SIZE = 1000
+        action = {"_op_type": "update", "_index": "index", "_id": "0", "doc": {"value": "x" * 100}}
+
+        with mock.patch.object(es, "flush_bulk_actions"), \
+                mock.patch("helpers.es.json.dumps", wraps=json.dumps) as dumps:
+            for _ in range(es.BULK_ACTION_BYTES_SAMPLE_INTERVAL + 1):
+                es.add_bulk_action(action)
+
+        self.assertEqual(dumps.call_count, 2)
+        self.assertEqual(es.bulk_actions_bytes, len(json.dumps(action)) * (es.BULK_ACTION_BYTES_SAMPLE_INTERVAL + 1))
+
+    def test_adapt_bulk_flush_size_to_latency(self):
+        with mock.patch.object(es.settings.config, "getfloat", return_value=2.0):
+            try:
+                es.bulk_flush_size = 1000
+                es._adapt_bulk_flush_size(1000, latency=5)
+                self.assertEqual(es.bulk_flush_size, 500)
+
+                # partial batch (for example at the end of a use case): no reason to grow
+                es._adapt_bulk_flush_size(10, latency=0.1)
+                self.assertEqual(es.bulk_flush_size, 500)
+
+                es._adapt_bulk_flush_size(500, latency=0.1)
+                self.assertEqual(es.bulk_flush_size, 625)
+
+                es._adapt_bulk_flush_size(625, latency=0.1, rejected=True)
+                self.assertEqual(es.bulk_flush_size, 312)
+            finally:
+                es.bulk_flush_size = None
+
+    def test_save_outlier_in_partial_write_mode_give_same_result_as_full_write_mode(self):
+        doc_generate = DummyDocumentsGenerate()
+        full_doc = doc_generate.generate_document()
+        partial_doc = copy.deepcopy(full_doc)
+        partial_doc["_id"] = str(full_doc["_id"]) + "_partial"
+        self.test_es.add_doc(full_doc)
+        self.test_es.add_doc(partial_doc)
+
+        for write_mode, doc in (("full", full_doc), ("partial", partial_doc)):
+            for summary in ("first summary", "first summary", "second summary"):
+                outlier = Outlier(outlier_type="dummy type", outlier_reason="dummy reason", outlier_summary=summary,
+                                  doc=copy.deepcopy(self.test_es.list_data[doc["_id"]]))
+                with mock.patch.object(es, "get_outliers_write_mode", return_value=write_mode), \
+                        mock.patch.object(es, "flush_bulk_actions"):
+                    es.save_outlier(outlier)
+                bulk_actions = copy.deepcopy(es.bulk_actions)
+                self.test_es.flush_bulk_actions()
+
+        # only the outlier is sent in partial write mode
+        self.assertNotIn("doc", bulk_actions[0])
+        self.assertEqual(bulk_actions[0]["_source"]["script"]["params"]["outliers"][0]["summary"], ["second summary"])
+
+        full_result = self.test_es.list_data[full_doc["_id"]]["_source"]
+        partial_result = self.test_es.list_data[partial_doc["_id"]]["_source"]
+        self.assertEqual(partial_result, full_result)
+        self.assertEqual(full_result["outliers"]["total_outliers"], 2)
+
+    def test_save_outlier_in_append_write_mode_index_outlier_record(self):
+        doc_generate = DummyDocumentsGenerate()
+        doc = doc_generate.generate_document()
+        outlier = Outlier(outlier_type="dummy type", outlier_reason="dummy reason", outlier_summary="dummy summary",
+                          doc=doc)
+        outlier.outlier_dict["model_name"] = "dummy_test"
+        outlier.outlier_dict["model_type"] = "analyzer"
+
+        with mock.patch.object(es, "get_outliers_write_mode", return_value="append"), \
+                mock.patch.object(es, "flush_bulk_actions"):
+            es.save_outlier(outlier)
+
+        self.assertEqual(es.bulk_actions, [{
+            "_op_type": "create",
+            "_index": helpers.es.DEFAULT_OUTLIERS_INDEX,
+            "_id": helpers.es.get_outlier_record_id(outlier),
+            "_source": {
+                "@timestamp": doc["_source"]["@timestamp"],
+                "outlier_doc": {"index": doc["_index"], "id": doc["_id"]},
+                "outliers": outlier.outlier_dict,
+                "model_name": "dummy_test",
+                "model_type": "analyzer"
+            }
+        }])
+
+    def test_get_outlier_record_id_is_the_same_for_the_same_outlier(self):
+        doc = DummyDocumentsGenerate().generate_document()
+
+        def create_outlier(summary):
+            outlier = Outlier(outlier_type="dummy type", outlier_reason="dummy reason", outlier_summary=summary,
+                              doc=doc)
+            outlier.outlier_dict["model_name"] = "dummy_test"
+            return outlier
+
+        self.assertEqual(helpers.es.get_outlier_record_id(create_outlier("dummy summary")),
+                         helpers.es.get_outlier_record_id(create_outlier("dummy summary")))
+        self.assertNotEqual(helpers.es.get_outlier_record_id(create_outlier("dummy summary")),
+                            helpers.es.get_outlier_record_id(create_outlier("other summary")))
+
+    def test_send_bulk_actions_ignore_outlier_records_that_already_exist(self):
+        bulk_actions = [{"_op_type": "create", "_index": helpers.es.DEFAULT_OUTLIERS_INDEX, "_id": "record",
+                         "_source": {}}]
+        results = [(False, {"create": {"_id": "record", "status": 409,
+                                       "error": {"type": "version_conflict_engine_exception"}}})]
+
+        with mock.patch("helpers.es.eshelpers.streaming_bulk", return_value=iter(results)), \
+                mock.patch.object(es, "_store_outliers_index_template") as store_outliers_index_template, \
+                mock.patch.object(es.logging.logger, "error") as log_error:
+            es._send_bulk_actions(bulk_actions)
+
+        store_outliers_index_template.assert_called_once()
+        log_error.assert_not_called()
+
+    def test_get_outlier_document_ids_stop_once_maximum_is_exceeded(self):
+        self.test_es.add_multiple_docs([{"_index": helpers.es.DEFAULT_OUTLIERS_INDEX, "_id": "record_" + str(i),
+                                         "_source": {"outlier_doc": {"index": "index", "id": str(i)}}}
+                                        for i in range(3)])
+        model_settings = {"history_window_days": 1, "history_window_hours": 0}
+
+        self.assertEqual(sorted(es.get_outlier_document_ids("analyzer", "dummy_test", model_settings, max_ids=3)),
+                         ["0", "1", "2"])
+        self.assertIsNone(es.get_outlier_document_ids("analyzer", "dummy_test", model_settings, max_ids=2))
+
+    def test_remove_all_whitelisted_outliers_in_append_write_mode_remove_whitelisted_records(self):
+        self.test_settings.change_configuration_path(test_file_whitelist_path_config)
+        doc_generate = DummyDocumentsGenerate()
+        whitelisted_doc = doc_generate.generate_document({
+            "command_query": "osquery_get_all_processes_with_listening_conns.log"})
+        other_doc = doc_generate.generate_document({"command_query": "other_command.log"})
+        events = {str(whitelisted_doc["_id"]): whitelisted_doc, str(other_doc["_id"]): other_doc}
+
+        for record_id, doc in events.items():
+            self.test_es.add_doc({
+                "_index": helpers.es.DEFAULT_OUTLIERS_INDEX,
+                "_id": "record_" + record_id,
+                "_source": {
+                    "outlier_doc": {"index": doc["_index"], "id": record_id},
+                    "outliers": {"type": "dummy type", "reason": "dummy reason", "summary": "dummy summary",
+                                 "observation": "dummy observation"},
+                    "model_name": "dummy_test",
+                    "model_type": "analyzer"
+                }
+            })
+
+        def mget(body=None):
+            return {"docs": [dict(events[doc["_id"]], found=True) for doc in body["docs"]]}
+
+        analyzer = AnalyzerFactory.create("/app/tests/unit_tests/files/use_cases/analyzer/analyzer_dummy_test.conf")
+        default_connection = es.conn
+        es.conn = mock.Mock(mget=mget)
+        try:
+            with mock.patch.object(es, "get_outliers_write_mode", return_value="append"):
+                total_whitelisted = es.remove_all_whitelisted_outliers({"analyzer_dummy_test": analyzer})
+        finally:
+            es.conn = default_connection
+
+        self.assertEqual(total_whitelisted, 1)
+        self.assertEqual(list(self.test_es.list_data.keys()), ["record_" + str(other_doc["_id"])])
+
+    def test_coalesce_outlier_updates_write_one_update_per_document(self):
+        doc_generate = DummyDocumentsGenerate()
+        doc = doc_generate.generate_document()
+        self.test_es.add_doc(doc)
+
+        with mock.patch.object(es.settings.config, "getboolean", return_value=True), \
+                mock.patch.object(es, "flush_bulk_actions"):
+            # two use cases flagging their own copy of the same document
+            for summary in ("first summary", "second summary", "second summary"):
+                outlier = Outlier(outlier_type="dummy type", outlier_reason="dummy reason", outlier_summary=summary,
+                                  doc=copy.deepcopy(doc))
+                es.save_outlier(outlier)
+            self.assertEqual(es.bulk_actions, list())
+
+            es.flush_outlier_updates()
+
+        self.assertEqual(len(es.bulk_actions), 1)
+        self.assertEqual(es.bulk_actions[0]["doc"]["outliers"]["summary"], ["first summary", "second summary"])
+        self.assertEqual(es.bulk_actions[0]["doc"]["outliers"]["total_outliers"], 2)
+
+    def test_save_outlier_skip_outliers_already_saved(self):
+        doc_generate = DummyDocumentsGenerate()
+        doc = doc_generate.generate_document()
+
+        with mock.patch.object(es, "flush_bulk_actions"):
+            outlier = Outlier(outlier_type="dummy type", outlier_reason="dummy reason",
+                              outlier_summary="dummy summary", doc=copy.deepcopy(doc))
+            self.assertFalse(es.save_outlier(outlier))
+            saved_doc = copy.deepcopy(outlier.doc)
+
+            # already saved during this run
+            outlier = Outlier(outlier_type="dummy type", outlier_reason="dummy reason",
+                              outlier_summary="dummy summary", doc=copy.deepcopy(doc))
+            self.assertTrue(es.save_outlier(outlier))
+
+            # already part of the scanned document, during a next run
+            es.start_new_run()
+            outlier = Outlier(outlier_type="dummy type", outlier_reason="dummy reason",
+                              outlier_summary="dummy summary", doc=saved_doc)
+            self.assertTrue(es.save_outlier(outlier))
+
+        self.assertEqual(len(es.bulk_actions), 1)
+
+    def test_scan_first_occur_documents_pages_and_only_fetches_recent_first_occurrences(self):
+        first_occur_start_time = dt.datetime(2020, 1, 1, 12)
+        pages = [{"_shards": {"failed": 0},
+                  "aggregations": {"first_occur": {"after_key": {"field_0": "user1", "field_1": "host2"}, "buckets": [
+                      {"key": {"field_0": "user1", "field_1": "host1"}, "doc_count": 3,
+                       "first_occur_time": {"value": 1577872800000},  # 2020-01-01 10:00
+                       "last_occur_time": {"value": 1577876400000}},
+                      {"key": {"field_0": "user1", "field_1": "host2"}, "doc_count": 1,
+                       "first_occur_time": {"value": 1577883600000},  # 2020-01-01 13:00
+                       "last_occur_time": {"value": 1577883600000}}]}}},
+                 {"_shards": {"failed": 0},
+                  "aggregations": {"first_occur": {"buckets": []}}}]
+        search_bodies = list()
+
+        def search(index=None, body=None, **kwargs):
+            search_bodies.append(copy.deepcopy(body))
+            return pages[len(search_bodies) - 1]
+
+        def msearch(index=None, body=None, **kwargs):
+            return {"responses": [{"hits": {"hits": [{"_id": "first_doc"}]}} for _ in body[1::2]]}
+
+        model_settings = {"es_index": "test_index", "timestamp_field": "@timestamp",
+                          "aggregator": ["meta.user_id"], "target": ["meta.hostname"]}
+        scan_first_occur_documents = self.test_es.default_es_methods["default_scan_first_occur_documents"]
+        es.fetch_first_occur_documents = self.test_es.default_es_methods["default_fetch_first_occur_documents"]
+
+        default_connection = es.conn
+        es.conn = mock.Mock(search=search, msearch=msearch)
+        try:
+            first_occur_buckets = list(scan_first_occur_documents({"filter": []}, dt.datetime(2020, 1, 1),
+                                                                  dt.datetime(2020, 1, 2), model_settings,
+                                                                  first_occur_start_time=first_occur_start_time))
+        finally:
+            es.conn = default_connection
+
+        self.assertEqual([(bucket["aggregator"], bucket["target"], bucket["doc_count"]) for bucket in
+                          first_occur_buckets], [("user1", "host1", 3), ("user1", "host2", 1)])
+        self.assertEqual([bucket["top_doc"] for bucket in first_occur_buckets], [None, {"_id": "first_doc"}])
+        self.assertEqual(search_bodies[1]["aggs"]["first_occur"]["composite"]["after"],
+                         {"field_0": "user1", "field_1": "host2"})
+
+    def test_add_outlier_by_query_wait_for_task_to_complete(self):
+        update_by_query = mock.Mock(return_value={"task": "node:1"})
+        tasks = mock.Mock(get=mock.Mock(side_effect=[
+            {"completed": False, "task": {"status": {"total": 10, "updated": 4, "noops": 0, "version_conflicts": 0}}},
+            {"completed": True, "response": {"total": 10, "updated": 9, "noops": 1, "version_conflicts": 0,
+                                             "failures": []}}]))
+        model_settings = {"timestamp_field": "@timestamp", "history_window_days": 1, "history_window_hours": 0}
+        outlier_dict_of_arrays = {"summary": ["dummy summary"], "type": ["dummy type"]}
+        add_outlier_by_query = self.test_es.default_es_methods["default_add_outlier_by_query"]
+
+        default_connection = es.conn
+        es.conn = mock.Mock(update_by_query=update_by_query, tasks=tasks)
+        try:
+            with mock.patch("helpers.es.time.sleep") as sleep:
+                result = add_outlier_by_query("test_index", {"filter": []}, model_settings, outlier_dict_of_arrays)
+        finally:
+            es.conn = default_connection
+
+        self.assertEqual((result["updated"], result["noops"]), (9, 1))
+        self.assertEqual(sleep.call_count, 1)
+        _, kwargs = update_by_query.call_args
+        self.assertFalse(kwargs["wait_for_completion"])
+        self.assertEqual(kwargs["body"]["script"]["params"]["outlier"], outlier_dict_of_arrays)
+        self.assertEqual(kwargs["body"]["script"]["source"], helpers.es.ADD_OUTLIER_BY_QUERY_SCRIPT)
+
+    def test_get_index_time_range_from_name_daily_index(self):
+        self.assertEqual(helpers.es.get_index_time_range_from_name("logstash-2020.01.31", "%Y.%m.%d"),
+                         (dt.datetime(2020, 1, 31), dt.datetime(2020, 1, 31, 23, 59, 59, 999999)))
+
+    def test_get_index_time_range_from_name_monthly_index(self):
+        self.assertEqual(helpers.es.get_index_time_range_from_name("logstash-2020.12", "%Y.%m"),
+                         (dt.datetime(2020, 12, 1), dt.datetime(2020, 12, 31, 23, 59, 59, 999999)))
+
+    def test_get_index_time_range_from_name_without_date(self):
+        self.assertEqual(helpers.es.get_index_time_range_from_name("logstash-archive", "%Y.%m.%d"), (None, None))
+
+    def test_prune_indices_keeps_probed_indices_overlapping_search_range(self):
+        index_time_ranges = {"logstash-old": (1577836800000, 1577923199000),  # 2020-01-01
+                             "logstash-current": (1578009600000, 1578095999000),  # 2020-01-03
+                             "logstash-empty": (None, None)}
+        connection = mock.Mock()
+        connection.indices.get_alias.return_value = {index_name: {} for index_name in index_time_ranges}
+        connection.msearch.side_effect = lambda body, **kwargs: {"responses": [
+            {"aggregations": {"first_event": {"value": index_time_ranges[header["index"]][0]},
+                              "last_event": {"value": index_time_ranges[header["index"]][1]}}}
+            for header in body[::2]]}
+        search_range = es.get_time_filter(start_time=dt.datetime(2020, 1, 2, 12), end_time=dt.datetime(2020, 1, 4))
+
+        default_connection = es.conn
+        es.conn = connection
+        es.start_new_run()
+        try:
+            with mock.patch.object(es.settings.config, "getboolean", return_value=True):
+                pruned_index = es.prune_indices("logstash-*", search_range)
+                # the time ranges of the indices are only resolved once per run
+                es.prune_indices("logstash-*", search_range)
+        finally:
+            es.conn = default_connection
+            es.start_new_run()
+
+        self.assertEqual(pruned_index, "logstash-current")
+        self.assertEqual(connection.msearch.call_count, 1)
+
+    def test_prune_indices_keeps_index_pattern_if_disabled(self):
+        search_range = es.get_time_filter(start_time=dt.datetime(2020, 1, 2), end_time=dt.datetime(2020, 1, 4))
+        with mock.patch.object(es.settings.config, "getboolean", return_value=False):
+            self.assertEqual(es.prune_indices("logstash-*", search_range), "logstash-*")
+
+    def test_get_aligned_time_rounds_down_to_multiple_of_rounding(self):
+        self.assertEqual(helpers.es.get_aligned_time(dt.datetime(2020, 1, 2, 13, 47, 12, 345), 900),
+                         dt.datetime(2020, 1, 2, 13, 45))
+        self.assertEqual(helpers.es.get_aligned_time(dt.datetime(2020, 1, 2, 13, 47, 12, 345), 0),
+                         dt.datetime(2020, 1, 2, 13, 47, 12, 345))
+
+    def test_get_time_filter_ends_at_run_end_time(self):
+        es.run_end_time = dt.datetime(2020, 1, 2, 12)
+        try:
+            search_range = es.get_time_filter(days=1, hours=12, timestamp_field="@timestamp")
+        finally:
+            es.start_new_run()
+
+        self.assertEqual(search_range["range"]["@timestamp"],
+                         {"gte": "2020-01-01T00:00:00", "lte": "2020-01-02T12:00:00"})
+
+    def test_count_documents_with_request_cache(self):
+        count_documents = self.test_es.default_es_methods["default_count_documents"]
+        search_range = es.get_time_filter(start_time=dt.datetime(2020, 1, 2), end_time=dt.datetime(2020, 1, 4))
+
+        default_connection = es.conn
+        es.conn = mock.Mock()
+        es.conn.search.return_value = {"hits": {"total": {"value": 42, "relation": "eq"}, "hits": []}}
+        try:
+            with mock.patch.object(es, "use_request_cache", return_value=True):
+                total_documents = count_documents("test_index", search_range)
+            _, kwargs = es.conn.search.call_args
+        finally:
+            es.conn = default_connection
+
+        self.assertEqual(total_documents, 42)
+        self.assertTrue(kwargs["request_cache"])
+        self.assertEqual(kwargs["body"]["size"], 0)
+
+    def test_count_documents_does_not_send_source_includes(self):
+        count_documents = self.test_es.default_es_methods["default_count_documents"]
+        search_range = es.get_time_filter(start_time=dt.datetime(2020, 1, 2), end_time=dt.datetime(2020, 1, 4))
+
+        default_connection = es.conn
+        es.conn = mock.Mock()
+        es.conn.count.return_value = {"count": 42}
+        try:
+            with mock.patch.object(es, "use_request_cache", return_value=False):
+                total_documents = count_documents("test_index", search_range, query_fields=["meta.hostname"])
+            _, kwargs = es.conn.count.call_args
+        finally:
+            es.conn = default_connection
+
+        self.assertEqual(total_documents, 42)
+        self.assertNotIn("_source", kwargs["body"])
+
+    def test_complete_documents_source_fetches_all_documents_at_once(self):
+        documents = [{"_index": "index_1", "_id": "1", "_source": {"meta": {"hostname": "host1"}}},
+                     {"_index": "index_2", "_id": "2", "_source": {"meta": {"hostname": "host2"}}},
+                     {"_index": "index_1", "_id": "3", "_source": {"meta": {"hostname": "host3"}},
+                      "_source_complete": True}]
+        mget = mock.Mock(return_value={"docs": [
+            {"_index": "index_1", "_id": "1", "found": True, "_source": {"meta": {"hostname": "host1", "os": "a"}}},
+            {"_index": "index_2", "_id": "2", "found": True, "_source": {"meta": {"hostname": "host2", "os": "b"}}}]})
+
+        default_connection = es.conn
+        es.conn = mock.Mock(mget=mget)
+        try:
+            es.complete_documents_source(documents + documents[:1])
+        finally:
+            es.conn = default_connection
+
+        mget.assert_called_once_with(body={"docs": [{"_index": "index_1", "_id": "1"},
+                                                    {"_index": "index_2", "_id": "2"}]})
+        self.assertEqual(documents[0]["_source"], {"meta": {"hostname": "host1", "os": "a"}})
+        self.assertEqual(documents[1]["_source"], {"meta": {"hostname": "host2", "os": "b"}})
+        self.assertTrue(all(doc["_source_complete"] for doc in documents))
+
+    def test_merge_docvalue_fields_into_source(self):
+        documents = [{"_id": "1", "_source": {"meta": {"command": "ls -la"}},
+                      "fields": {"meta.hostname": ["host1"], "meta.logged_in_users": ["user1", "user2"]}}]
+
+        merged_documents = list(helpers.es.merge_docvalue_fields_into_source(documents))
+
+        self.assertEqual(merged_documents[0]["_source"],
+                         {"meta": {"command": "ls -la", "hostname": "host1", "logged_in_users": ["user1", "user2"]}})
+        self.assertNotIn("fields", merged_documents[0])
+
+    def test_scan_reads_fields_with_doc_values_from_doc_values(self):
+        scan = self.test_es.default_es_methods["default_scan"]
+        field_caps = mock.Mock(return_value={"fields": {
+            "meta.hostname": {"keyword": {"aggregatable": True}},
+            "meta.command": {"text": {"aggregatable": False}}}})
+        model_settings = {"process_documents_chronologically": False, "es_scan_slices": 1,
+                          "es_docvalue_fields": True}
+        scanned_documents = [{"_id": "1", "_source": {"meta": {"command": "ls"}},
+                              "fields": {"meta.hostname": ["host1"]}}]
+
+        default_connection = es.conn
+        es.conn = mock.Mock(field_caps=field_caps)
+        es.conn.indices.get_field_mapping.return_value = {"test_index": {"mappings": {
+            "meta.hostname": {"full_name": "meta.hostname", "mapping": {"hostname": {"type": "keyword"}}}}}}
+        try:
+            with mock.patch("helpers.es.eshelpers.scan", return_value=iter(scanned_documents)) as eshelpers_scan:
+                documents = list(scan("test_index", None, query_fields=["meta.hostname", "meta.command"],
+                                      model_settings=model_settings))
+        finally:
+            es.conn = default_connection
+
+        _, kwargs = eshelpers_scan.call_args
+        self.assertEqual(kwargs["query"]["docvalue_fields"], ["meta.hostname"])
+        self.assertEqual(kwargs["query"]["_source"], ["meta.command"])
+        self.assertEqual(documents[0]["_source"], {"meta": {"command": "ls", "hostname": "host1"}})
+
+    def test_get_docvalue_fields_read_keyword_fields_altered_by_mapping_from_source(self):
+        field_caps = mock.Mock(return_value={"fields": {
+            "meta.hostname": {"keyword": {"aggregatable": True}},
+            "meta.command": {"keyword": {"aggregatable": True}},
+            "meta.user": {"keyword": {"aggregatable": True}},
+            "meta.user_id": {"long": {"aggregatable": True}}}})
+        field_mappings = {
+            "index_1": {"mappings": {
+                "meta.hostname": {"full_name": "meta.hostname", "mapping": {"hostname": {"type": "keyword"}}},
+                "meta.command": {"full_name": "meta.command",
+                                 "mapping": {"command": {"type": "keyword", "ignore_above": 256}}},
+                "meta.user_id": {"full_name": "meta.user_id", "mapping": {"user_id": {"type": "long"}}}}},
+            "index_2": {"mappings": {
+                "meta.user": {"full_name": "meta.user",
+                              "mapping": {"user": {"type": "keyword", "normalizer": "lowercase"}}}}}}
+
+        default_connection = es.conn
+        es.conn = mock.Mock(field_caps=field_caps)
+        es.conn.indices.get_field_mapping.return_value = field_mappings
+        try:
+            docvalue_fields = es.get_docvalue_fields("index_*", ["meta.hostname", "meta.command", "meta.user",
+                                                                 "meta.user_id"])
+        finally:
+            es.conn = default_connection
+
+        self.assertEqual(docvalue_fields, ["meta.hostname", "meta.user_id"])
+
+    def test_prefetch_generator_returns_items_in_order(self):
+        documents = helpers.es.prefetch_generator((i for i in range(25)), page_size=4, max_pages=2, max_bytes=10)
+        self.assertEqual(list(documents), list(range(25)))
+
+    def test_prefetch_generator_raises_error_of_generator(self):
+        def failing_generator():
+            yield 1
+            raise ValueError("scroll failed")
+
+        documents = helpers.es.prefetch_generator(failing_generator(), page_size=10, max_pages=2)
+        with self.assertRaises(ValueError):
+            list(documents)
+
+    def test_prefetch_generator_closes_generator_when_consumer_stops(self):
+        generator_closed = threading.Event()
+
+        def endless_generator():
+            try:
+                i = 0
+                while True:
+                    yield i
+                    i += 1
+            finally:
+                generator_closed.set()
+
+        documents = helpers.es.prefetch_generator(endless_generator(), page_size=10, max_pages=2)
+        self.assertEqual(next(documents), 0)
+        documents.close()
+
+        self.assertTrue(generator_closed.wait(timeout=5))
+
+    def test_split_time_filter_in_contiguous_partitions(self):
+        search_range = es.get_time_filter(start_time=dt.datetime(2020, 1, 1), end_time=dt.datetime(2020, 1, 4))
+
+        partition_ranges = helpers.es.split_time_filter(search_range, 3)
+
+        self.assertEqual([partition_range["range"]["@timestamp"] for partition_range in partition_ranges],
+                         [{"gte": "2020-01-01T00:00:00", "lt": "2020-01-02T00:00:00"},
+                          {"gte": "2020-01-02T00:00:00", "lt": "2020-01-03T00:00:00"},
+                          {"gte": "2020-01-03T00:00:00", "lte": "2020-01-04T00:00:00"}])
+
+    def test_chain_generators_concurrently_keeps_order_of_generators(self):
+        generators = [(i for i in range(start, start + 100)) for start in (0, 100, 200)]
+
+        items = list(helpers.es.chain_generators_concurrently(generators, max_queue_size=10))
+
+        self.assertEqual(items, list(range(300)))
+
+    def test_scan_with_time_partitions_scans_each_partition_in_chronological_order(self):
+        scan = self.test_es.default_es_methods["default_scan"]
+        model_settings = {"process_documents_chronologically": True, "timestamp_field": "@timestamp",
+                          "es_scan_slices": 1, "es_scan_time_partitions": 2}
+        search_range = es.get_time_filter(start_time=dt.datetime(2020, 1, 1), end_time=dt.datetime(2020, 1, 3))
+
+        def scan_partition(client, query=None, **kwargs):
+            partition_start = query["query"]["bool"]["filter"][0]["range"]["@timestamp"]["gte"]
+            return iter([{"_id": partition_start + "_" + str(i)} for i in range(3)])
+
+        with mock.patch("helpers.es.eshelpers.scan", side_effect=scan_partition) as eshelpers_scan:
+            documents = list(scan("test_index", search_range, model_settings=model_settings))
+
+        self.assertEqual(eshelpers_scan.call_count, 2)
+        self.assertEqual([doc["_id"] for doc in documents],
+                         [day + "T00:00:00_" + str(i) for day in ("2020-01-01", "2020-01-02") for i in range(3)])
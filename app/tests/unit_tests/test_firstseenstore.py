@@ -0,0 +1,93 @@
+import unittest
+
+import datetime as dt
+import tempfile
+import threading
+
+from helpers.firstseenstore import FirstSeenStore
+
+
+class TestFirstSeenStore(unittest.TestCase):
+
+    def setUp(self):
+        self.state_directory = tempfile.TemporaryDirectory()
+        self.first_seen_store = FirstSeenStore(self.state_directory.name)
+
+    def tearDown(self):
+        self.first_seen_store.close()
+        self.state_directory.cleanup()
+
+    def test_last_processed_time_is_none_before_first_run(self):
+        self.assertIsNone(self.first_seen_store.get_last_processed_time("use_case"))
+
+    def test_last_processed_time_is_kept_per_use_case_across_store_instances(self):
+        last_processed_time = dt.datetime(2020, 1, 1, 10, 30, 15, 123000)
+        self.first_seen_store.set_last_processed_time("use_case", last_processed_time)
+        self.first_seen_store.close()
+
+        self.first_seen_store = FirstSeenStore(self.state_directory.name)
+        self.assertEqual(self.first_seen_store.get_last_processed_time("use_case"), last_processed_time)
+        self.assertIsNone(self.first_seen_store.get_last_processed_time("other_use_case"))
+
+    def test_get_seen_combinations_only_returns_combinations_of_use_case(self):
+        time = dt.datetime(2020, 1, 1)
+        self.first_seen_store.add_occurrences("use_case", [("user1", "host1", time, time),
+                                                           ("user1", "host2", time, time)])
+        self.first_seen_store.add_occurrences("other_use_case", [("user2", "host1", time, time)])
+
+        seen_combinations = self.first_seen_store.get_seen_combinations("use_case", [("user1", "host1"),
+                                                                                     ("user2", "host1"),
+                                                                                     ("user1", "host3")])
+        self.assertEqual(seen_combinations, {("user1", "host1")})
+
+    def test_add_occurrences_keeps_earliest_first_seen_and_latest_last_seen_time(self):
+        self.first_seen_store.add_occurrences("use_case", [("user1", "host1", dt.datetime(2020, 1, 2),
+                                                            dt.datetime(2020, 1, 3))])
+        self.first_seen_store.add_occurrences("use_case", [("user1", "host1", dt.datetime(2020, 1, 1),
+                                                            dt.datetime(2020, 1, 2))])
+        self.first_seen_store.add_occurrences("use_case", [("user1", "host1", dt.datetime(2020, 1, 4),
+                                                            dt.datetime(2020, 1, 5))])
+
+        rows = self.first_seen_store.conn.execute("SELECT first_seen, last_seen FROM first_seen").fetchall()
+        self.assertEqual(rows, [("2020-01-01T00:00:00.000000", "2020-01-05T00:00:00.000000")])
+
+    def test_get_seen_combinations_can_be_called_several_times(self):
+        time = dt.datetime(2020, 1, 1)
+        self.first_seen_store.add_occurrences("use_case", [("user1", "host1", time, time),
+                                                           ("user2", "host2", time, time)])
+
+        self.assertEqual(self.first_seen_store.get_seen_combinations("use_case", [("user1", "host1")]),
+                         {("user1", "host1")})
+        self.assertEqual(self.first_seen_store.get_seen_combinations("use_case", [("user2", "host2"),
+                                                                                  ("user2", "host1")]),
+                         {("user2", "host2")})
+        self.assertEqual(self.first_seen_store.get_seen_combinations("use_case", []), set())
+
+    def test_stores_sharing_file_wait_for_each_other_to_write(self):
+        time = dt.datetime(2020, 1, 1)
+
+        def add_occurrences_with_other_store():
+            other_store = FirstSeenStore(self.state_directory.name)
+            other_store.add_occurrences("other_use_case", [("user1", "host1", time, time)])
+            other_store.close()
+
+        # another store writes while this store is writing
+        self.first_seen_store.conn.execute("BEGIN IMMEDIATE")
+        self.first_seen_store.conn.execute("INSERT INTO processed (use_case, last_processed) VALUES (?, ?)",
+                                           ("use_case", time.strftime(FirstSeenStore.TIME_FORMAT)))
+        other_thread = threading.Thread(target=add_occurrences_with_other_store)
+        other_thread.start()
+
+        # looking up combinations isn't blocked by the writes
+        reading_store = FirstSeenStore(self.state_directory.name)
+        try:
+            self.assertEqual(reading_store.get_seen_combinations("other_use_case", [("user1", "host1")]), set())
+        finally:
+            reading_store.close()
+
+        self.first_seen_store.conn.commit()
+        other_thread.join()
+
+        self.assertEqual(self.first_seen_store.get_last_processed_time("use_case"), time)
+        self.assertEqual(self.first_seen_store.get_seen_combinations("other_use_case", [("user1", "host1")]),
+                         {("user1", "host1")})
@@ -1,12 +1,16 @@
 import json
+import threading
 import unittest
+from functools import partial
+from unittest import mock
 
 import copy
 import re
 
 import helpers.es
+import outliers
 from helpers.outlier import Outlier
-from helpers.singletons import es
+from helpers.singletons import es, logging, settings
 from tests.unit_tests.test_stubs.test_stub_es import TestStubEs
 from tests.unit_tests.test_stubs.test_stub_analyzer import TestStubAnalyzer
 from tests.unit_tests.utils.update_settings import UpdateSettings
@@ -22,6 +26,9 @@ doc_with_two_outliers_test_file = json.load(open("/app/tests/unit_tests/files/do
 doc_with_three_outliers_test_file = json.load(open("/app/tests/unit_tests/files/doc_with_three_outliers.json"))
 
 test_file_outliers_path_config = "/app/tests/unit_tests/files/whitelist_tests_outliers.conf"
+test_conf_file_01 = "/app/tests/unit_tests/files/simplequery_test_01.conf"
+use_case_analyzer = "/app/tests/unit_tests/files/use_cases/analyzer/analyzer_dummy_test.conf"
+use_case_analyzer_arbitrary = "/app/tests/unit_tests/files/use_cases/analyzer/analyzer_arbitrary_dummy_test.conf"
 
 nested_doc_for_whitelist_test = {'169.254.184.188', 'fe80::491a:881a:b1bf:b539', str(2), str(1), '1535026336',
                                  '1535017696_osquery_get_all_scheduled_tasks.log',
@@ -257,3 +264,130 @@ class TestOutlierOperations(unittest.TestCase):
 
         self.test_settings.change_configuration_path("/app/tests/unit_tests/files/whitelist_tests_09_ticket_1933.conf")
         self.assertFalse(test_outlier.is_whitelisted())
+
+
+class TestSharedScanDummy:
+    """
+    Shared scan evaluating its analyzers one after the other, and failing afterwards if an error is given
+    """
+    def __init__(self, analyzers, error=None):
+        self.analyzers = analyzers
+        self.error = error
+
+    def run(self, evaluate_analyzer):
+        for analyzer in self.analyzers:
+            evaluate_analyzer(analyzer)
+        if self.error is not None:
+            raise self.error
+
+
+class TestEvaluateAnalyzersConcurrently(unittest.TestCase):
+    def setUp(self):
+        self.test_es = TestStubEs()
+        self.test_settings = UpdateSettings()
+        self.test_settings.change_configuration_path(test_conf_file_01)
+        settings.config.set("general", "max_concurrent_use_cases", "4")
+
+    def tearDown(self):
+        self.test_settings.restore_default_configuration_path()
+        self.test_es.restore_es()
+
+    @staticmethod
+    def _create_analyzers(nr_analyzers):
+        return [AnalyzerFactory.create(use_case_analyzer) for _ in range(nr_analyzers)]
+
+    def test_evaluate_analyzers_concurrently_keeps_error_to_failing_analyzer(self):
+        analyzers = self._create_analyzers(4)
+        analyzers[1].evaluate_model = mock.Mock(side_effect=ValueError("dummy error"))
+
+        outliers.evaluate_analyzers_concurrently([], analyzers, 4, len(analyzers))
+
+        self.assertEqual([analyzer.completed_analysis for analyzer in analyzers], [True, False, True, True])
+        self.assertEqual([analyzer.unknown_error_analysis for analyzer in analyzers], [False, True, False, False])
+
+    def test_evaluate_analyzers_concurrently_keeps_error_to_failing_shared_scan(self):
+        analyzers = self._create_analyzers(4)
+        analyzers[1].evaluate_model = mock.Mock(side_effect=ValueError("dummy error"))
+        shared_scans = [TestSharedScanDummy(analyzers[:2], error=RuntimeError("dummy error")),
+                        TestSharedScanDummy(analyzers[2:3])]
+
+        outliers.evaluate_analyzers_concurrently(shared_scans, analyzers[3:], 4, len(analyzers))
+
+        self.assertEqual([analyzer.completed_analysis for analyzer in analyzers], [True, False, True, True])
+        self.assertEqual([analyzer.unknown_error_analysis for analyzer in analyzers], [False, True, False, False])
+
+    def test_evaluate_analyzers_concurrently_flags_analyzers_not_evaluated_by_failing_shared_scan(self):
+        analyzers = self._create_analyzers(3)
+        failing_shared_scan = mock.Mock(analyzers=analyzers[:2], run=mock.Mock(side_effect=RuntimeError("dummy")))
+
+        outliers.evaluate_analyzers_concurrently([failing_shared_scan], analyzers[2:], 4, len(analyzers))
+
+        self.assertEqual([analyzer.completed_analysis for analyzer in analyzers], [False, False, True])
+        self.assertEqual([analyzer.unknown_error_analysis for analyzer in analyzers], [True, True, False])
+
+    def test_perform_analysis_concurrently_writes_outliers_after_all_evaluations(self):
+        analyzers = self._create_analyzers(4)
+        calls = list()
+        calls_lock = threading.Lock()
+
+        def add_call(name):
+            with calls_lock:
+                calls.append(name)
+
+        for i, analyzer in enumerate(analyzers):
+            analyzer.evaluate_model = mock.Mock(side_effect=partial(add_call, "evaluate_" + str(i)))
+        analyzers[1].evaluate_model.side_effect = ValueError("dummy error")
+        shared_scans = [TestSharedScanDummy(analyzers[:2])]
+
+        with mock.patch.object(outliers, "load_analyzers", return_value=analyzers), \
+                mock.patch.object(outliers, "plan_shared_scans", return_value=(shared_scans, analyzers[2:])), \
+                mock.patch.object(es, "start_new_run"), \
+                mock.patch.object(es, "drain_bulk_actions", side_effect=partial(add_call, "drain")), \
+                mock.patch.object(es, "flush_outlier_updates", side_effect=partial(add_call, "flush")):
+            outliers.perform_analysis(mock.Mock())
+
+        # each analyzer drains its own bulk actions, and the outlier updates are only written once all are evaluated
+        self.assertEqual(sorted(calls[:-2]), ["drain", "drain", "drain", "evaluate_0", "evaluate_2", "evaluate_3"])
+        self.assertEqual(calls[-2:], ["flush", "drain"])
+        self.assertEqual([analyzer.unknown_error_analysis for analyzer in analyzers], [False, True, False, False])
+
+    def test_perform_analysis_flags_use_cases_of_which_coalesced_outliers_are_not_written(self):
+        analyzers = [AnalyzerFactory.create(use_case_analyzer), AnalyzerFactory.create(use_case_analyzer_arbitrary)]
+        doc = copy.deepcopy(doc_without_outlier_test_file)
+        outlier_dict = {"model_type": [analyzers[0].model_type], "model_name": [analyzers[0].model_name]}
+        analyzers[0].evaluate_model = mock.Mock(side_effect=partial(es._coalesce_outlier_update, doc, outlier_dict))
+
+        try:
+            with mock.patch.object(outliers, "load_analyzers", return_value=analyzers), \
+                    mock.patch.object(outliers, "plan_shared_scans", return_value=([], analyzers)), \
+                    mock.patch.object(es, "start_new_run"), \
+                    mock.patch.object(es, "flush_outlier_updates", side_effect=ConnectionError("dummy error")):
+                outliers.perform_analysis(mock.Mock())
+        finally:
+            es.pending_outlier_updates = dict()
+
+        self.assertEqual([analyzer.completed_analysis for analyzer in analyzers], [False, True])
+        self.assertEqual([analyzer.unknown_error_analysis for analyzer in analyzers], [True, False])
+
+    def test_evaluate_analyzers_concurrently_keeps_ticker_per_analyzer(self):
+        analyzers = self._create_analyzers(4)
+        # all analyzers tick at the same time, each with its own number of steps
+        barrier = threading.Barrier(len(analyzers), timeout=10)
+        tickers = dict()
+
+        def evaluate_model(nr_steps):
+            logging.init_ticker(total_steps=nr_steps, desc="use case " + str(nr_steps))
+            barrier.wait()
+            for _ in range(nr_steps):
+                logging.tick()
+            barrier.wait()
+            tickers[nr_steps] = (logging.current_step, logging.total_steps, logging.desc)
+
+        for i, analyzer in enumerate(analyzers):
+            analyzer.evaluate_model = mock.Mock(side_effect=partial(evaluate_model, i + 1))
+
+        outliers.evaluate_analyzers_concurrently([], analyzers, len(analyzers), len(analyzers))
+
+        self.assertTrue(all(analyzer.completed_analysis for analyzer in analyzers))
+        self.assertEqual(tickers, {nr_steps: (nr_steps, nr_steps, "use case " + str(nr_steps))
+                                   for nr_steps in range(1, len(analyzers) + 1)})
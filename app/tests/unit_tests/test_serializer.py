@@ -0,0 +1,31 @@
+import unittest
+
+import json
+import datetime as dt
+
+from helpers.serializer import FastJSONSerializer
+
+
+class TestSerializer(unittest.TestCase):
+
+    def setUp(self):
+        self.serializer = FastJSONSerializer()
+
+    def test_dumps_and_loads_document(self):
+        doc = {"_source": {"meta": {"hostname": "hôst1", "port": 443, "score": 0.5, "tags": ["outlier"]}}}
+
+        serialized_doc = self.serializer.dumps(doc)
+
+        self.assertIsInstance(serialized_doc, str)
+        self.assertEqual(json.loads(serialized_doc), doc)
+        self.assertEqual(self.serializer.loads(serialized_doc), doc)
+
+    def test_dumps_datetime_like_json_serializer(self):
+        self.assertEqual(self.serializer.dumps({"@timestamp": dt.datetime(2020, 1, 2, 3, 4, 5)}),
+                         '{"@timestamp":"2020-01-02T03:04:05"}')
+
+    def test_dumps_integer_bigger_than_64_bits(self):
+        self.assertEqual(self.serializer.dumps({"value": 2 ** 70}), '{"value":' + str(2 ** 70) + '}')
+
+    def test_dumps_keeps_strings_unchanged(self):
+        self.assertEqual(self.serializer.dumps('{"query": {}}'), '{"query": {}}')
@@ -0,0 +1,111 @@
+import copy
+import unittest
+from unittest import mock
+
+from helpers.singletons import es
+from helpers.sharedscan import plan_shared_scans
+from helpers.analyzerfactory import AnalyzerFactory
+from tests.unit_tests.test_stubs.test_stub_es import TestStubEs
+from tests.unit_tests.utils.update_settings import UpdateSettings
+
+test_conf_file_01 = "/app/tests/unit_tests/files/simplequery_test_01.conf"
+test_conf_file_simplequery_shared_scan = "/app/tests/unit_tests/files/simplequery_test_shared_scan.conf"
+use_case_simplequery = "/app/tests/unit_tests/files/use_cases/simplequery/simplequery_dummy_test.conf"
+use_case_simplequery_arbitrary = "/app/tests/unit_tests/files/use_cases/simplequery/" \
+                                 "simplequery_arbitrary_dummy_test.conf"
+use_case_terms = "/app/tests/unit_tests/files/use_cases/terms/terms_dummy_test.conf"
+
+
+class TestSharedScan(unittest.TestCase):
+
+    def setUp(self):
+        self.test_es = TestStubEs()
+        self.test_settings = UpdateSettings()
+        self.test_settings.change_configuration_path(test_conf_file_01)
+
+    def tearDown(self):
+        self.test_es.restore_es()
+        self.test_settings.restore_default_configuration_path()
+
+    def _create_analyzers(self, es_shared_scan=True):
+        analyzers = [AnalyzerFactory.create(use_case_simplequery), AnalyzerFactory.create(use_case_terms)]
+        for analyzer in analyzers:
+            analyzer.model_settings["es_shared_scan"] = es_shared_scan
+            # group both analyzers, even if terms analyzers process documents chronologically by default
+            analyzer.model_settings["process_documents_chronologically"] = False
+        return analyzers
+
+    def test_plan_shared_scans_group_analyzers_on_same_index_and_window(self):
+        shared_scans, separate_analyzers = plan_shared_scans(self._create_analyzers())
+
+        self.assertEqual(len(shared_scans), 1)
+        self.assertEqual(len(shared_scans[0].analyzers), 2)
+        self.assertEqual(separate_analyzers, [])
+
+    def test_plan_shared_scans_disabled_by_default(self):
+        analyzers = self._create_analyzers(es_shared_scan=False)
+        shared_scans, separate_analyzers = plan_shared_scans(analyzers)
+
+        self.assertEqual(shared_scans, [])
+        self.assertEqual(separate_analyzers, analyzers)
+
+    def test_plan_shared_scans_keep_separate_analyzers_with_different_window(self):
+        analyzers = self._create_analyzers()
+        analyzers[1].model_settings["history_window_days"] += 1
+        shared_scans, separate_analyzers = plan_shared_scans(analyzers)
+
+        self.assertEqual(shared_scans, [])
+        self.assertEqual(len(separate_analyzers), 2)
+
+    def test_shared_scan_dispatch_documents_to_matching_analyzers(self):
+        self.test_es.add_doc({"_id": "both", "_source": {}, "matched_queries": ["simplequery_dummy_test",
+                                                                                "terms_dummy_test"]})
+        self.test_es.add_doc({"_id": "terms", "_source": {}, "matched_queries": ["terms_dummy_test"]})
+
+        scanned_documents = dict()
+
+        def evaluate_analyzer(analyzer):
+            total_documents, documents = analyzer.count_and_scan_documents()
+            scanned_documents[analyzer.model_type] = (total_documents, [doc["_id"] for doc in documents])
+
+        shared_scans, _ = plan_shared_scans(self._create_analyzers())
+        shared_scans[0].run(evaluate_analyzer)
+
+        self.assertEqual(scanned_documents["simplequery"], (1, ["both"]))
+        self.assertEqual(scanned_documents["terms"], (2, ["both", "terms"]))
+
+    def test_plan_shared_scans_group_simplequery_analyzers_enabled_in_simplequery_settings(self):
+        self.test_settings.change_configuration_path(test_conf_file_simplequery_shared_scan)
+        analyzers = [AnalyzerFactory.create(use_case_simplequery),
+                     AnalyzerFactory.create(use_case_simplequery_arbitrary),
+                     AnalyzerFactory.create(use_case_terms)]
+        analyzers[2].model_settings["process_documents_chronologically"] = False
+
+        shared_scans, separate_analyzers = plan_shared_scans(analyzers)
+
+        self.assertEqual(len(shared_scans), 1)
+        self.assertEqual(shared_scans[0].analyzers, analyzers[:2])
+        self.assertEqual(separate_analyzers, analyzers[2:])
+
+    def test_shared_scan_keeps_outliers_of_all_analyzers_flagging_same_document(self):
+        self.test_settings.change_configuration_path(test_conf_file_simplequery_shared_scan)
+        analyzers = [AnalyzerFactory.create(use_case_simplequery),
+                     AnalyzerFactory.create(use_case_simplequery_arbitrary)]
+        analyzers[1].model_settings["outlier_summary"] = "other dummy summary"
+        self.test_es.add_doc({"_index": "logstash-eagleeye-test", "_type": "doc", "_id": "both", "_source": {},
+                              "matched_queries": ["simplequery_dummy_test", "simplequery_arbitrary_dummy_test"]})
+
+        def evaluate_analyzer(analyzer):
+            analyzer.evaluate_model()
+            es.flush_bulk_actions()
+
+        # Elasticsearch only changes the stored documents through the bulk actions
+        def scan_copies(*args, **kwargs):
+            return iter(copy.deepcopy(list(self.test_es.list_data.values())))
+
+        shared_scans, _ = plan_shared_scans(analyzers)
+        with mock.patch.object(es, "_scan", side_effect=scan_copies):
+            shared_scans[0].run(evaluate_analyzer)
+
+        result = self.test_es.list_data["both"]["_source"]
+        self.assertEqual(sorted(result["outliers"]["summary"]), ["dummy summary", "other dummy summary"])
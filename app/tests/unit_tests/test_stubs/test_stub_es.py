@@ -1,16 +1,12 @@
-from helpers.singletons import es
-import helpers.es
+from collections import defaultdict
 
-import dateutil.parser
+import numpy as np
 
+from helpers.singletons import es, settings
+import helpers.es
+import helpers.utils
 
-def _convert_to_elastic_search_format(aggr_dict):
-    for aggr_key in aggr_dict:
-        tmp_list_target_buckets = list()
-        for target_key in aggr_dict[aggr_key]["target"]["buckets"]:
-            tmp_list_target_buckets.append(aggr_dict[aggr_key]["target"]["buckets"][target_key])
-        aggr_dict[aggr_key]["target"]["buckets"] = tmp_list_target_buckets
-    return list(aggr_dict.values())
+import dateutil.parser
 
 
 def _get_values_from_list_field(doc, list_field):
@@ -26,6 +22,15 @@ def _get_values_from_list_field(doc, list_field):
     return values
 
 
+def _get_field_names(doc, parent_field=""):
+    for key_name, value in doc.items():
+        field_name = parent_field + key_name
+        if isinstance(value, dict):
+            yield from _get_field_names(value, field_name + ".")
+        else:
+            yield field_name
+
+
 class TestStubEs:
 
     def __init__(self):
@@ -34,6 +39,8 @@ class TestStubEs:
         self.id = 0
         self.default_es_methods = self._get_default_es_methods()
         self.apply_new_es()
+        # each test starts with a new run, without outliers saved by previous tests
+        es.start_new_run()
 
     @staticmethod
     def _get_default_es_methods():
@@ -44,7 +51,15 @@ class TestStubEs:
                 "default_init_connection": es.init_connection,
                 "default_scan": es._scan,
                 "default_count_documents": es._count_documents,
+                "default_count_documents_per_search_query": es.count_documents_per_search_query,
+                "default_get_aggregatable_fields": es.get_aggregatable_fields,
+                "default_get_exact_match_fields": es.get_exact_match_fields,
+                "default_scan_composite_aggregation": es.scan_composite_aggregation,
+                "default_scan_metric_aggregation": es.scan_metric_aggregation,
                 "default_scan_first_occur_documents": es.scan_first_occur_documents,
+                "default_scan_first_occur_per_interval": es.scan_first_occur_per_interval,
+                "default_fetch_first_occur_documents": es.fetch_first_occur_documents,
+                "default_add_outlier_by_query": es.add_outlier_by_query,
                 "default_remove_all_outliers": es.remove_all_outliers,
                 "default_flush_bulk_actions": es.flush_bulk_actions
             }
@@ -55,7 +70,15 @@ class TestStubEs:
         es.init_connection = self.init_connection
         es._scan = self._scan
         es._count_documents = self._count_documents
+        es.count_documents_per_search_query = self.count_documents_per_search_query
+        es.get_aggregatable_fields = self.get_aggregatable_fields
+        es.get_exact_match_fields = self.get_exact_match_fields
+        es.scan_composite_aggregation = self.scan_composite_aggregation
+        es.scan_metric_aggregation = self.scan_metric_aggregation
         es.scan_first_occur_documents = self.scan_first_occur_documents
+        es.scan_first_occur_per_interval = self.scan_first_occur_per_interval
+        es.fetch_first_occur_documents = self.fetch_first_occur_documents
+        es.add_outlier_by_query = self.add_outlier_by_query
         es.remove_all_outliers = self.remove_all_outliers
         es.flush_bulk_actions = self.flush_bulk_actions
 
@@ -65,7 +88,15 @@ class TestStubEs:
         es.init_connection = self.default_es_methods["default_init_connection"]
         es._scan = self.default_es_methods["default_scan"]
         es._count_documents = self.default_es_methods["default_count_documents"]
+        es.count_documents_per_search_query = self.default_es_methods["default_count_documents_per_search_query"]
+        es.get_aggregatable_fields = self.default_es_methods["default_get_aggregatable_fields"]
+        es.get_exact_match_fields = self.default_es_methods["default_get_exact_match_fields"]
+        es.scan_composite_aggregation = self.default_es_methods["default_scan_composite_aggregation"]
+        es.scan_metric_aggregation = self.default_es_methods["default_scan_metric_aggregation"]
         es.scan_first_occur_documents = self.default_es_methods["default_scan_first_occur_documents"]
+        es.scan_first_occur_per_interval = self.default_es_methods["default_scan_first_occur_per_interval"]
+        es.fetch_first_occur_documents = self.default_es_methods["default_fetch_first_occur_documents"]
+        es.add_outlier_by_query = self.default_es_methods["default_add_outlier_by_query"]
         es.remove_all_outliers = self.default_es_methods["default_remove_all_outliers"]
         es.flush_bulk_actions = self.default_es_methods["default_flush_bulk_actions"]
         es.bulk_actions = list()
@@ -84,11 +115,86 @@ class TestStubEs:
     def _count_documents(self, index="", bool_clause=None, query_fields=None, search_query=None, model_settings=None):
         return len(self.list_data)
 
-    def scan_first_occur_documents(self, search_query, start_time, end_time, model_settings):
+    def count_documents_per_search_query(self, index="", search_range=None, search_queries=None):
+        """
+        Function that imitate the helpers.es.count_documents_per_search_query() function behavior.
+        Documents without "matched_queries" match all search queries.
+        """
+        total_documents = dict()
+        for name in search_queries:
+            total_documents[name] = len([doc for doc in self.list_data.values()
+                                         if name in doc.get("matched_queries", search_queries.keys())])
+        return total_documents
+
+    def get_aggregatable_fields(self, index, fields):
+        """
+        Function that imitate the helpers.es.get_aggregatable_fields() function behavior.
+        All fields can be aggregated.
+        """
+        return {field: field for field in fields}
+
+    def get_exact_match_fields(self, index):
+        """
+        Function that imitate the helpers.es.get_exact_match_fields() function behavior.
+        All fields of the documents are keyword fields.
+        """
+        fields = set()
+        for doc in self.list_data.values():
+            fields.update(_get_field_names(doc["_source"]))
+        return sorted(fields)
+
+    def scan_composite_aggregation(self, index, fields, search_query, model_settings):
+        """
+        Function that imitate the helpers.es.scan_composite_aggregation() function behavior.
+        The search query and the history window are ignored, like in _scan.
+        """
+        doc_counts = defaultdict(int)
+        for doc in self.list_data.values():
+            try:
+                sentences = helpers.utils.flatten_fields_into_sentences(fields=doc["_source"], sentence_format=fields)
+            except (KeyError, TypeError):
+                continue
+            for sentence in sentences:
+                doc_counts[tuple(sentence)] += 1
+
+        for values in sorted(doc_counts):
+            yield values, doc_counts[values]
+
+    def scan_metric_aggregation(self, index, aggregator_fields, target_field, metric, search_query, model_settings,
+                                percents=(50,)):
+        """
+        Function that imitate the helpers.es.scan_metric_aggregation() function behavior.
+        The search query and the history window are ignored, like in _scan.
+        """
+        metrics = defaultdict(list)
+        for doc in self.list_data.values():
+            try:
+                sentences = helpers.utils.flatten_fields_into_sentences(fields=doc["_source"],
+                                                                        sentence_format=aggregator_fields)
+                target_value = helpers.utils.get_dotkey_value(doc["_source"], target_field)
+            except (KeyError, TypeError):
+                continue
+            metric_value = float(target_value) if metric == "numerical_value" else len(target_value)
+            for sentence in sentences:
+                metrics[tuple(sentence)].append(metric_value)
+
+        for values in sorted(metrics):
+            metric_values = np.array(metrics[values])
+            median = np.median(metric_values)
+            yield values, {"count": len(metric_values), "min": np.min(metric_values), "max": np.max(metric_values),
+                           "avg": np.mean(metric_values), "std_deviation": np.std(metric_values),
+                           "mad": np.median(np.absolute(metric_values - median)),
+                           "percentiles": {float(percent): np.percentile(metric_values, percent)
+                                           for percent in percents}}
+
+    def scan_first_occur_documents(self, search_query, start_time, end_time, model_settings,
+                                   first_occur_start_time=None, fetch_documents=True):
         """
         Function that imitate the helpers.es.scan_first_occur_documents() function behavior.
+        The first document of all combinations is returned, whatever first_occur_start_time, unless fetch_documents is
+        False.
         """
-        aggr_dict = dict()
+        first_occur_buckets = dict()
         aggregators = model_settings["aggregator"]
         targets = model_settings["target"]
         for raw_doc in self.list_data.values():
@@ -99,29 +205,90 @@ class TestStubEs:
                 aggr_value = _get_values_from_list_field(doc, aggregators)
                 target_value = _get_values_from_list_field(doc, targets)
 
-                if aggr_value not in aggr_dict:
-                    aggr_dict[aggr_value] = dict()
-                    aggr_dict[aggr_value]["key"] = aggr_value
-                    aggr_dict[aggr_value]["target"] = dict()
-                    aggr_dict[aggr_value]["target"]["buckets"] = dict()
-                if target_value not in aggr_dict[aggr_value]["target"]["buckets"]:
-                    aggr_dict[aggr_value]["target"]["buckets"][target_value] = dict()
-                    aggr_dict[aggr_value]["target"]["buckets"][target_value]["key"] = target_value
-                    aggr_dict[aggr_value]["target"]["buckets"][target_value]["doc_count"] = 1
-                    aggr_dict[aggr_value]["target"]["buckets"][target_value]["top_doc"] = dict()
-                    aggr_dict[aggr_value]["target"]["buckets"][target_value]["top_doc"]["hits"] = dict()
-                    aggr_dict[aggr_value]["target"]["buckets"][target_value]["top_doc"]["hits"]["hits"] = [raw_doc]
+                if (aggr_value, target_value) not in first_occur_buckets:
+                    first_occur_buckets[(aggr_value, target_value)] = {"aggregator": aggr_value,
+                                                                       "target": target_value,
+                                                                       "doc_count": 1,
+                                                                       "first_occur_time": doc_timestamp,
+                                                                       "last_occur_time": doc_timestamp,
+                                                                       "top_doc": raw_doc}
                 else:
-                    aggr_dict[aggr_value]["target"]["buckets"][target_value]["doc_count"] += 1
+                    first_occur_bucket = first_occur_buckets[(aggr_value, target_value)]
+                    first_occur_bucket["doc_count"] += 1
+                    first_occur_bucket["last_occur_time"] = max(first_occur_bucket["last_occur_time"], doc_timestamp)
 
-                    previous_doc = aggr_dict[aggr_value]["target"]["buckets"][target_value]["top_doc"]["hits"]["hits"][0]
-                    previous_doc_timestamp = previous_doc["_source"]["@timestamp"]
-                    previous_doc_timestamp = dateutil.parser.parse(previous_doc_timestamp, ignoretz=True)
+                    if doc_timestamp < first_occur_bucket["first_occur_time"]:
+                        first_occur_bucket["first_occur_time"] = doc_timestamp
+                        first_occur_bucket["top_doc"] = raw_doc
 
-                    if doc_timestamp < previous_doc_timestamp:
-                        aggr_dict[aggr_value]["target"]["buckets"][target_value]["top_doc"]["hits"]["hits"] = [raw_doc]
+        for first_occur_bucket in first_occur_buckets.values():
+            if not fetch_documents:
+                first_occur_bucket["top_doc"] = None
+            yield first_occur_bucket
 
-        return _convert_to_elastic_search_format(aggr_dict)
+    def scan_first_occur_per_interval(self, search_query, start_time, end_time, interval, model_settings):
+        """
+        Function that imitate the helpers.es.scan_first_occur_per_interval() function behavior.
+        """
+        first_occur_buckets = dict()
+        for raw_doc in self.list_data.values():
+            doc = raw_doc["_source"]
+            doc_timestamp = dateutil.parser.parse(doc["@timestamp"], ignoretz=True)
+            if end_time >= doc_timestamp >= start_time:
+                aggr_value = _get_values_from_list_field(doc, model_settings["aggregator"])
+                target_value = _get_values_from_list_field(doc, model_settings["target"])
+                interval_index = (doc_timestamp - start_time) // interval
+
+                key = (aggr_value, target_value, interval_index)
+                if key not in first_occur_buckets:
+                    first_occur_buckets[key] = {"aggregator": aggr_value, "target": target_value,
+                                                "interval": interval_index, "doc_count": 0,
+                                                "first_occur_time": doc_timestamp, "last_occur_time": doc_timestamp,
+                                                "top_doc": None}
+                first_occur_buckets[key]["doc_count"] += 1
+                first_occur_buckets[key]["first_occur_time"] = min(first_occur_buckets[key]["first_occur_time"],
+                                                                   doc_timestamp)
+                first_occur_buckets[key]["last_occur_time"] = max(first_occur_buckets[key]["last_occur_time"],
+                                                                  doc_timestamp)
+
+        for first_occur_bucket in first_occur_buckets.values():
+            yield first_occur_bucket
+
+    def fetch_first_occur_documents(self, first_occur_buckets, search_query, start_time, end_time, model_settings):
+        """
+        Function that imitate the helpers.es.fetch_first_occur_documents() function behavior.
+        """
+        for first_occur_bucket in first_occur_buckets:
+            for raw_doc in self.list_data.values():
+                doc = raw_doc["_source"]
+                doc_timestamp = dateutil.parser.parse(doc["@timestamp"], ignoretz=True)
+                if end_time >= doc_timestamp >= start_time and \
+                        _get_values_from_list_field(doc, model_settings["aggregator"]) == \
+                        first_occur_bucket["aggregator"] and \
+                        _get_values_from_list_field(doc, model_settings["target"]) == first_occur_bucket["target"]:
+                    top_doc = first_occur_bucket["top_doc"]
+                    if top_doc is None or \
+                            doc_timestamp < dateutil.parser.parse(top_doc["_source"]["@timestamp"], ignoretz=True):
+                        first_occur_bucket["top_doc"] = raw_doc
+
+    def add_outlier_by_query(self, index, search_query, model_settings, outlier_dict_of_arrays):
+        """
+        Function that imitate the helpers.es.add_outlier_by_query() function behavior.
+        The outlier is added to all documents, whatever the search query.
+        """
+        result = {"total": len(self.list_data), "updated": 0, "noops": 0, "version_conflicts": 0, "failures": []}
+        for doc_id, doc in self.list_data.items():
+            if outlier_dict_of_arrays["summary"][0] in doc["_source"].get("outliers", dict()).get("summary", list()):
+                result["noops"] += 1
+                continue
+
+            doc_outlier_dict_of_arrays = dict(outlier_dict_of_arrays)
+            assets = helpers.utils.extract_outlier_asset_information(doc["_source"], settings)
+            if assets:
+                doc_outlier_dict_of_arrays["assets"] = assets
+            self.list_data[doc_id] = helpers.es.add_outlier_dict_to_document(doc, doc_outlier_dict_of_arrays)
+            result["updated"] += 1
+        return result
 
     def remove_all_outliers(self):
         self.list_data = dict()
@@ -132,8 +299,16 @@ class TestStubEs:
 
         for bulk in es.bulk_actions:
             if bulk['_op_type'] == 'update':
+                # If it is a request using the stored script adding outliers
+                if "_source" in bulk and bulk["_source"].get("script", dict()).get("id") == \
+                        helpers.es.ADD_OUTLIERS_SCRIPT_ID:
+                    data = self.list_data[bulk['_id']]
+                    for outlier_dict_of_arrays in bulk["_source"]["script"]["params"]["outliers"]:
+                        data = helpers.es.add_outlier_dict_to_document(data, outlier_dict_of_arrays)
+                    self.list_data[bulk['_id']] = data
+
                 # If it is a script bulk request
-                if "_source" in bulk and "script" in bulk["_source"]:
+                elif "_source" in bulk and "script" in bulk["_source"]:
                     data = self.list_data[bulk['_id']]
 
                     # We supposed here that only the remove of outlier is possible
@@ -153,6 +328,9 @@ class TestStubEs:
 
                     self.list_data[bulk['_id']].update(data)
 
+            elif bulk['_op_type'] == 'delete':
+                self.list_data.pop(bulk['_id'])
+
             else:
                 raise KeyError('Unknown bulk action: "' + bulk['_op_type'] + '"')
         es.bulk_actions = []
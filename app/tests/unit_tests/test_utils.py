@@ -348,6 +348,33 @@ class TestUtils(unittest.TestCase):
                     res = helpers.utils.get_decision_frontier("mad", values_array, sensitivity, "high")
                 self.assertEqual(res, expected_res)
 
+    def test_decision_frontier_from_stats_same_as_from_values(self):
+        for values_array in list_values_array + [[1, 1, 1, 5]]:
+            median_value = np.median(values_array)
+            stats = {"max": max(values_array), "avg": np.mean(values_array), "std_deviation": np.std(values_array),
+                     "mad": np.median(np.absolute(np.array(values_array) - median_value)),
+                     "percentiles": {50.0: median_value}}
+
+            for trigger_method in ("pct_of_max_value", "pct_of_median_value", "pct_of_avg_value", "mad", "madpos",
+                                   "stdev", "float", "coeff_of_variation"):
+                for trigger_on in ("high", "low"):
+                    for sensitivity in list_sensitivity:
+                        expected_res = helpers.utils.get_decision_frontier(trigger_method, values_array, sensitivity,
+                                                                           trigger_on)
+                        res = helpers.utils.get_decision_frontier_from_stats(trigger_method, stats, sensitivity,
+                                                                             trigger_on)
+                        self.assertAlmostEqual(res, expected_res)
+
+    def test_decision_frontier_from_stats_coeff_of_variation_with_zero_average(self):
+        values_array = [0, 0, 0]
+        stats = {"max": 0, "avg": 0.0, "std_deviation": 0.0, "mad": 0.0, "percentiles": {50.0: 0.0}}
+
+        with np.errstate(invalid="ignore"):
+            expected_res = helpers.utils.get_decision_frontier("coeff_of_variation", values_array, 1, "high")
+            res = helpers.utils.get_decision_frontier_from_stats("coeff_of_variation", stats, 1, "high")
+        self.assertTrue(np.isnan(expected_res))
+        self.assertTrue(np.isnan(res))
+
     def test_decision_frontier_mad_zero(self):
         values_array = [1, 1]
         sensitivity = 10